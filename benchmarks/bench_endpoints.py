@@ -0,0 +1,213 @@
+"""Throughput and tail latency of the Flask routes.
+
+Drives the routes at a fixed concurrency, either in-process through the
+Flask test client or against a running server with --url. Model calls go
+to llm.FakeClient with the given latency, menus come from the
+data/menu_htmls fixture for --date, and users live in a scratch database.
+Routes that print go to /dev/null while measured.
+
+    python benchmarks/bench_endpoints.py --concurrency 16 --requests 500 --output results.json
+    python benchmarks/bench_endpoints.py --compare results.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm
+import menu_archive
+import menu_scrape
+
+USER = "rahul"  # The routes still hardcode this user
+PASSWORD = "benchmark"
+LOCATION = "42.2780,-83.7382"
+ROUTES = ['getmenu', 'get_full_menu', 'send_message', 'save_preferences', 'login']
+
+
+def route_request(route, preferences):
+    """Return (method, path, headers, json body) for one request to `route`."""
+    if route == 'getmenu':
+        return 'GET', '/getmenu/', {'location': LOCATION}, None
+    if route == 'get_full_menu':
+        return 'GET', '/get_full_menu/', {}, None
+    if route == 'send_message':
+        return 'POST', '/send_message/', {'message': 'Where can I get pizza tonight?'}, None
+    if route == 'save_preferences':
+        return 'POST', '/save_preferences/', {}, preferences
+    if route == 'login':
+        return 'POST', '/login/', {'uniqname': USER, 'password': PASSWORD}, None
+    raise ValueError(route)
+
+
+def setup_app(args):
+    """Import the app against scratch databases and the fixture date."""
+    scratch = os.path.abspath(args.scratch)
+    os.makedirs(scratch, exist_ok=True)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(os.path.join(scratch, 'users.db' + suffix)):
+            os.remove(os.path.join(scratch, 'users.db' + suffix))
+
+    llm.set_client(llm.FakeClient(first_token_delay=args.first_token_delay, token_delay=args.token_delay))
+
+    import db
+    import handler
+    from handler import Handler
+    handler.users_db = os.path.join(scratch, 'users.db')
+    handler.migrate_users_db()
+    Handler.register_new_user(USER, PASSWORD)
+
+    # The routes serve the current date's menus; point them at the fixture. Importing
+    # the app starts no prefetcher, so nothing rolls the date back to today
+    menu_scrape.set_current_date(args.date)
+
+    import flaskServer
+
+    for module in (handler, db, menu_scrape, llm, flaskServer):
+        module.logger.setLevel('WARNING')
+    # Parse the fixture once so the first measured requests are not cold
+    menu_scrape.fetch_dining_hall_info(args.date)
+    return flaskServer.app, Handler.default_preferences
+
+
+def make_sender(args, app):
+    """Return send(method, path, headers, body) -> status code, with one client per thread."""
+    local = threading.local()
+    if args.url:
+        import requests
+
+        def send(method, path, headers, body):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            response = local.session.request(method, args.url.rstrip('/') + path, headers=headers, json=body, timeout=60)
+            return response.status_code
+    else:
+        def send(method, path, headers, body):
+            if not hasattr(local, 'client'):
+                local.client = app.test_client()
+            response = local.client.open(path, method=method, headers=headers, json=body)
+            response.get_data()
+            return response.status_code
+    return send
+
+
+def run_route(route, send, preferences, concurrency, requests_count):
+    method, path, headers, body = route_request(route, preferences)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def one(_):
+        started = time.perf_counter()
+        try:
+            status = send(method, path, headers, body)
+            error = status >= 400
+        except Exception as e:
+            status, error = str(e), True
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if error:
+                errors.append(status)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests_count)))
+    elapsed = time.perf_counter() - started
+
+    samples = sorted(latencies)
+    percentile = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return {
+        "route": route,
+        "requests": requests_count,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests_count / elapsed, 1),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "p50_ms": round(percentile(0.50), 3),
+        "p95_ms": round(percentile(0.95), 3),
+        "p99_ms": round(percentile(0.99), 3),
+        "errors": len(errors),
+        "error_statuses": sorted({str(status) for status in errors}),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_comparison(results, previous):
+    before = {result["route"]: result for result in previous["results"]}
+    print(f"\ncompared with {previous.get('revision') or 'previous run'}:")
+    for result in results:
+        old = before.get(result["route"])
+        if not old:
+            continue
+        change = lambda key: (result[key] - old[key]) / old[key] * 100 if old[key] else 0
+        print(f"{result['route']:>16}: rps {change('requests_per_second'):+.1f}%  p50 {change('p50_ms'):+.1f}%  "
+              f"p95 {change('p95_ms'):+.1f}%  p99 {change('p99_ms'):+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=ROUTES)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help="requests per route")
+    parser.add_argument('--warmup', type=int, default=5, help="unmeasured requests per route first")
+    parser.add_argument('--date', default='2024-11-18', help="fixture date under data/menu_htmls")
+    parser.add_argument('--first-token-delay', type=float, default=0.2, help="fake model latency, seconds")
+    parser.add_argument('--token-delay', type=float, default=0.01, help="fake model time per token, seconds")
+    parser.add_argument('--url', help="benchmark a running server instead of the in-process app")
+    parser.add_argument('--scratch', default=os.path.join('var', 'bench'), help="directory for scratch databases")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--compare', help="print the change from the results in this JSON file")
+    args = parser.parse_args()
+
+    if not menu_archive.has_day(os.path.join(menu_scrape.menu_htmls_dir, args.date)):
+        parser.error(f"no fixture for {args.date} in {menu_scrape.menu_htmls_dir}")
+
+    app, preferences = setup_app(args)
+    send = make_sender(args, app)
+
+    results = []
+    # Some routes print their responses; keep that out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for route in args.routes:
+            method, path, headers, body = route_request(route, preferences)
+            for _ in range(args.warmup):
+                send(method, path, headers, body)
+            results.append(run_route(route, send, preferences, args.concurrency, args.requests))
+
+    for result in results:
+        print(f"{result['route']:>16}: {result['requests_per_second']:>8} req/s  p50 {result['p50_ms']}ms  "
+              f"p95 {result['p95_ms']}ms  p99 {result['p99_ms']}ms  errors {result['errors']}")
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "target": args.url or "in-process",
+        "settings": {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        "results": results,
+    }
+    if args.compare:
+        with open(args.compare) as file:
+            print_comparison(results, json.load(file))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""Parse, write and scrape timings over the data/menu_htmls fixtures.
+
+For every parser engine and every fixture day this times each hall's page,
+the whole day, the peak memory of parsing the day and the writing of the
+parsed day to the menu store. Synthetic pages repeat every station's items
+--scales times to show how parsing grows with page size. The scrape phase
+downloads a day's pages from a local HTTP server, first cold and then as
+conditional requests answered with 304.
+
+    python benchmarks/bench_parser.py --output parser.json
+    python benchmarks/bench_parser.py --baseline parser.json --threshold 0.2
+
+With --baseline, any timing more than --threshold slower than the same
+timing in the baseline fails the run with exit status 1.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import menu_archive
+import menu_scrape
+import menu_store
+
+ITEMS_LIST = re.compile(r'<ul class="items">')
+LIST_TAG = re.compile(r'<(/?)ul\b')
+
+
+def enlarge_page(html_content, factor):
+    """Repeat the contents of every station's item list `factor` times."""
+    if factor == 1:
+        return html_content
+    parts = []
+    position = 0
+    for match in ITEMS_LIST.finditer(html_content):
+        if match.start() < position:
+            continue
+        inner_start = match.end()
+        depth = 1
+        for tag in LIST_TAG.finditer(html_content, inner_start):
+            depth += -1 if tag.group(1) else 1
+            if depth == 0:
+                break
+        inner_end = tag.start()
+        parts.append(html_content[position:inner_start])
+        parts.append(html_content[inner_start:inner_end] * factor)
+        position = inner_end
+    parts.append(html_content[position:])
+    return ''.join(parts)
+
+
+def load_day(date):
+    return dict(menu_archive.read_pages(os.path.join(menu_scrape.menu_htmls_dir, date)))
+
+
+def timed(function, repeat):
+    """Return (median seconds, last result) of calling `function` `repeat` times."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times), result
+
+
+def bench_parsing(engine, date, scale, pages, repeat):
+    pages = {name: enlarge_page(html, scale) for name, html in pages.items()}
+    halls = {}
+    parsed = []
+    for name, html in pages.items():
+        seconds, result = timed(lambda: menu_scrape.parse_menu_html(html, date, engine), repeat)
+        halls[name] = round(seconds * 1000, 3)
+        parsed.append(result)
+
+    day_seconds, _ = timed(lambda: [menu_scrape.parse_menu_html(html, date, engine) for html in pages.values()], repeat)
+
+    tracemalloc.start()
+    [menu_scrape.parse_menu_html(html, date, engine) for html in pages.values()]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    items = sum(len(items) for hall in parsed for meals in hall["menus"].values() for items in meals.values())
+    return {
+        "engine": engine,
+        "date": date,
+        "scale": scale,
+        "page_bytes": sum(len(html.encode()) for html in pages.values()),
+        "items": items,
+        "hall_ms": halls,
+        "day_ms": round(day_seconds * 1000, 3),
+        "peak_memory_mb": round(peak / 2 ** 20, 2),
+        "digest": hashlib.sha256(json.dumps(parsed, sort_keys=True).encode()).hexdigest()[:16],
+    }, parsed
+
+
+@contextlib.contextmanager
+def scratch_store():
+    """Point every menu store path at a temporary directory, so the real output/ is never touched."""
+    paths = ('store_dir', 'index_path', 'pages_dir', 'legacy_output_path')
+    saved = {name: getattr(menu_store, name) for name in paths}
+    with tempfile.TemporaryDirectory() as scratch:
+        menu_store.store_dir = scratch
+        menu_store.index_path = os.path.join(scratch, 'index.json')
+        menu_store.pages_dir = os.path.join(scratch, 'pages')
+        menu_store.legacy_output_path = os.path.join(scratch, 'dining_hall_info.json')
+        os.makedirs(menu_store.pages_dir)
+        try:
+            yield scratch
+        finally:
+            for name, value in saved.items():
+                setattr(menu_store, name, value)
+
+
+def bench_writing(date, parsed, repeat):
+    """Time saving a parsed day to a scratch menu store."""
+    with scratch_store() as scratch:
+        seconds, _ = timed(lambda: menu_store.save_day(date, parsed), repeat)
+        size = os.path.getsize(os.path.join(scratch, f'{date}.json'))
+    return {"date": date, "write_ms": round(seconds * 1000, 3), "output_bytes": size}
+
+
+def bench_scrape(date, pages):
+    """Download a day from a local server: once cold, once as conditional requests."""
+    bodies = {name[:-len('.html')]: html.encode() for name, html in pages.items()}
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = bodies.get(self.path.split('?')[0].strip('/'))
+            if body is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/'
+    menu_htmls_dir = menu_scrape.menu_htmls_dir
+    try:
+        with tempfile.TemporaryDirectory() as scratch:
+            menu_scrape.menu_htmls_dir = scratch
+            results = {}
+            for phase in ('cold', 'revalidate'):
+                started = time.perf_counter()
+                statuses = menu_scrape.download_menu_pages([date], base_url=base_url)
+                results[f"{phase}_ms"] = round((time.perf_counter() - started) * 1000, 3)
+                results[f"{phase}_statuses"] = sorted(set(statuses.values()))
+    finally:
+        menu_scrape.menu_htmls_dir = menu_htmls_dir
+        server.shutdown()
+    return dict(results, date=date)
+
+
+def regressions(results, baseline, threshold):
+    """Return descriptions of timings more than `threshold` slower than the baseline."""
+    def timings(report):
+        values = {}
+        for run in report["parsing"]:
+            key = f"parse {run['engine']} {run['date']} x{run['scale']}"
+            values[key] = run["day_ms"]
+        for run in report["writing"]:
+            values[f"write {run['date']}"] = run["write_ms"]
+        return values
+
+    before = timings(baseline)
+    failures = []
+    for key, value in timings(results).items():
+        if key in before and before[key] and value > before[key] * (1 + threshold):
+            failures.append(f"{key}: {value}ms vs {before[key]}ms ({(value / before[key] - 1) * 100:+.0f}%)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', nargs='+', choices=sorted(menu_scrape.PARSER_ENGINES),
+                        default=sorted(menu_scrape.PARSER_ENGINES))
+    parser.add_argument('--dates', nargs='+', help="fixture dates (default: all under data/menu_htmls)")
+    parser.add_argument('--scales', nargs='+', type=int, default=[1, 4], help="synthetic page size multipliers")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per timing; the median is reported")
+    parser.add_argument('--no-scrape', action='store_true', help="skip the local download phase")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    for module in (menu_scrape, menu_store):
+        module.logger.setLevel('WARNING')
+
+    dates = args.dates or sorted(name for name in os.listdir(menu_scrape.menu_htmls_dir)
+                                 if re.fullmatch(r'\d{4}-\d{2}-\d{2}', name))
+    report = {"timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'), "parsing": [], "writing": [], "scrape": []}
+    for date in dates:
+        pages = load_day(date)
+        for scale in args.scales:
+            digests = set()
+            for engine in args.engines:
+                run, parsed = bench_parsing(engine, date, scale, pages, args.repeat)
+                report["parsing"].append(run)
+                digests.add(run["digest"])
+                print(f"parse {engine:>11} {date} x{scale}: {run['day_ms']:>9}ms/day  {run['items']:>5} items  "
+                      f"peak {run['peak_memory_mb']}MB")
+            if len(digests) > 1:
+                print(f"  engines disagree on {date} x{scale}")
+        # Write the day as it really is, not the last engine's synthetic enlargement
+        day = [menu_scrape.parse_menu_html(html, date, args.engines[0]) for html in pages.values()]
+        report["writing"].append(bench_writing(date, day, args.repeat))
+        print(f"write {date}: {report['writing'][-1]['write_ms']}ms, {report['writing'][-1]['output_bytes']} bytes")
+        if not args.no_scrape:
+            report["scrape"].append(bench_scrape(date, pages))
+            scrape = report["scrape"][-1]
+            print(f"scrape {date}: cold {scrape['cold_ms']}ms {scrape['cold_statuses']}, "
+                  f"revalidate {scrape['revalidate_ms']}ms {scrape['revalidate_statuses']}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            failures = regressions(report, json.load(file), args.threshold)
+        if failures:
+            print(f"\n{len(failures)} timings regressed by more than {args.threshold:.0%}:")
+            for failure in failures:
+                print(f"  {failure}")
+            sys.exit(1)
+        print(f"\nNo timings regressed by more than {args.threshold:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Concurrent read/write throughput of the users database.
+
+Simulates many users hitting the Handler preference helpers from a pool of
+threads. ``pooled`` goes through the shared WAL connection layer in db.py;
+``legacy`` opens a fresh connection per operation like the old helpers did;
+``server`` sends /fetch_preferences/ and /save_preferences/ requests to the
+app on werkzeug's threaded server, which runs every request on a new
+thread, and also reports how many connections db.py had to open.
+
+    python benchmarks/bench_users_db.py --users 500 --threads 16 --ops 20000
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import handler
+from handler import Handler
+
+
+def setup_database(path, users, wal):
+    """Create a scratch users database with the app's current schema."""
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db.close_connections()
+    handler.users_db = path
+    handler.migrate_users_db()
+    preferences = json.dumps(Handler.default_preferences)
+    with db.transaction(path) as c:
+        c.executemany(
+            "INSERT INTO users (user_id, password, preferences) VALUES (?, ?, ?)",
+            [(f"user{n}", Handler.encrypt_password("password"), preferences) for n in range(users)] + [("rahul", Handler.encrypt_password("password"), preferences)],
+        )
+    db.close_connections()
+    if not wal:
+        # db.py switches every database it opens to WAL; the old helpers used the default journal
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode = DELETE")
+        conn.close()
+
+
+def legacy_read(path, user_id):
+    conn = sqlite3.connect(path, timeout=30)
+    c = conn.cursor()
+    c.execute("SELECT preferences FROM users WHERE user_id = ?", (user_id,))
+    result = c.fetchone()
+    conn.close()
+    return json.loads(result[0])
+
+
+def legacy_write(path, user_id, preferences):
+    conn = sqlite3.connect(path, timeout=30)
+    c = conn.cursor()
+    c.execute("SELECT preferences FROM users WHERE user_id = ?", (user_id,))
+    c.fetchone()
+    c.execute("UPDATE users SET preferences = ? WHERE user_id = ?", (json.dumps(preferences), user_id))
+    conn.commit()
+    conn.close()
+
+
+def start_server(date):
+    """Serve the app on werkzeug's threaded server in the background; returns its URL."""
+    import llm
+    import menu_scrape
+    # Recommendations are built from this fixture day's menus rather than scraped
+    menu_scrape.set_current_date(date)
+    # Saving preferences refreshes the user's recommendation
+    llm.set_client(llm.FakeClient(first_token_delay=0, token_delay=0))
+    from werkzeug.serving import make_server
+    import flaskServer
+    for module in (flaskServer, llm):
+        module.logger.setLevel('WARNING')
+    server = make_server('127.0.0.1', 0, flaskServer.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def run(mode, path, users, threads, ops, write_ratio, seed, date):
+    setup_database(path, users, wal=(mode != 'legacy'))
+    if mode == 'server':
+        base_url = start_server(date)
+        http = threading.local()
+    opened = db.stats()["opened"]
+    rng = random.Random(seed)
+    plan = [(f"user{rng.randrange(users)}", rng.random() < write_ratio) for _ in range(ops)]
+    latencies = [[] for _ in range(threads)]
+    errors = []
+    slot = threading.local()
+    counter = iter(range(threads))
+    counter_lock = threading.Lock()
+
+    def operation(step):
+        if not hasattr(slot, 'index'):
+            with counter_lock:
+                slot.index = next(counter)
+        user_id, is_write = step
+        started = time.perf_counter()
+        try:
+            if mode == 'server':
+                if not hasattr(http, 'session'):
+                    http.session = requests.Session()
+                if is_write:
+                    response = http.session.post(base_url + '/save_preferences/', json=Handler.default_preferences)
+                else:
+                    response = http.session.get(base_url + '/fetch_preferences/')
+                if response.status_code != 200:
+                    errors.append(response.text)
+            elif mode == 'pooled':
+                if is_write:
+                    Handler.save_user_preferences(user_id, Handler.default_preferences)
+                else:
+                    Handler.fetch_user_preferences(user_id)
+            else:
+                if is_write:
+                    legacy_write(path, user_id, Handler.default_preferences)
+                else:
+                    legacy_read(path, user_id)
+        except sqlite3.Error as e:
+            errors.append(str(e))
+        latencies[slot.index].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    # The preferences route prints every body it receives
+    with ThreadPoolExecutor(max_workers=threads) as executor, contextlib.redirect_stdout(open(os.devnull, 'w')):
+        list(executor.map(operation, plan))
+    elapsed = time.perf_counter() - started
+    opened = db.stats()["opened"] - opened
+    db.close_connections()
+
+    samples = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+    percentile = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return {
+        "mode": mode,
+        "users": users,
+        "threads": threads,
+        "ops": ops,
+        "write_ratio": write_ratio,
+        "seconds": round(elapsed, 3),
+        "ops_per_second": round(ops / elapsed, 1),
+        "mean_ms": round(statistics.mean(samples) * 1000, 3),
+        "p50_ms": round(percentile(0.50), 3),
+        "p95_ms": round(percentile(0.95), 3),
+        "p99_ms": round(percentile(0.99), 3),
+        "errors": len(errors),
+        "connections_opened": opened if mode != 'legacy' else ops,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['pooled', 'legacy', 'server', 'all'], default='all')
+    parser.add_argument('--db', default=os.path.join(handler.var_dir, 'bench_users.db'),
+                        help="scratch database to create (default: var/bench_users.db)")
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--ops', type=int, default=20000)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--date', default='2024-11-18', help="fixture date under data/menu_htmls, for server mode")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # The helpers log every call; keep the benchmark output readable
+    handler.logger.setLevel('WARNING')
+    db.logger.setLevel('WARNING')
+
+    modes = ['legacy', 'pooled', 'server'] if args.mode == 'all' else [args.mode]
+    results = [run(mode, args.db, args.users, args.threads, args.ops, args.write_ratio, args.seed, args.date) for mode in modes]
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+
+    for result in results:
+        print(f"{result['mode']:>7}: {result['ops_per_second']:>9} ops/s  p50 {result['p50_ms']}ms  "
+              f"p95 {result['p95_ms']}ms  p99 {result['p99_ms']}ms  errors {result['errors']}  "
+              f"connections {result['connections_opened']}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Memory each worker adds, by route, when the menus come from a snapshot.
+
+Mimics gunicorn with preload_app: the app is imported once, one process
+parses a fixture day and publishes its snapshot, then a fresh process is
+forked from the importing one for each route. That process serves the
+route --requests times and reports whether it decoded the menus and how
+much private memory (pages no other process shares) it gained. Touching
+shared objects also copies pages, so compare with the "decode" row, a
+worker decoding the menus and nothing else. Linux only, as it reads
+/proc/self/smaps_rollup.
+
+    python benchmarks/bench_workers.py --requests 20 --output results.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('PREFETCH', '0')
+os.environ.setdefault('LLM_BACKEND', 'fake')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import menu_archive
+import menu_scrape
+
+USER = "rahul"  # The routes still hardcode this user
+LOCATION = "42.2780,-83.7382"
+ROUTES = {
+    'getmenu': ('GET', '/getmenu/', {'location': LOCATION}),
+    'get_full_menu': ('GET', '/get_full_menu/', {}),
+    'get_full_menu_hall': ('GET', '/get_full_menu/?hall=bursley', {}),
+    'nearest_halls': ('GET', f'/nearest_halls/?location={LOCATION}', {}),
+    'send_message': ('POST', '/send_message/', {'message': 'Where can I get pizza tonight?'}),
+}
+
+
+def private_kb():
+    """Private_Clean + Private_Dirty of this process, in kB."""
+    total = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                total += int(line.split()[1])
+    return total
+
+
+def setup_app(args, scratch):
+    """Import the app against scratch databases, menu store and snapshots."""
+    import handler
+    import menu_db
+    import menu_snapshot
+    import menu_store
+    from handler import Handler
+
+    handler.users_db = os.path.join(scratch, 'users.db')
+    menu_db.menus_db = os.path.join(scratch, 'menus.db')
+    menu_db._init_db()
+    menu_store.store_dir = os.path.join(scratch, 'menus')
+    menu_store.index_path = os.path.join(menu_store.store_dir, 'index.json')
+    menu_store.pages_dir = os.path.join(menu_store.store_dir, 'pages')
+    menu_store.legacy_output_path = os.path.join(scratch, 'dining_hall_info.json')
+    menu_snapshot.snapshot_dir = os.path.join(scratch, 'snapshots')
+    os.makedirs(menu_store.pages_dir)
+    os.makedirs(menu_snapshot.snapshot_dir)
+    handler.migrate_users_db()
+    Handler.register_new_user(USER, 'benchmark')
+    menu_scrape.set_current_date(args.date)
+
+    import flaskServer
+    for module in (handler, menu_scrape, flaskServer):
+        module.logger.setLevel('WARNING')
+    return flaskServer.app
+
+
+def in_child(work):
+    """Run work() in a forked process and return its JSON-able result."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            result = work()
+        except Exception as e:
+            result = {"error": repr(e)}
+        with os.fdopen(write, 'w') as f:
+            json.dump(result, f)
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as f:
+        result = json.load(f)
+    os.waitpid(pid, 0)
+    return result
+
+
+def measure(app, route, requests_count):
+    def work():
+        before = private_kb()
+        if route == 'decode':
+            menu_scrape.fetch_dining_hall_info()
+        else:
+            method, path, headers = ROUTES[route]
+            client = app.test_client()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                for _ in range(requests_count):
+                    client.open(path, method=method, headers=headers).get_data()
+        return {"route": route, "private_kb": private_kb() - before,
+                "decoded": menu_scrape.menu_cache.latest(menu_scrape.current_date()) is not None}
+    return in_child(work)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--routes', nargs='+', choices=list(ROUTES), default=list(ROUTES))
+    parser.add_argument('--requests', type=int, default=20, help="requests per route")
+    parser.add_argument('--date', default='2024-11-18', help="fixture date under data/menu_htmls")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        parser.error("needs Linux's /proc/self/smaps_rollup")
+    if not menu_archive.has_day(os.path.join(menu_scrape.menu_htmls_dir, args.date)):
+        parser.error(f"no fixture for {args.date} in {menu_scrape.menu_htmls_dir}")
+
+    with tempfile.TemporaryDirectory() as scratch:
+        app = setup_app(args, scratch)
+        # Another worker parses the day, publishes it and loads the menus database
+        import menu_db
+        in_child(lambda: menu_db.ensure_day(args.date) or {})
+
+        results = [measure(app, route, args.requests) for route in ['decode'] + args.routes]
+
+    for result in results:
+        if 'error' in result:
+            print(f"{result['route']:>18}: {result['error']}")
+        else:
+            print(f"{result['route']:>18}: {result['private_kb']:>6} kB  {'decoded the menus' if result['decoded'] else 'read the snapshot'}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'), "python": platform.python_version(),
+                       "date": args.date, "requests": args.requests, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
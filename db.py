@@ -0,0 +1,141 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# Applied to every new connection. WAL lets readers run alongside a writer,
+# and synchronous=NORMAL is durable across application crashes in WAL mode.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+)
+
+# Idle connections kept per database. More can be checked out at once when many
+# threads are busy; the ones beyond this are closed when they are returned.
+POOL_SIZE = 8
+
+_pools = {}
+_pools_lock = threading.Lock()
+_local = threading.local()
+_opened = 0
+
+
+def _open(path):
+    global _opened
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    with _pools_lock:
+        _opened += 1
+    logger.debug(f"Opened connection to {path}")
+    return conn
+
+def _pool(path):
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = queue.LifoQueue(maxsize=POOL_SIZE)
+        return pool
+
+@contextmanager
+def connection(path):
+    """Check out a connection to `path` for the enclosed block, and return it to the pool after.
+
+    Connections run in autocommit mode; use transaction() to group writes.
+    Nested blocks in one thread share the outer block's connection, so a
+    read inside a transaction sees its writes.
+    """
+    held = getattr(_local, 'held', None)
+    if held is None:
+        held = _local.held = {}
+    entry = held.get(path)
+    if entry is not None:
+        entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            entry[1] -= 1
+        return
+
+    try:
+        conn = _pool(path).get_nowait()
+    except queue.Empty:
+        conn = _open(path)
+    held[path] = [conn, 1]
+    try:
+        yield conn
+    finally:
+        del held[path]
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _pool(path).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def _forget_connections():
+    # A forked worker must not share its parent's connections, so it opens its own
+    global _pools, _pools_lock, _local
+    _pools = {}
+    _pools_lock = threading.Lock()
+    _local = threading.local()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_connections)
+
+def close_connections():
+    """Close every idle pooled connection; connections in use are closed when returned."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+def stats():
+    """Connections opened so far, and idle connections per database."""
+    with _pools_lock:
+        return {"opened": _opened, "idle": {path: pool.qsize() for path, pool in _pools.items()}}
+
+@contextmanager
+def cursor(path):
+    """Yield a cursor for reads or single autocommitted statements."""
+    with connection(path) as conn:
+        c = conn.cursor()
+        try:
+            yield c
+        finally:
+            c.close()
+
+@contextmanager
+def transaction(path, immediate=True):
+    """Run the enclosed statements in one transaction.
+
+    IMMEDIATE takes the write lock up front so read-then-write sequences do
+    not fail with SQLITE_BUSY halfway through. Keep the block short and never
+    make network calls inside it.
+    """
+    with connection(path) as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield c
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            c.close()
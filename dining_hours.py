@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+hours_path = os.path.join(this_dir, 'data', 'static_info', 'dining_hall_hours.json')
+
+# Same numbering as the hours file's day names: Sunday is 0
+DAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+# When two periods share a boundary (e.g. breakfast ends as lunch starts) the earlier one wins
+MEAL_PRIORITY = ['Breakfast', 'Lunch', 'Brunch', 'Dinner']
+
+
+def weekday_of(at):
+    return (at.weekday() + 1) % 7
+
+def hour_of(at):
+    return at.hour + at.minute / 60
+
+def _expand_days(day_range):
+    """'Monday - Thursday' -> [1, 2, 3, 4]; ranges may wrap, e.g. 'Saturday - Sunday'."""
+    if '-' not in day_range:
+        return [DAYS.index(day_range.strip())]
+    beginning, end = (DAYS.index(day.strip()) for day in day_range.split('-'))
+    return [(beginning + offset) % 7 for offset in range((end - beginning) % 7 + 1)]
+
+def _serving_at(periods, time):
+    for meal in MEAL_PRIORITY:
+        if meal in periods and periods[meal][0] <= time <= periods[meal][1]:
+            return (meal, periods[meal])
+    return None
+
+
+class Schedule:
+    """Dining hall hours compiled into per-weekday lookup tables.
+
+    For every weekday the opening and closing times of all halls are merged
+    into one sorted list of boundaries. The status of every hall is
+    precomputed for each boundary and for each gap between boundaries, so a
+    lookup is a single bisect. Periods include both endpoints, as before.
+    """
+
+    def __init__(self, hours):
+        self.halls = list(hours)
+        # periods[weekday][hall] = {meal: [start, end]}
+        self.periods = [{} for _ in DAYS]
+        for hall, day_ranges in hours.items():
+            for day_range, periods in day_ranges.items():
+                for weekday in _expand_days(day_range):
+                    self.periods[weekday].setdefault(hall, periods)
+
+        self._boundaries = []
+        self._at_boundary = []
+        self._between = []
+        self._starts = []
+        for weekday in range(len(DAYS)):
+            day_periods = self.periods[weekday]
+            boundaries = sorted({time for periods in day_periods.values()
+                                 for interval in periods.values() for time in interval})
+            # Representative times: one per boundary, one inside each gap around them
+            gaps = [boundaries[0] - 1 if boundaries else 0]
+            gaps += [(left + right) / 2 for left, right in zip(boundaries, boundaries[1:])]
+            gaps += [boundaries[-1] + 1] if boundaries else []
+            self._boundaries.append(boundaries)
+            self._at_boundary.append([self._compile_state(day_periods, time) for time in boundaries])
+            self._between.append([self._compile_state(day_periods, time) for time in gaps])
+            self._starts.append({
+                hall: sorted((interval[0], meal) for meal, interval in periods.items())
+                for hall, periods in day_periods.items()
+            })
+
+    def _compile_state(self, day_periods, time):
+        statuses = {hall: _serving_at(day_periods.get(hall, {}), time) for hall in self.halls}
+        by_meal = {}
+        for hall, status in statuses.items():
+            if status:
+                by_meal.setdefault(status[0], []).append(hall)
+        return statuses, by_meal
+
+    def _state(self, at):
+        weekday = weekday_of(at)
+        time = hour_of(at)
+        boundaries = self._boundaries[weekday]
+        position = bisect_left(boundaries, time)
+        if position < len(boundaries) and boundaries[position] == time:
+            return self._at_boundary[weekday][position]
+        return self._between[weekday][position]
+
+    def statuses(self, at):
+        """Return {hall: (meal, [start, end]) or None} for every hall at `at`."""
+        return self._state(at)[0]
+
+    def status(self, hall, at):
+        return self._state(at)[0].get(hall)
+
+    def open_halls(self, meal, at):
+        """Return the halls serving `meal` at `at`."""
+        return list(self._state(at)[1].get(meal, []))
+
+    def meal_period(self, at):
+        """Name the period at `at` by the meals being served, e.g. 'Dinner' or 'Closed'."""
+        return '/'.join(meal for meal in MEAL_PRIORITY if meal in self._state(at)[1]) or 'Closed'
+
+    def next_opening(self, hall, at):
+        """Return (meal, datetime) of the next period that starts after `at`, or None."""
+        time = hour_of(at)
+        for days_ahead in range(len(DAYS) + 1):
+            starts = self._starts[(weekday_of(at) + days_ahead) % 7].get(hall, [])
+            position = bisect_right(starts, (time, chr(0x10FFFF))) if days_ahead == 0 else 0
+            if position < len(starts):
+                start, meal = starts[position]
+                day = (at + timedelta(days=days_ahead)).replace(hour=0, minute=0, second=0, microsecond=0)
+                return meal, day + timedelta(hours=start)
+        return None
+
+
+_schedule = None
+_schedule_mtime = None
+_schedule_lock = threading.Lock()
+
+def get_schedule():
+    """Return the compiled schedule, recompiling it when the hours file changes."""
+    global _schedule, _schedule_mtime
+    mtime = os.stat(hours_path).st_mtime_ns
+    if _schedule is None or mtime != _schedule_mtime:
+        with _schedule_lock:
+            if _schedule is None or mtime != _schedule_mtime:
+                with open(hours_path, 'r') as file:
+                    _schedule = Schedule(json.load(file))
+                _schedule_mtime = mtime
+    return _schedule
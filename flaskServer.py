@@ -1,11 +1,30 @@
 # flaskServer.py
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, Response, stream_with_context, g
 from flask_cors import CORS
 import os
+import json
 import logging
 import handler
 import traceback
-from menu_scrape import fetch_dining_hall_info
+import time
+import metrics
+import profiling
+import http_cache
+import menu_snapshot
+import menu_store
+import menu_archive
+from menu_views import MenuQuery, InvalidMenuQuery
+from menu_masks import UnknownLabel
+from recommendations import preferences_hash
+from menu_scrape import fetch_dining_hall_info, fetch_menu_snapshot, menu_htmls_dir, current_date
+from menu_scrape import currently_serving_dict as get_status_dict
+from recommendations import recommendation_cache
+from hall_ranking import hall_ranking
+from jobs import job_queue
+from prefetch import prefetcher
+from meal_plans import meal_planner, MAX_PLAN_DAYS
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -15,6 +34,69 @@ app.secret_key = b'\xb8\x08^\x88\tRK\xbd \xc79e\xcd\x91\x07\xda\xc3\x95\xaa\xc1\
 CORS(app, supports_credentials=True)
 logged_in = False
 
+@app.before_request
+def start_request_metrics():
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_started = time.perf_counter()
+    metrics.HTTP_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+
+@app.before_request
+def start_profiling():
+    # ?profile=<secret> or an X-Profile: <secret> header profiles this request
+    g.profiler = profiling.profiler_for(request.headers.get('X-Profile') or request.args.get('profile'))
+
+@app.after_request
+def record_request_status(response):
+    g.metrics_status = response.status_code
+    if g.get('profiler'):
+        response.headers['X-Profile-Id'] = g.profiler.profile_id
+    return response
+
+@app.teardown_request
+def finish_profiling(error=None):
+    profiler = g.pop('profiler', None)
+    if profiler:
+        # Keep the secret out of the stored path
+        query = urlencode([(key, value) for key, value in request.args.items(multi=True) if key != 'profile'])
+        path = request.path + ('?' + query if query else '')
+        profiler.finish(request.url_rule.rule if request.url_rule else 'unmatched', request.method, path)
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    # Runs after a streamed response has been fully sent, and may run twice for one
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    metrics.HTTP_IN_FLIGHT.dec(endpoint=g.metrics_endpoint)
+    status = 500 if error else g.get('metrics_status', 500)
+    metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                         endpoint=g.metrics_endpoint, method=request.method, status=status)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Every worker's series, labelled by worker; this process's are current, the others' up to PUBLISH_SECONDS old
+    return Response(metrics.render_workers(), mimetype='text/plain; version=0.0.4')
+
+def profile_access_allowed():
+    return profiling.secret_matches(request.headers.get('X-Profile-Secret') or request.args.get('secret'))
+
+@app.route('/profiles/', methods=['GET'])
+def list_profiles():
+    if not profile_access_allowed():
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(profiling.profile_store.list()), 200
+
+@app.route('/profiles/<profile_id>/', methods=['GET'])
+def get_profile(profile_id):
+    """The profile's call-tree report, or the raw pstats file with ?format=pstats."""
+    profile = profiling.profile_store.get(profile_id) if profile_access_allowed() else None
+    if profile is None:
+        return jsonify({"error": "Not found"}), 404
+    if request.args.get('format') == 'pstats':
+        return Response(profile.pstats_bytes(), mimetype='application/octet-stream',
+                        headers={'Content-Disposition': f'attachment; filename={profile_id}.prof'})
+    return Response(profile.report(), mimetype='text/plain')
+
 @app.route('/login/', methods=['POST'])
 def login():
     try:
@@ -51,6 +133,25 @@ def signup():
         logger.error(f"Error in signup: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
     
+def wants_stream():
+    """Stream when asked with ?stream=1 or an Accept: text/event-stream header."""
+    return request.args.get('stream') in ('1', 'true') or 'text/event-stream' in request.headers.get('Accept', '')
+
+def sse(data, event=None):
+    return (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
+
+def stream_prompt_events(user, message):
+    """Server-Sent Events for a prompt: one 'data' event per token, then 'done' with the full reply."""
+    chunks = []
+    try:
+        for token in handler.Handler.stream_prompt(user, message):
+            chunks.append(token)
+            yield sse({"token": token})
+        yield sse({"user_id": user, "prompt": message, "response": ''.join(chunks).strip()}, event='done')
+    except Exception as e:
+        logger.error(f"Error streaming send_message: {str(e)}")
+        yield sse({"user_id": user, "prompt": message, "response": "Error processing message. Please try again later."}, event='error')
+
 #TODO: Please see how the message object is being generated and returned. look at handler.py handle_prompt function.
 @app.route('/send_message/', methods=['POST'])
 def send_message():
@@ -65,6 +166,10 @@ def send_message():
         if not message:
             return jsonify({"error": "No message provided"}), 400
 
+        if wants_stream():
+            return Response(stream_with_context(stream_prompt_events(user, message)), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
         response = handler.Handler.handle_prompt(user, message)
         
         return jsonify(response), 200
@@ -77,35 +182,150 @@ def send_message():
             "response": "Error processing message. Please try again later."
         }), 500
 
+def meal_plan_events(plan):
+    """Server-Sent Events for a meal plan: one 'day' event per finished date, then 'done' with the whole plan."""
+    yield sse({"plan_id": plan.plan_id, "dates": plan.dates}, event='started')
+    for date, day in plan.updates():
+        yield sse(dict(day, date=date), event='day')
+    yield sse(plan.to_dict(), event='done')
+
+@app.route('/meal_plan/', methods=['POST'])
+def create_meal_plan():
+    """
+    Start a meal plan from a JSON body: {"dates": [...], "dining_halls": [...], "prompt": "..."}.
+    Returns 202 with the plan to poll at /meal_plan/<plan_id>/, or streams it with ?stream=1.
+    """
+    try:
+        session['user'] = "rahul" # HARDCODED
+        user = session.get('user')
+        data = request.get_json(silent=True) or {}
+        dates = data.get('dates') or []
+        dining_halls = data.get('dining_halls') or None
+        prompt = data.get('prompt', '')
+        if not dates or len(dates) > MAX_PLAN_DAYS:
+            return jsonify({"error": f"Provide between 1 and {MAX_PLAN_DAYS} dates"}), 400
+        try:
+            dates = list(dict.fromkeys(datetime.strptime(date, '%Y-%m-%d').strftime('%Y-%m-%d') for date in dates))
+        except (TypeError, ValueError):
+            return jsonify({"error": "Dates must be formatted YYYY-MM-DD"}), 400
+        # Days not fetched yet are fetched by the plan's background tasks
+        for date in dates:
+            if not plannable(date):
+                return jsonify({"error": f"{date} is too far out; plans cover saved days and the next {MAX_PLAN_DAYS} days"}), 400
+
+        plan = meal_planner.start(user, dining_halls, dates, prompt)
+        if wants_stream():
+            return Response(stream_with_context(meal_plan_events(plan)), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        return jsonify(plan.to_dict()), 202, {'Location': f'/meal_plan/{plan.plan_id}/'}
+    except Exception as e:
+        logger.error(f"Error creating meal plan: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@app.route('/meal_plan/<plan_id>/', methods=['GET'])
+def get_meal_plan(plan_id):
+    plan = meal_planner.get(plan_id)
+    if plan is None:
+        return jsonify({"error": "Meal plan not found"}), 404
+    return jsonify(plan.to_dict()), 200
+
+def menu_date_known(date):
+    """Whether menus for `date` can be served without scraping them on the request thread.
+
+    That is the current and prefetched days, and days already stored or
+    archived; anything else gets a 404 rather than a live scrape.
+    """
+    return date is None or prefetcher.covers(date) or menu_store.has_day(date) \
+        or menu_archive.has_day(os.path.join(menu_htmls_dir, date))
+
+def plannable(date):
+    """Whether a meal plan can include `date`: a day with saved menus, or one of the next MAX_PLAN_DAYS days."""
+    today = current_date()
+    last = (datetime.strptime(today, '%Y-%m-%d') + timedelta(days=MAX_PLAN_DAYS - 1)).strftime('%Y-%m-%d')
+    return today <= date <= last or menu_date_known(date)
+
+def unknown_date(date):
+    return jsonify({"error": f"No menus for {date}"}), 404
+
+def full_menu_body(query=MenuQuery()):
+    """The full-menu response for `query`, serialized and compressed once per parsed day."""
+    if query.is_everything:
+        # Sent straight from the snapshot every worker maps, without decoding the menus
+        snapshot = fetch_menu_snapshot(query.date)
+        prepared = http_cache.published_body(snapshot, 'full_menu') if snapshot is not None else None
+        if prepared is not None:
+            return prepared
+    else:
+        # Other queries are written from the snapshot's item JSON, again without decoding the menus
+        index = handler.Handler.published_menu_index(query.date)
+        if index is not None:
+            return http_cache.shared_serialized_body(f'full_menu:{query.date}:{query.key}', index,
+                                                     lambda: handler.Handler.get_menu_json(query))
+    menus = fetch_dining_hall_info(query.date)
+    return http_cache.shared_body(f'full_menu:{query.date}:{query.key}', menus,
+                                  lambda: query.apply(handler.Handler.get_menu(menus)))
+
+def menu_tag(query):
+    """A validator for the menus `query` picks, from the snapshot's per-hall digests when it has them."""
+    index = handler.Handler.published_menu_index(query.date)
+    if index is None:
+        return full_menu_body(query).tag
+    return http_cache.digest([hall['digest'] for hall in index.halls if query.wants_hall(dict(hall['fields'])['dining_hall'])])
+
+menu_snapshot.register_body('full_menu', lambda menus: http_cache.PreparedBody(handler.Handler.get_menu(menus), shared=True).representations())
+
+prefetcher.register('full_menu', lambda date: full_menu_body(MenuQuery(date=date)))
+
 #TODO Make sure this is giving the right information. Take a look at handler.py get_user_info function.
 @app.route('/getmenu/', methods=['GET'])
 def get_menu():
+    try:
+        query = MenuQuery.from_args(request.args)
+    except InvalidMenuQuery as e:
+        return jsonify({"error": str(e)}), 400
+    if not menu_date_known(query.date):
+        return unknown_date(query.date)
     try:
         session['user'] = "rahul" # HARDCODED
         headers = request.headers
         user = session.get('user')
         if not user:
             logger.info("User not logged in. Sending default dining information")
-            return jsonify(handler.Handler.get_menu()), 200
+            return http_cache.respond(full_menu_body(query))
         
         location = headers.get('location')
-        print(location)
         coords = (float(location.split(",")[0]), float(location.split(",")[1]))
-        menu_data = handler.Handler.get_user_menu(user, coords)
-        
-        reccomendation = handler.Handler.get_ai_reccomendations(user)
-        if not menu_data:
+
+        # Served from cache (or a pending marker) so the menu never waits on the model
+        reccomendation = recommendation_cache.get(user)
+
+        # Everything the personalized body depends on, so a match can skip building it. The
+        # menu part covers only the halls asked for, so changes to other halls keep the tag
+        tag = http_cache.digest(menu_tag(query), query.key,
+                                preferences_hash(handler.Handler.fetch_user_preferences(user)),
+                                coords, get_status_dict(), reccomendation)
+        cached = http_cache.not_modified(tag, cache_control='private, no-cache')
+        if cached is not None:
+            return cached
+
+        dining_info = handler.Handler.get_user_menu_json(user, coords, query)
+        if dining_info is None:
+            menu_data = query.apply(handler.Handler.get_user_menu(user, coords, query.date))
+            dining_info = json.dumps(menu_data, separators=(',', ':')).encode()
+        if dining_info == b'[]':
             return jsonify({
                 "dining_info": [],
                 "payload": "No dining hall information available"
             }), 200
-            
-        return jsonify({
-            "recommendation": reccomendation,
-            "dining_info": menu_data,
-            "payload": "Success"
-        }), 200
-            
+
+        # The menus are spliced in as they are, so the items copied from the snapshot are not decoded
+        body = b'{"recommendation":' + json.dumps(reccomendation, separators=(',', ':')).encode() \
+            + b',"dining_info":' + dining_info + b',"payload":"Success"}'
+        return http_cache.respond(http_cache.PreparedBody.serialized(body), tag=tag, cache_control='private, no-cache')
+
+    except UnknownLabel as e:
+        # Saved before preferences were checked; the user has to fix them
+        return jsonify({"error": f"Invalid preferences: {e}"}), 400
     except Exception as e:
         logger.error(f"Error in get_menu: {str(e)}\n{traceback.format_exc()}")
         return jsonify({
@@ -113,6 +333,28 @@ def get_menu():
             "error": str(e)
         }), 200
 
+@app.route('/nearest_halls/', methods=['GET'])
+def nearest_halls():
+    """Rank the dining halls for a location, given as a location header or query parameter."""
+    location = request.args.get('location') or request.headers.get('location')
+    try:
+        coords = tuple(float(part) for part in location.split(","))
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+        if len(coords) != 2 or (limit is not None and limit <= 0):
+            raise ValueError(location)
+    except (AttributeError, ValueError):
+        return jsonify({"error": "Provide a location as lat,lon and a positive integer limit"}), 400
+    try:
+        session['user'] = "rahul" # HARDCODED
+        ranking = hall_ranking.rank(coords, session.get('user'), open_only=request.args.get('open') in ('1', 'true'),
+                                    limit=limit)
+        return jsonify({"dining_halls": ranking, "payload": "Success"}), 200
+    except UnknownLabel as e:
+        return jsonify({"error": f"Invalid preferences: {e}"}), 400
+    except Exception as e:
+        logger.error(f"Error ranking dining halls: {str(e)}\n{traceback.format_exc()}")
+        return jsonify({"error": "Internal server error"}), 500
+
 #TODO: Render About Me page using these preferences.
 @app.route('/fetch_preferences/', methods=['GET'])
 def fetch_user_preferences():
@@ -136,10 +378,15 @@ def save_user_preferences():
         user_id = 'rahul'
         data = request.json
         print(f"received prefs json: {data}")
+        try:
+            handler.Handler.compile_preference_masks(data)
+        except UnknownLabel as e:
+            return jsonify({"error": str(e)}), 400
         retVal = handler.Handler.save_user_preferences(user_id, data)
         
         if retVal is False:
             return jsonify({"message": "Database error. User not found"}), 404
+        recommendation_cache.refresh(user_id)
         return jsonify({"message": "Preferences saved successfully"}), 200
     except Exception as e:
         logger.error(f"Error saving preferences: {str(e)}")
@@ -151,23 +398,74 @@ def end_session():
     try:
         session['user'] = "rahul" # HARDCODED
         user = session.get('user')
-        handler.Handler.end_session(user)
+        # Summarizing the conversation is queued; this returns without waiting for the model
+        if not handler.Handler.end_session(user):
+            return jsonify({"error": "User not found"}), 404
         return jsonify({"message": "Session ended successfully"}), 200
     except Exception as e:
         logger.error(f"Error ending session: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+metrics.report('jobs', job_queue.stats)
+metrics.report('prefetch', prefetcher.stats)
+
+def by_worker(stats, report):
+    """This worker's stats, with every worker's own under "by_worker"."""
+    stats["worker"] = os.getpid()
+    stats["by_worker"] = {worker: found["reports"].get(report) for worker, found in metrics.worker_snapshots().items()}
+    return stats
+
+@app.route('/jobs/stats/', methods=['GET'])
+def job_stats():
+    try:
+        return jsonify(by_worker(job_queue.stats(), 'jobs')), 200
+    except Exception as e:
+        logger.error(f"Error getting job stats: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@app.route('/prefetch/stats/', methods=['GET'])
+def prefetch_stats():
+    try:
+        return jsonify(by_worker(prefetcher.stats(), 'prefetch')), 200
+    except Exception as e:
+        logger.error(f"Error getting prefetch stats: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
 
 # returns formatted json of ALL menu options
 @app.route('/get_full_menu/', methods=['GET'])
 def get_full_menu():
     try:
-        formatted_menu = handler.Handler.get_menu()
-        print(f"{formatted_menu}")
-        return jsonify(formatted_menu), 200
+        query = MenuQuery.from_args(request.args)
+    except InvalidMenuQuery as e:
+        return jsonify({"error": str(e)}), 400
+    if not menu_date_known(query.date):
+        return unknown_date(query.date)
+    try:
+        return http_cache.respond(full_menu_body(query))
     except Exception as e:
         logger.error(f"Error getting full menu: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+def start_background():
+    """Start the job queue, the menu prefetcher and metrics publishing in the serving process.
+
+    Whatever serves the app calls this, so importing it (tests, benchmarks,
+    the reloader's watching process) starts no threads. RUN_JOBS=0 and
+    PREFETCH=0 turn either off.
+    """
+    # Pick up jobs queued before the last shutdown; under gunicorn every worker takes jobs
+    if os.environ.get('RUN_JOBS', '1') == '1':
+        job_queue.start()
+    # Fetch and warm today and the next days in the background, and roll over at midnight
+    if os.environ.get('PREFETCH', '1') == '1':
+        prefetcher.start()
+    # Let whichever worker answers /metrics and the stats routes report this one too
+    metrics.start_publishing()
+
 if __name__ == '__main__':
+    # The reloader runs this module in a parent that only watches files and a child that
+    # serves; only the child, which has WERKZEUG_RUN_MAIN set, starts the background threads
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background()
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,29 @@
+import math
+
+EARTH_RADIUS_METERS = 6371e3
+METERS_PER_MILE = 1609.34
+
+DINING_HALL_COORDS = {
+    'Bursley': (42.296152151463275, -83.71031104510504),
+    'East Quad': (42.27308724683324, -83.73523173347121),
+    'Markley': (42.28105576454475, -83.72888983161529),
+    'Mosher-Jordan': (42.28014917899281, -83.73153330135683),
+    'North Quad': (42.280668689896245, -83.74012628743262),
+    'South Quad': (42.273867238346284, -83.74207111626943)
+}
+
+# The halls never move, so their half of the haversine terms is computed once
+_HALLS = [(hall, math.radians(lat), math.radians(lon), math.cos(math.radians(lat)))
+          for hall, (lat, lon) in DINING_HALL_COORDS.items()]
+
+
+def hall_distances(location):
+    """Return {hall: miles} from `location` to every dining hall, rounded to 0.1 mile."""
+    lat, lon = math.radians(location[0]), math.radians(location[1])
+    cos_lat = math.cos(lat)
+    distances = {}
+    for hall, hall_lat, hall_lon, hall_cos_lat in _HALLS:
+        a = math.sin((hall_lat - lat) / 2) ** 2 + cos_lat * hall_cos_lat * math.sin((hall_lon - lon) / 2) ** 2
+        distances[hall] = round(EARTH_RADIUS_METERS * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a)) / METERS_PER_MILE, 1)
+    return distances
+
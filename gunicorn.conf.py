@@ -0,0 +1,37 @@
+"""Serve the app with gunicorn:
+
+    gunicorn -c gunicorn.conf.py flaskServer:app
+
+The app is imported once in the arbiter (preload_app) and the workers are
+forked from it, so they share its code pages. Menus are parsed by one
+worker and published as a snapshot that every worker maps (see
+menu_snapshot.py). The menu routes and hall ranking read the snapshot,
+and chat, recommendations and meal plans the menus database, so only a
+worker that parses or ingests a day decodes its menus;
+benchmarks/bench_workers.py measures what each worker adds.
+BIND, WORKERS and THREADS override the defaults below. gunicorn runs on
+POSIX systems only; python flaskServer.py runs anywhere.
+
+Each worker runs the job queue, whose leases keep a job from running
+twice, and the menu prefetcher; the workers take turns downloading, so
+the later ones get 304s. Meal plans are kept in var/meal_plans.db and
+profiles under var/profiles, so any worker can answer for them. Each
+worker publishes its metrics and job and prefetch stats to var/metrics,
+and /metrics, /jobs/stats/ and /prefetch/stats/ report every worker's,
+labelled by pid.
+"""
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WORKERS', os.cpu_count() or 2))
+# Chat and meal plan streams hold a thread for as long as the model writes
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 8))
+timeout = 120
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Threads do not survive the fork, so each worker starts its own
+    from flaskServer import start_background
+    start_background()
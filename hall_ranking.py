@@ -0,0 +1,108 @@
+import threading
+import logging
+from collections import OrderedDict
+
+import dining_hours
+import geo
+import metrics
+from handler import Handler
+from menu_masks import day_mask_index
+from menu_scrape import fetch_dining_hall_info, get_current_time_est as now, MENU_CACHE_MAX_DATES
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# Preference masks whose match counts are kept per parsed day
+MATCH_COUNTS_MAX = 256
+
+
+class HallRanking:
+    """Dining halls ordered by open status, preference matches and distance.
+
+    Distances are measured from the exact location on every call; with a
+    handful of halls that is cheap, and they agree with /getmenu/. Counts of the items matching a user's preferences are
+    cached per parsed day and preference masks.
+    """
+
+    def __init__(self):
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def places(self, location, statuses):
+        """Return [{dining_hall, distance, meal, hours}] for every hall, measured from `location`."""
+        places = []
+        for hall, distance in geo.hall_distances(location).items():
+            status = statuses.get(hall)
+            places.append({
+                "dining_hall": hall,
+                "distance": distance,
+                "meal": status[0] if status else None,
+                "hours": list(status[1]) if status else None,
+            })
+        return places
+
+    def match_counts(self, date, preferences):
+        """Return {(hall, meal): (matching items, items)} for a day's menus.
+
+        Read from the day's snapshot when it has a mask index, so this
+        process does not decode the menus; otherwise from the parsed menus.
+        """
+        index = Handler.published_menu_index(date)
+        source = index if index is not None else fetch_dining_hall_info(date)
+        masks = Handler.compile_preference_masks(preferences) if preferences else (0, 0)
+        key = (id(source), masks)
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None and entry[0] is source:
+                self._counts.move_to_end(key)
+        metrics.cache_lookup('hall_matches', entry is not None and entry[0] is source)
+        if entry is not None and entry[0] is source:
+            return entry[1]
+
+        if index is not None:
+            layout = ((dict(hall['fields'])['dining_hall'], meal, sum(count for _, count in stations))
+                      for hall in index.halls for meal, stations in hall['meals'])
+        else:
+            index = day_mask_index(source, Handler.allergen_vocabulary, Handler.trait_vocabulary)
+            layout = ((dining_hall['dining_hall'], meal, sum(len(items) for items in stations.values()))
+                      for dining_hall in source for meal, stations in dining_hall['menus'].items())
+        # Both walk the items in the order of the mask index
+        keep = iter(index.matches(*masks))
+        counts = {}
+        for hall, meal, total in layout:
+            counts[(hall, meal)] = (sum(next(keep) for _ in range(total)), total)
+        with self._lock:
+            # Keep a reference to the source so its id cannot be reused while cached
+            self._counts[key] = (source, counts)
+            while len(self._counts) > MATCH_COUNTS_MAX * MENU_CACHE_MAX_DATES:
+                self._counts.popitem(last=False)
+        return counts
+
+    def rank(self, location, user_id=None, at=None, open_only=False, limit=None):
+        """Return the halls nearest `location`, best first.
+
+        Open halls with items the user can eat come first, then open halls
+        without any, then closed halls; each group is ordered by distance.
+        """
+        if limit is not None and limit <= 0:
+            raise ValueError(f"limit must be positive, got {limit}")
+        date = at.strftime('%Y-%m-%d') if at else None
+        at = at or now()
+        statuses = dining_hours.get_schedule().statuses(at)
+        places = self.places(location, statuses)
+        preferences = Handler.fetch_user_preferences(user_id) if user_id else None
+        counts = self.match_counts(date, preferences)
+
+        ranking = []
+        for place in places:
+            if open_only and place["meal"] is None:
+                continue
+            matching, total = counts.get((place["dining_hall"], place["meal"]), (0, 0))
+            ranking.append(dict(place, status=f'Currently serving {place["meal"].lower()}' if place["meal"] else 'Currently closed',
+                                matching_items=matching, total_items=total))
+        ranking.sort(key=lambda hall: (hall["meal"] is None, hall["matching_items"] == 0, hall["distance"]))
+        return ranking[:limit] if limit is not None else ranking
+
+
+hall_ranking = HallRanking()
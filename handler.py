@@ -1,25 +1,33 @@
 from menu_scrape import fetch_dining_hall_info as get_info
 from menu_scrape import currently_serving as get_status
 from menu_scrape import currently_serving_dict as get_status_dict
-from menu_scrape import get_current_time_est as now
+from menu_scrape import get_current_time_est as now, current_date
+from menu_scrape import fetch_menu_snapshot
+import menu_db
+import llm
+import dining_hours
+import geo
+from menu_context import build_menu_context
+import db
+import metrics
+from jobs import job_queue
+from prefetch import prefetcher
+from menu_masks import MaskVocabulary, UnknownLabel, day_mask_index, publish_mask_index, published_mask_index
 import sqlite3
 import json
 import os
 import logging
 import typing_extensions as typing
 import hashlib
-import math
 from datetime import datetime
 
-import google.generativeai as genai
-
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger.setLevel(logging.DEBUG)
 
-if not GEMINI_API_KEY:
+if not GEMINI_API_KEY and llm.LLM_BACKEND == 'gemini':
 	logger.error("GEMINI_API_KEY not found in environment variables!!")
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
@@ -31,13 +39,53 @@ output_dir = os.path.join(this_dir, 'output')
 if not os.path.exists(var_dir):
 	os.makedirs(var_dir)
 
-if not os.path.exists(users_db):
-	conn = sqlite3.connect(users_db)
-	c = conn.cursor()
-	c.execute('''CREATE TABLE users
-								(user_id text, password text, preferences json, conversation text)''')
-	conn.commit()
-	conn.close()
+# Bumped whenever migrate_users_db() learns a new schema step
+USERS_SCHEMA_VERSION = 1
+
+def migrate_users_db():
+	"""Create var/users.db or upgrade it to the current schema."""
+	with db.transaction(users_db) as c:
+		c.execute("PRAGMA user_version")
+		if c.fetchone()[0] >= USERS_SCHEMA_VERSION:
+			return
+
+		# Version 0 kept every conversation as one JSON blob in an unindexed users table
+		c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'")
+		legacy = c.fetchone() is not None
+		if legacy:
+			c.execute("ALTER TABLE users RENAME TO users_legacy")
+
+		c.execute('''CREATE TABLE users
+									(user_id text PRIMARY KEY, password text, preferences json, session integer NOT NULL DEFAULT 0)''')
+		c.execute('''CREATE TABLE messages
+									(user_id text NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+									session integer NOT NULL, seq integer NOT NULL, role text NOT NULL, parts text NOT NULL,
+									PRIMARY KEY (user_id, session, seq)) WITHOUT ROWID''')
+
+		if legacy:
+			logger.info("Migrating conversations in users.db to the messages table")
+			c.execute("SELECT user_id, password, preferences, conversation FROM users_legacy ORDER BY rowid")
+			for user_id, password, preferences, conversation in c.fetchall():
+				c.execute("INSERT OR IGNORE INTO users (user_id, password, preferences) VALUES (?, ?, ?)", (user_id, password, preferences))
+				if not c.rowcount:
+					logger.warning(f"Dropping duplicate row for user {user_id}")
+					continue
+				messages = json.loads(conversation) if conversation else []
+				c.executemany("INSERT INTO messages (user_id, session, seq, role, parts) VALUES (?, 0, ?, ?, ?)",
+					[(user_id, seq, message["role"], message["parts"]) for seq, message in enumerate(messages)])
+			c.execute("DROP TABLE users_legacy")
+
+		c.execute(f"PRAGMA user_version = {USERS_SCHEMA_VERSION}")
+
+migrate_users_db()
+
+def _dumps(value):
+	return json.dumps(value, separators=(',', ':')).encode()
+
+def _json_object(pairs):
+	"""A JSON object from (key, already serialized value) pairs."""
+	return b'{' + b','.join(_dumps(key) + b':' + value for key, value in pairs) + b'}'
+
 
 class Handler:
 		
@@ -76,6 +124,13 @@ class Handler:
 		"custom_preferences": "Insert custom preferences here"
 	}
 
+	# One bit per allergen/trait above, used to filter menus with a single AND per item
+	allergen_vocabulary = MaskVocabulary(default_preferences["allergens"])
+	trait_vocabulary = MaskVocabulary(default_preferences["traits"])
+
+	# Number of recent messages sent back to the model with each prompt
+	conversation_window = 20
+
 	### HELPER METHODS ##
 	def encrypt_password(password):
 		"""Encrypt the password using SHA-256."""
@@ -83,18 +138,17 @@ class Handler:
 		return sha_signature
 
 	# returns a dict
+	@metrics.timed("db")
 	def fetch_database_information(user_id):
 		"""Fetch the a user's information from the database."""
 		logger.debug(f"Fetching user {user_id} from the database")
-		conn = sqlite3.connect(users_db)
-		c = conn.cursor()
-		c.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-		user = c.fetchone()
-		conn.close()
+		with db.cursor(users_db) as c:
+			c.execute("SELECT user_id, password, preferences FROM users WHERE user_id=?", (user_id,))
+			user = c.fetchone()
 		if user:
 			logger.info(f"User {user_id} found in database")
 			preferences = json.loads(user[2])
-			conversation = json.loads(user[3])
+			conversation = Handler.load_conversation(user_id)
 			password = user[1]
 			user_dict = {
 				"user_id": user_id,
@@ -108,14 +162,13 @@ class Handler:
 			return None
 
 	
+	@metrics.timed("db")
 	def check_user_exists(user_id):
 		"""Check if a user exists in the database."""
 		logger.debug(f"Checking if user {user_id} exists in the database")
-		conn = sqlite3.connect(users_db)
-		c = conn.cursor()
-		c.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-		user = c.fetchone()
-		conn.close()
+		with db.cursor(users_db) as c:
+			c.execute("SELECT 1 FROM users WHERE user_id=?", (user_id,))
+			user = c.fetchone()
 		if user:
 			logger.info(f"User {user_id} found in database")
 			return True
@@ -123,58 +176,49 @@ class Handler:
 			logger.info(f"User {user_id} not found in database")
 			return False
 	
+	@metrics.timed("db")
 	def register_new_user(uniqname, password):
 		"""Register a new user in the database."""
 		logger.debug(f"register_new_user called with payload: {uniqname}")
 
 		print(f"received username: {uniqname} and password: {password}")
 
-		conn = sqlite3.connect(users_db)
-		c = conn.cursor()
-
-		c.execute("SELECT * FROM users WHERE user_id=?", (uniqname,))
-		existing_user = c.fetchone()
-
-
-		if existing_user:
-			logger.error(f'Tried to register user that already exists.')
-			return False
-
 		preferences_json = json.dumps(Handler.default_preferences)
-		convo = json.dumps([])
 		encrypted_password = Handler.encrypt_password(password)
 
-		c.execute("INSERT INTO users (user_id, password, preferences, conversation) VALUES (?, ?, ?, ?)", (uniqname, encrypted_password, preferences_json, convo))
-		conn.commit()
-		conn.close()
+		with db.transaction(users_db) as c:
+			c.execute("SELECT 1 FROM users WHERE user_id=?", (uniqname,))
+			existing_user = c.fetchone()
+
+			if existing_user:
+				logger.error(f'Tried to register user that already exists.')
+				return False
+
+			c.execute("INSERT INTO users (user_id, password, preferences) VALUES (?, ?, ?)", (uniqname, encrypted_password, preferences_json))
 		logger.info(f"New user {uniqname} registerered succesfully!")
 		return True
 	
+	@metrics.timed("db")
 	def patch_database_information(user_id, key, value):
 		"""Update a user's information in the database."""
 		logger.debug(f"Updating user {user_id} with key {key} and value {value}")
 		if not Handler.check_user_exists(user_id):
 			Handler.register_new_user(user_id)
-		conn = sqlite3.connect(users_db)
-		c = conn.cursor()
 		try:
-			c.execute(f"UPDATE users SET {key} = ? WHERE user_id = ?", (value, user_id))
-			conn.commit()
-			conn.close()
+			with db.transaction(users_db) as c:
+				c.execute(f"UPDATE users SET {key} = ? WHERE user_id = ?", (value, user_id))
 			return True
 		except sqlite3.Error as e:
 			logger.error(f"Error updating database: {e}")
-			conn.close()
 			return False
 
+	@metrics.timed("db")
 	def fetch_user_preferences(user_id):
 		"""Fetch the user's preferences from the database."""
 		logger.debug(f"Fetching preferences for user {user_id}")
-		conn = sqlite3.connect(users_db)
-		c = conn.cursor()
-		c.execute("SELECT preferences FROM users WHERE user_id = ?", (user_id,))
-		result = c.fetchone()
-		conn.close()
+		with db.cursor(users_db) as c:
+			c.execute("SELECT preferences FROM users WHERE user_id = ?", (user_id,))
+			result = c.fetchone()
 
 		if result:
 			logger.info(f"User {user_id} found with existing preferences.")
@@ -222,51 +266,72 @@ class Handler:
 
 		return formatted_preferences
 
-	def clear_db(db):
+	@metrics.timed("db")
+	def clear_db(db_name):
 		"""Clear the database."""
-		logger.debug(f"Clearing database {db}")
-		if db == 'users':
+		logger.debug(f"Clearing database {db_name}")
+		if db_name == 'users':
 			try:
-				
-				conn = sqlite3.connect(users_db)
-				c = conn.cursor()
-				c.execute(f"DELETE FROM users")
-				conn.commit()
-				conn.close()
+				with db.transaction(users_db) as c:
+					c.execute(f"DELETE FROM users")
 				return True
 			except sqlite3.Error as e:
 				logger.error(f"Error clearing database: {e}")
 
-		elif db == 'conversations':
+		elif db_name == 'conversations':
 			try:
-				conn = sqlite3.connect(users_db)
-				c = conn.cursor()
-				c.execute(f"DELETE FROM conversations")
-				conn.commit()
-				conn.close()
+				with db.transaction(users_db) as c:
+					c.execute(f"DELETE FROM messages")
 				return True
 			except sqlite3.Error as e:
 				logger.error(f"Error clearing database: {e}")
 
+	@metrics.timed("db")
 	def save_user_preferences(user_id, prefs_json):
 		"""Save the user's preferences to the database."""
 		logger.debug(f'Saving preferences for user {user_id}')
-		conn = sqlite3.connect(users_db)
-		c = conn.cursor()
-		c.execute('SELECT preferences FROM users WHERE user_id = ?', (user_id,))
-		
-		fetched_pref = c.fetchone()
-		if not fetched_pref:
+		with db.transaction(users_db) as c:
+			c.execute("UPDATE users SET preferences = ? WHERE user_id = ?", (json.dumps(prefs_json), user_id))
+			updated = c.rowcount
+
+		if not updated:
 			logger.error(f'User {user_id} does not exist!')
-			conn.close()
 			return False
-
-		c.execute("UPDATE users SET preferences = ? WHERE user_id = ?", (json.dumps(prefs_json), user_id))
-		conn.commit()
-		conn.close()
 		return True
 	
-	def get_ai_reccomendations(user_id, date=now().strftime('%Y-%m-%d')): #TODO Provide based on the current mealtime
+	@metrics.timed("db")
+	def load_conversation(user_id, last=None, session=None):
+		"""
+		Return the messages of the user's current session (or of `session`), oldest first.
+		With `last`, only the last `last` messages are read.
+		"""
+		with db.cursor(users_db) as c:
+			if last is None:
+				c.execute("""SELECT role, parts FROM messages WHERE user_id = ?
+					AND session = COALESCE(?, (SELECT session FROM users WHERE user_id = ?)) ORDER BY seq""", (user_id, session, user_id))
+				rows = c.fetchall()
+			else:
+				c.execute("""SELECT role, parts FROM (
+						SELECT seq, role, parts FROM messages WHERE user_id = ?
+						AND session = COALESCE(?, (SELECT session FROM users WHERE user_id = ?)) ORDER BY seq DESC LIMIT ?)
+					ORDER BY seq""", (user_id, session, user_id, last))
+				rows = c.fetchall()
+		return [{"role": role, "parts": parts} for role, parts in rows]
+
+	@metrics.timed("db")
+	def append_messages(user_id, messages):
+		"""Append messages to the user's current session."""
+		with db.transaction(users_db) as c:
+			c.execute("""SELECT u.session, COALESCE(MAX(m.seq) + 1, 0) FROM users u
+				LEFT JOIN messages m ON m.user_id = u.user_id AND m.session = u.session
+				WHERE u.user_id = ?""", (user_id,))
+			session, seq = c.fetchone()
+			c.executemany("INSERT INTO messages (user_id, session, seq, role, parts) VALUES (?, ?, ?, ?, ?)",
+				[(user_id, session, seq + offset, message["role"], message["parts"]) for offset, message in enumerate(messages)])
+
+	def get_ai_reccomendations(user_id, date=None): #TODO Provide based on the current mealtime
+
+		date = date or current_date()
 
 		dining_halls = [
 			'Bursley',
@@ -284,18 +349,12 @@ class Handler:
 
 		prefs = Handler.fetch_user_preferences(user_id)
 		
-		model = genai.GenerativeModel(model_name="gemini-1.5-flash")
-		menu_data = Handler.get_menu()
-		menu_data = [hall for hall in menu_data if hall["dining_hall"] in dining_halls]
+		# Only today's statuses say anything about what is being served
+		statuses = dining_hours.get_schedule().statuses(now()) if date == current_date() else None
+		menu_data = build_menu_context(Handler.query_menu(user_id, date, halls=dining_halls),
+			prefs.get("custom_preferences", ""), statuses=statuses)
 		gemini_prompt = f'Based on these user preferences and the current serving information: {prefs}\n {get_status()} Generate meal recommendations using the following available meals: {menu_data}. Provide selections of items and their locations and give some reason as well. Just 1 paragraph.'
-		result = model.generate_content(
-			gemini_prompt,
-			generation_config=genai.GenerationConfig(
-				response_mime_type="application/json", response_schema=Recommendations,
-			),
-		)
-
-		return json.loads(result.text)
+		return llm.get_client().generate_json(gemini_prompt, Recommendations)
 	
 
 	### MAIN METHODS ###
@@ -334,65 +393,60 @@ class Handler:
 				logger.info(f"User {uniqname} successfully logged in.")
 				return True
 
-	def get_menu():
-		"""Return the default current menu for the dining halls."""
-		menus = get_info()
-		for menu in menus:
-			menu["distance"] = None
-		return menus
+	def get_menu(menus=None):
+		"""Return the default current menu for the dining halls, or format the given parsed `menus` the same way."""
+		menus = menus if menus is not None else get_info()
+		return [dict(menu, distance=None) for menu in menus]
 	
-	def get_user_menu(user_id, location, date=now().strftime('%Y-%m-%d')):
+	def compile_preference_masks(preferences, required_traits=()):
+		"""
+		Return (excluded allergen mask, required trait mask) for a user's preferences.
+		Traits set to "required" are added to `required_traits`. Raises UnknownLabel if one of them,
+		or an excluded allergen, is not in the vocabulary.
+		"""
+		allergens = [key for key, value in preferences.get("allergens", {}).items() if value is True]
+		traits = list(required_traits) + [key for key, value in preferences.get("traits", {}).items() if value == "required"]
+		return Handler.allergen_vocabulary.encode(allergens), Handler.trait_vocabulary.encode(traits)
+
+	def query_menu(user_id=None, date=None, halls=None, meals=None, stations=None, traits=()):
+		"""
+		Return menus filtered in SQL by hall, meal and station.
+		Items with the user's allergens, or without all of `traits`, are excluded.
+		"""
+		date = date or current_date()
+		allergens = []
+		if user_id is not None:
+			preferences = Handler.fetch_user_preferences(user_id)
+			if preferences:
+				allergens = [key for key, value in preferences["allergens"].items() if value is True]
+		return menu_db.query_menu(date, halls=halls, meals=meals, stations=stations,
+			exclude_allergens=allergens, require_traits=traits)
+
+	def get_user_menu(user_id, location, date=None, required_traits=()):
 		
+		date = date or current_date()
+
 		# Statuses
 		statuses = get_status_dict()
 
-		# Dining Hall coordinates
-
-		dining_hall_coords = {
-			'Bursley': (42.296152151463275, -83.71031104510504),
-			'East Quad': (42.27308724683324, -83.73523173347121),
-			'Markley': (42.28105576454475, -83.72888983161529),
-			'Mosher-Jordan': (42.28014917899281, -83.73153330135683),
-			'North Quad': (42.280668689896245, -83.74012628743262),
-			'South Quad': (42.273867238346284, -83.74207111626943)
-		}
-
-		# Get the distance between two points
-		def get_distance(point1, point2):
-			lat1, lon1 = point1
-			lat2, lon2 = point2
-			R = 6371e3  # Earth's radius in meters
-			phi1 = math.radians(lat1)
-			phi2 = math.radians(lat2)
-			delta_phi = math.radians(lat2 - lat1)
-			delta_lambda = math.radians(lon2 - lon1)
-			a = math.sin(delta_phi / 2) * math.sin(delta_phi / 2) + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2) * math.sin(delta_lambda / 2)
-			c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-			distance_meters = R * c
-			distance_miles = distance_meters / 1609.34  # Convert meters to miles
-			return round(distance_miles, 1)
-
-		# Get the nearest dining distances
-
-		dining_hall_distances = {hall: get_distance(coords, location) for hall, coords in dining_hall_coords.items() if location}
+		dining_hall_distances = geo.hall_distances(location) if location else {}
 
 		preferences = Handler.fetch_user_preferences(user_id)
-		allergens = []
 		if preferences is None:
 			return get_info(date)
 		else:	
-			allergens = [key for key, value in preferences["allergens"].items() if value is True]
+			excluded_allergens, required_trait_mask = Handler.compile_preference_masks(preferences, required_traits)
 			menu_data = get_info(date)
+			mask_index = day_mask_index(menu_data, Handler.allergen_vocabulary, Handler.trait_vocabulary)
+			keep = iter(mask_index.matches(excluded_allergens, required_trait_mask))
 			new_menu_data = []
-			for dining_hall in menu_data:
-				for meal_time, meals in dining_hall["menus"].items():
+			for cached_hall in menu_data:
+				# The cached menus are shared, so build a new hall dict instead of mutating it
+				dining_hall = dict(cached_hall, menus={})
+				for meal_time, meals in cached_hall["menus"].items():
 					new_meals = []
 					for station, items in meals.items():
-						new_items = []
-						for item in items:
-							item_allergens = item["allergens"] # list of allergens
-							if not any(allergen in item_allergens for allergen in allergens):
-								new_items.append(item)
+						new_items = [item for item in items if next(keep)]
 						new_meals.append({"station_name": station, "items": new_items})
 					dining_hall["menus"][meal_time] = new_meals
 					if location:
@@ -407,121 +461,206 @@ class Handler:
 
 		return new_menu_data
 
+	def published_menu_index(date=None):
+		"""Return the PublishedDayIndex of a date's menu snapshot, or None if there is no usable one."""
+		snapshot = fetch_menu_snapshot(date or current_date())
+		if snapshot is None:
+			return None
+		return published_mask_index(snapshot, Handler.allergen_vocabulary, Handler.trait_vocabulary)
 
-	def handle_prompt(user_id, message):
-		"""Handle the user's prompt."""
-		logger.debug(f"Handling prompt for user {user_id}")
-		conn = sqlite3.connect(users_db)
-		c = conn.cursor()
-		c.execute("SELECT conversation FROM users WHERE user_id = ?", (user_id,))
-		result = c.fetchone()
+	def get_user_menu_json(user_id, location, query):
+		"""
+		Return the JSON of query.apply(get_user_menu(...)), written from the menu snapshot.
+		Item JSON is copied out of the snapshot instead of decoded, so this process holds no copy of the menus.
+		Returns None if there is no usable snapshot or the user is unknown; use get_user_menu then.
+		"""
+		preferences = Handler.fetch_user_preferences(user_id)
+		index = Handler.published_menu_index(query.date)
+		if preferences is None or index is None:
+			return None
 
-		conversation_history = json.loads(result[0])
-		current_messages = conversation_history
-		
-		prompt = ""
-
-		if len(current_messages) == 0:
-			dining_hall_info = Handler.get_user_menu(user_id, None)
-			status = get_status()
-			logger.info(f"Starting new conversation for user {user_id}")
-			context = f"Here are the meals currently being served at the dining halls:\n{dining_hall_info}\n Here is information on if the dining halls are currently open and what meals they are serving:\n{status}"
-			prompt = context + "Student prompt: " + message
-			current_messages.append({"role": "user", "parts": prompt})
-		else:
-			prompt = message
-			current_messages.append({"role": "user", "parts": message})
+		excluded_allergens, required_trait_mask = Handler.compile_preference_masks(preferences)
+		keep = index.matches(excluded_allergens, required_trait_mask)
+		statuses = get_status_dict()
+		dining_hall_distances = geo.hall_distances(location) if location else {}
+
+		dining_halls = []
+		position = 0
+		for hall in index.halls:
+			fields = dict(hall["fields"])
+			name = fields["dining_hall"]
+			wanted = query.wants_hall(name)
+			meals = []
+			for meal_time, stations in hall["meals"]:
+				wanted_meal = wanted and query.wants_meal(meal_time)
+				new_stations = []
+				for station, count in stations:
+					if wanted_meal and query.wants_station(station):
+						items = [index.item_json(item) for item in range(position, position + count) if keep[item]]
+						if query.projects:
+							items = [_dumps(query.project_item(json.loads(bytes(item)))) for item in items]
+						new_stations.append(_json_object([("station_name", _dumps(station)), ("items", b'[' + b','.join(items) + b']')]))
+					position += count
+				if wanted_meal:
+					meals.append((meal_time, b'[' + b','.join(new_stations) + b']'))
+			if not wanted:
+				continue
+			fields["distance"] = dining_hall_distances[name] if location else None
+			fields["status"] = statuses[name]
+			body = _json_object((key, _json_object(meals) if key == "menus" else _dumps(value)) for key, value in fields.items())
+			dining_halls.append((fields["distance"], body))
 
-		genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+		if location:
+			dining_halls.sort(key=lambda x: x[0])
 
-		model = genai.GenerativeModel(
-				model_name="gemini-1.5-flash",
-				system_instruction="Using information about today's menus for the University of Michigan dining halls, answer the student's prompts. Give precise answers, using only 50 words or less. Do not make up information.",
-		)
+		return b'[' + b','.join(body for _, body in dining_halls) + b']'
 
-		chat = model.start_chat(
-				history = current_messages
-		)
+	def get_menu_json(query):
+		"""
+		Return the JSON of query.apply(get_menu(...)) for query.date, written from the menu snapshot like get_user_menu_json.
+		Returns None if there is no usable snapshot; use get_menu then.
+		"""
+		index = Handler.published_menu_index(query.date)
+		if index is None:
+			return None
+		dining_halls = []
+		position = 0
+		for hall in index.halls:
+			fields = dict(hall["fields"])
+			wanted = query.wants_hall(fields["dining_hall"])
+			meals = []
+			for meal_time, stations in hall["meals"]:
+				wanted_meal = wanted and query.wants_meal(meal_time)
+				new_stations = []
+				for station, count in stations:
+					if wanted_meal and query.wants_station(station):
+						items = [index.item_json(item) for item in range(position, position + count)]
+						if query.projects:
+							items = [_dumps(query.project_item(json.loads(bytes(item)))) for item in items]
+						new_stations.append((station, b'[' + b','.join(items) + b']'))
+					position += count
+				if wanted_meal:
+					meals.append((meal_time, _json_object(new_stations)))
+			if wanted:
+				fields["distance"] = None
+				dining_halls.append(_json_object((key, _json_object(meals) if key == "menus" else _dumps(value)) for key, value in fields.items()))
+		return b'[' + b','.join(dining_halls) + b']'
+
+
+	chat_system_instruction = "Using information about today's menus for the University of Michigan dining halls, answer the student's prompts. Give precise answers, using only 50 words or less. Do not make up information."
+
+	def prepare_prompt(user_id, message):
+		"""
+		Return the (history, prompt) pair to send to the model for the user's message.
+		Every prompt carries menu context picked for that message; the history only holds what was said.
+		"""
+		current_messages = Handler.load_conversation(user_id, last=Handler.conversation_window)
+
+		# Filtered in SQL like recommendations and meal plans, so this worker does not decode the menus
+		preferences = Handler.fetch_user_preferences(user_id) or {}
+		required_traits = [key for key, value in preferences.get("traits", {}).items() if value == "required"]
+		dining_hall_info = build_menu_context(Handler.query_menu(user_id, traits=required_traits), message,
+			statuses=dining_hours.get_schedule().statuses(now()))
+		status = get_status()
+		context = f"Here are the menu items most relevant to the student's prompt:\n{dining_hall_info}\n Here is information on if the dining halls are currently open and what meals they are serving:\n{status}"
+		prompt = context + "Student prompt: " + message
+
+		return current_messages, prompt
+
+	def handle_prompt(user_id, message):
+		"""Handle the user's prompt."""
+		logger.debug(f"Handling prompt for user {user_id}")
+		history, prompt = Handler.prepare_prompt(user_id, message)
 
-		response = chat.send_message(
-				prompt,
-				generation_config=genai.types.GenerationConfig(
-						candidate_count=1,
-						max_output_tokens=200,
-						temperature=1.0,
-				),)
+		response_text = llm.get_client().chat(Handler.chat_system_instruction, history, prompt)
 		
-		# Update the conversation history
-		current_messages.append({"role": "model", "parts": response.text})
-		c.execute("UPDATE users SET conversation = ? WHERE user_id = ?", (json.dumps(current_messages), user_id))
-		conn.commit()
-		conn.close()
+		# Update the conversation history, in a transaction opened only after the model call.
+		# The menu context is left out; the next turn gets its own
+		Handler.append_messages(user_id, [{"role": "user", "parts": message}, {"role": "model", "parts": response_text}])
 
 		payload = {
 				"user_id": user_id,
 				"prompt": message,
-				"response": (response.text).strip(),
+				"response": response_text.strip(),
 		}
 
 		return payload
+
+	def stream_prompt(user_id, message):
+		"""
+		Handle the user's prompt, yielding the response text as the model produces it.
+		The exchange is saved once the stream completes; an abandoned stream is not saved.
+		"""
+		logger.debug(f"Streaming prompt for user {user_id}")
+		history, prompt = Handler.prepare_prompt(user_id, message)
+
+		chunks = []
+		for chunk in llm.get_client().stream_chat(Handler.chat_system_instruction, history, prompt):
+			chunks.append(chunk)
+			yield chunk
+
+		Handler.append_messages(user_id, [{"role": "user", "parts": message}, {"role": "model", "parts": ''.join(chunks)}])
 	
-	def generate_meal_plan(user_id, dining_halls, dates, prompt): 
-		"""Generate a meal plan for a user based on dining halls, their preferences, and chosen dates."""
-		logger.debug(f"Generating meal plan for user {user_id}")
+	def plan_day(user_id, dining_halls, date, prompt):
+		"""
+		Generate one day of a user's meal plan from the chosen dining halls' menus.
+		Multi-day plans run one of these per date; see meal_plans.py.
+		"""
+		logger.debug(f"Generating meal plan for user {user_id} on {date}")
 		class Meal(typing.TypedDict):
 			dining_hall: str
 			meal_time: str
 			meal_station: str
 			meal_item_name: str
 		
-		meal_plan = {}
-		
-		model = genai.GenerativeModel(model_name="gemini-1.5-flash")
-		for date in dates:
-			menu_data = Handler.get_menu(user_id, date)
-			menu_data = [hall for hall in menu_data if hall["dining_hall"] in dining_halls]
-			gemini_prompt = f'Generate a meal plan for {date} using the following available meals: {menu_data} based on the following prompt: {prompt}. Keep in mind this will just be the meals that should be eaten in 1 day.'
-			result = model.generate_content(
-				gemini_prompt,
-				generation_config=genai.GenerationConfig(
-					response_mime_type="application/json", response_schema=list[Meal],
-				),
-			)
-			meal_plan[date] = json.loads(result.text)
-
-		return meal_plan
+		menu_data = build_menu_context(Handler.query_menu(user_id, date, halls=dining_halls), prompt)
+		gemini_prompt = f'Generate a meal plan for {date} using the following available meals: {menu_data} based on the following prompt: {prompt}. Keep in mind this will just be the meals that should be eaten in 1 day.'
+		return llm.get_client().generate_json(gemini_prompt, list[Meal])
 	
 	def end_session(user_id):
-		"""End the session for a user."""
+		"""
+		End the session for a user.
+		The conversation is summarized into the user's custom preferences by a background job.
+		"""
 		logger.debug(f"Ending session for user {user_id}")
-		conn = sqlite3.connect(users_db)
-		c = conn.cursor()
-		c.execute("SELECT conversation FROM users WHERE user_id = ?", (user_id,))
-		conversation = c.fetchone()
-		c.execute("UPDATE users SET conversation = ? WHERE user_id = ?", (json.dumps([]), user_id))
-		conn.commit()
-		conn.close()
+		# Later messages go to a new session; the old one stays in the messages table
+		with db.transaction(users_db) as c:
+			c.execute("SELECT session FROM users WHERE user_id = ?", (user_id,))
+			row = c.fetchone()
+			if row is None:
+				logger.error(f'User {user_id} does not exist!')
+				return False
+			c.execute("UPDATE users SET session = session + 1 WHERE user_id = ?", (user_id,))
 
-		prompt = f"Past conversation history: {conversation}\n Current custom preferences are: {Handler.fetch_user_preferences(user_id)['custom_preferences']}"
+		job_queue.enqueue("summarize_sessions", user_id, {"sessions": [row[0]]})
+		return True
 
-		genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+	def summarize_sessions(user_id, payload):
+		"""Update the user's custom preferences from the conversations of ended sessions."""
+		conversation = [message for session in payload["sessions"] for message in Handler.load_conversation(user_id, session=session)]
+		if not conversation:
+			logger.debug(f"No messages to summarize for user {user_id}")
+			return
 
-		model = genai.GenerativeModel(
-				model_name="gemini-1.5-flash",
-				system_instruction="Given a conversation history, update the user's custom preferences to reflect any preferences in meals they may have reflected in the conversation. For example, 'The user seems to like stir fry'. Keep this summary under 100 words.",
-		)
+		prompt = f"Past conversation history: {conversation}\n Current custom preferences are: {Handler.fetch_user_preferences(user_id)['custom_preferences']}"
 
-		result = model.generate_content(
+		summary = llm.get_client().generate(
 			prompt,
-			generation_config=genai.types.GenerationConfig(
-						candidate_count=1,
-						max_output_tokens=200,
-						temperature=1.0,
-				),
+			system_instruction="Given a conversation history, update the user's custom preferences to reflect any preferences in meals they may have reflected in the conversation. For example, 'The user seems to like stir fry'. Keep this summary under 100 words.",
 		)
 
+		# Read the preferences again after the model call so concurrent changes are kept
 		preferences = Handler.fetch_user_preferences(user_id)
-		preferences["custom_preferences"] = result.text
+		preferences["custom_preferences"] = summary
 		Handler.save_user_preferences(user_id, preferences)
 
-		return True
\ No newline at end of file
+
+# Sessions a user ended before the previous summary ran are summarized together
+job_queue.register("summarize_sessions", Handler.summarize_sessions,
+	merge=lambda old, new: {"sessions": old["sessions"] + [s for s in new["sessions"] if s not in old["sessions"]]})
+
+# Days fetched ahead of time are ingested and indexed before anyone asks for them
+prefetcher.register("menu_db", menu_db.ensure_day)
+# Workers read the masks and item JSON from the snapshot rather than each decoding the menus
+publish_mask_index(Handler.allergen_vocabulary, Handler.trait_vocabulary)
+prefetcher.register("mask_index", Handler.published_menu_index)
@@ -0,0 +1,193 @@
+import gzip
+import json
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+from flask import request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# Bodies smaller than this are sent uncompressed
+COMPRESS_MIN_BYTES = 1024
+# Per-request bodies favour speed; shared bodies are compressed once, so favour size
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+SHARED_GZIP_LEVEL = 9
+SHARED_BROTLI_QUALITY = 11
+# Enough for a few days times the common filter combinations
+SHARED_BODIES_MAX = 32
+
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+
+def digest(*parts):
+    """Hex digest of `parts`, each serialized as sorted-key JSON."""
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(json.dumps(part, sort_keys=True, default=str).encode())
+        hasher.update(b'\0')
+    return hasher.hexdigest()[:32]
+
+def choose_encoding(accept_encoding):
+    """Pick the best encoding we support from an Accept-Encoding header, or None."""
+    offered = {}
+    for entry in (accept_encoding or '').split(','):
+        name, _, parameters = entry.strip().partition(';')
+        quality = 1.0
+        if parameters.strip().startswith('q='):
+            try:
+                quality = float(parameters.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            offered[name.strip().lower()] = quality
+    best = None
+    for encoding in ENCODINGS:
+        quality = offered.get(encoding, offered.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+def compress(body, encoding, shared=False):
+    if encoding == 'br':
+        return brotli.compress(body, quality=SHARED_BROTLI_QUALITY if shared else BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=SHARED_GZIP_LEVEL if shared else GZIP_LEVEL, mtime=0)
+
+def etag_for(tag, encoding):
+    # Each encoding is a different representation, so it gets its own strong validator
+    return f'"{tag}-{encoding}"' if encoding else f'"{tag}"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    return etag in (candidate.strip().removeprefix('W/') for candidate in if_none_match.split(','))
+
+
+class PreparedBody:
+    """A serialized JSON body with its digest and lazily computed compressed forms."""
+
+    def __init__(self, payload, shared=False):
+        self.body = json.dumps(payload, separators=(',', ':')).encode()
+        self.tag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.shared = shared
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def serialized(cls, body, shared=False):
+        """A body that is already JSON, e.g. assembled from pieces serialized elsewhere."""
+        prepared = cls.__new__(cls)
+        prepared.body = body
+        prepared.tag = hashlib.sha256(body).hexdigest()[:32]
+        prepared.shared = shared
+        prepared._encoded = {}
+        prepared._lock = threading.Lock()
+        return prepared
+
+    @classmethod
+    def published(cls, tag, encoded):
+        """A body serialized and compressed elsewhere, e.g. mapped from a menu snapshot."""
+        prepared = cls.__new__(cls)
+        prepared.body = encoded[None]
+        prepared.tag = tag
+        prepared.shared = True
+        prepared._encoded = {encoding: data for encoding, data in encoded.items() if encoding}
+        prepared._lock = threading.Lock()
+        return prepared
+
+    def encoded(self, encoding):
+        if encoding is None or len(self.body) < COMPRESS_MIN_BYTES:
+            return self.body, None
+        with self._lock:
+            if encoding not in self._encoded:
+                self._encoded[encoding] = compress(self.body, encoding, self.shared)
+                logger.debug(f"Compressed {len(self.body)} bytes to {len(self._encoded[encoding])} with {encoding}")
+            return self._encoded[encoding], encoding
+
+    def representations(self):
+        """Return (tag, {encoding or None: bytes}) with every encoding we can send."""
+        return self.tag, {None: self.body, **{encoding: self.encoded(encoding)[0] for encoding in ENCODINGS}}
+
+
+_shared_bodies = OrderedDict()
+_shared_bodies_lock = threading.Lock()
+
+def _remember(name, source, make):
+    with _shared_bodies_lock:
+        entry = _shared_bodies.get(name)
+        if entry is not None and entry[0] is source:
+            _shared_bodies.move_to_end(name)
+            return entry[1]
+    prepared = make()
+    with _shared_bodies_lock:
+        # Keep a reference to the source so the identity check stays meaningful
+        _shared_bodies[name] = (source, prepared)
+        _shared_bodies.move_to_end(name)
+        while len(_shared_bodies) > SHARED_BODIES_MAX:
+            _shared_bodies.popitem(last=False)
+    return prepared
+
+def shared_body(name, source, build):
+    """Return the PreparedBody of `build()`, built once per `source` object.
+
+    `source` is a shared, read-only value the body is derived from, such as
+    the menus list returned by fetch_dining_hall_info; a new list (after a
+    re-parse) gets a new body.
+    """
+    return _remember(name, source, lambda: PreparedBody(build(), shared=True))
+
+def shared_serialized_body(name, source, build):
+    """Like shared_body, for a `build()` that returns the JSON bytes itself."""
+    return _remember(name, source, lambda: PreparedBody.serialized(build(), shared=True))
+
+def published_body(snapshot, name):
+    """Return the body `name` published in a menu snapshot, or None if it has none."""
+    representations = snapshot.representations(name)
+    if representations is None:
+        return None
+    return _remember(f'published:{snapshot.date}:{name}', snapshot, lambda: PreparedBody.published(*representations))
+
+
+def not_modified(tag, cache_control='no-cache'):
+    """Return a 304 response if the request already holds the representation `tag`, else None."""
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    for candidate in (etag_for(tag, encoding), etag_for(tag, None)):
+        if etag_matches(request.headers.get('If-None-Match'), candidate):
+            response = Response(status=304)
+            response.headers['ETag'] = candidate
+            response.headers['Cache-Control'] = cache_control
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+    return None
+
+def respond(prepared, tag=None, cache_control='no-cache', status=200):
+    """Send a PreparedBody compressed as the client prefers, or 304 if its ETag matches.
+
+    `tag` overrides the validator, e.g. when it is derived from the inputs of
+    a personalized body rather than from the body itself.
+    """
+    tag = tag or prepared.tag
+    cached = not_modified(tag, cache_control)
+    if cached is not None:
+        return cached
+    body, encoding = prepared.encoded(choose_encoding(request.headers.get('Accept-Encoding')))
+    # Published bodies are views of a shared mapping; the response gets its own copy
+    response = Response(bytes(body) if isinstance(body, memoryview) else body, status=status, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = etag_for(tag, encoding)
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import uuid
+import random
+import socket
+import threading
+import logging
+from collections import deque
+
+import db
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+var_dir = os.path.join(this_dir, 'var')
+jobs_db = os.path.join(var_dir, 'jobs.db')
+
+JOB_WORKERS = 4
+MAX_ATTEMPTS = 5
+# Retry n waits BACKOFF_SECONDS * 2**(n - 1), up to MAX_BACKOFF_SECONDS, plus jitter
+BACKOFF_SECONDS = 5
+MAX_BACKOFF_SECONDS = 300
+# Idle workers look for due retries this often even without new jobs
+POLL_SECONDS = 1.0
+# A running job whose lease was not renewed for this long is taken to have crashed and runs again
+LEASE_SECONDS = 60
+# Running jobs have their leases renewed this often
+HEARTBEAT_SECONDS = LEASE_SECONDS / 4
+# Finished jobs are kept this long for inspection
+DONE_RETENTION_SECONDS = 24 * 60 * 60
+# Number of recent jobs the latency statistics are computed over
+LATENCY_SAMPLES = 1000
+
+
+def _percentile(samples, q):
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class JobQueue:
+    """Durable job queue in SQLite, worked by a pool of threads.
+
+    A job is identified by (kind, key). Enqueuing a job while one with the
+    same kind and key is still waiting merges the two payloads instead of
+    adding a second job. Failed jobs are retried with exponential backoff
+    and kept as 'failed' after MAX_ATTEMPTS.
+
+    Any process can enqueue jobs; only the ones that call start() run them.
+    A running job holds a lease that its queue renews every
+    HEARTBEAT_SECONDS, so a job left 'running' by a crashed process is run
+    again once its lease expires, and never while its owner is alive.
+    """
+
+    def __init__(self, path=jobs_db, workers=JOB_WORKERS):
+        self.path = path
+        self.workers = workers
+        self.handlers = {}
+        # Identifies the leases of this queue, even among several in one process
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._threads = []
+        self._heartbeat = None
+        self._stopped = threading.Event()
+        self._wakeup = threading.Condition()
+        self._stopping = False
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._run_times = deque(maxlen=LATENCY_SAMPLES)
+        self._counts = {"done": 0, "retried": 0, "failed": 0, "coalesced": 0}
+        self._lock = threading.Lock()
+        self._migrate()
+
+    def _migrate(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with db.transaction(self.path) as c:
+            c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                        (id integer PRIMARY KEY, kind text NOT NULL, key text NOT NULL, payload json NOT NULL,
+                        status text NOT NULL DEFAULT 'queued', attempts integer NOT NULL DEFAULT 0,
+                        created_at real NOT NULL, available_at real NOT NULL,
+                        started_at real, finished_at real, last_error text)''')
+            c.execute("PRAGMA table_info(jobs)")
+            columns = {row[1] for row in c.fetchall()}
+            if 'owner' not in columns:
+                c.execute("ALTER TABLE jobs ADD COLUMN owner text")
+            if 'lease_until' not in columns:
+                c.execute("ALTER TABLE jobs ADD COLUMN lease_until real")
+            c.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, available_at)")
+            c.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (kind, key, status)")
+
+    def register(self, kind, handler, merge=None):
+        """Run `handler(key, payload)` for jobs of `kind`.
+
+        `merge(old_payload, new_payload)` combines the payloads of coalesced
+        jobs; by default the newer payload replaces the older one.
+        """
+        self.handlers[kind] = (handler, merge or (lambda old, new: new))
+
+    def enqueue(self, kind, key, payload=None):
+        """Queue a job and return its id, coalescing it with a waiting job for the same key."""
+        payload = payload if payload is not None else {}
+        _, merge = self.handlers[kind]
+        current = time.time()
+        with db.transaction(self.path) as c:
+            c.execute("SELECT id, payload FROM jobs WHERE kind = ? AND key = ? AND status = 'queued'", (kind, key))
+            row = c.fetchone()
+            if row:
+                job_id = row[0]
+                c.execute("UPDATE jobs SET payload = ? WHERE id = ?",
+                          (json.dumps(merge(json.loads(row[1]), payload)), job_id))
+            else:
+                c.execute("INSERT INTO jobs (kind, key, payload, created_at, available_at) VALUES (?, ?, ?, ?, ?)",
+                          (kind, key, json.dumps(payload), current, current))
+                job_id = c.lastrowid
+        if row:
+            with self._lock:
+                self._counts["coalesced"] += 1
+            logger.debug(f"Coalesced {kind} job for {key} into job {job_id}")
+        else:
+            logger.debug(f"Queued {kind} job {job_id} for {key}")
+        # Workers of this queue, if it has any, pick it up now; others within POLL_SECONDS
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def start(self):
+        """Start the worker threads and the lease heartbeat, once."""
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            self._stopped.clear()
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'jobs-{number}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._heartbeat = threading.Thread(target=self._renew_leases, name='jobs-heartbeat', daemon=True)
+            self._heartbeat.start()
+
+    def stop(self, timeout=None):
+        """Stop the workers after their current jobs."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+            heartbeat, self._heartbeat = self._heartbeat, None
+            self._stopping = True
+        self._stopped.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in threads:
+            thread.join(timeout)
+        if heartbeat is not None:
+            heartbeat.join(timeout)
+
+    def _claim(self):
+        current = time.time()
+        with db.transaction(self.path) as c:
+            c.execute("""SELECT id, kind, key, payload, attempts, created_at, status FROM jobs
+                        WHERE (status = 'queued' AND available_at <= ?) OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?))
+                        ORDER BY available_at, id LIMIT 1""", (current, current))
+            row = c.fetchone()
+            if row:
+                c.execute("""UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1,
+                            owner = ?, lease_until = ? WHERE id = ?""",
+                          (current, self.owner, current + LEASE_SECONDS, row[0]))
+        if row and row[6] == 'running':
+            logger.info(f"{row[1]} job {row[0]} for {row[2]} lost its worker; running it again")
+        return row[:6] if row else None
+
+    def _renew_leases(self):
+        while not self._stopping:
+            with db.transaction(self.path) as c:
+                c.execute("UPDATE jobs SET lease_until = ? WHERE status = 'running' AND owner = ?",
+                          (time.time() + LEASE_SECONDS, self.owner))
+            self._stopped.wait(HEARTBEAT_SECONDS)
+
+    def _work(self):
+        while not self._stopping:
+            job = self._claim()
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(POLL_SECONDS)
+                continue
+            self._run(*job)
+
+    def _run(self, job_id, kind, key, payload, attempts, created_at):
+        started = time.time()
+        handler, _ = self.handlers[kind]
+        try:
+            handler(key, json.loads(payload))
+        except Exception as e:
+            attempts += 1
+            finished = time.time()
+            if attempts >= MAX_ATTEMPTS:
+                logger.error(f"{kind} job {job_id} for {key} failed after {attempts} attempts: {e}")
+                status, available_at, counter = 'failed', finished, "failed"
+            else:
+                delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempts - 1)) * random.uniform(1, 1.25)
+                logger.warning(f"{kind} job {job_id} for {key} failed, retrying in {delay:.0f}s: {e}")
+                status, available_at, counter = 'queued', finished + delay, "retried"
+            with db.transaction(self.path) as c:
+                c.execute("UPDATE jobs SET status = ?, available_at = ?, last_error = ? WHERE id = ? AND owner = ?",
+                          (status, available_at, str(e), job_id, self.owner))
+            with self._lock:
+                self._counts[counter] += 1
+            return
+
+        finished = time.time()
+        with db.transaction(self.path) as c:
+            c.execute("UPDATE jobs SET status = 'done', finished_at = ?, last_error = NULL WHERE id = ? AND owner = ?",
+                      (finished, job_id, self.owner))
+            c.execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < ?", (finished - DONE_RETENTION_SECONDS,))
+        with self._lock:
+            self._counts["done"] += 1
+            self._latencies.append(finished - created_at)
+            self._run_times.append(finished - started)
+        logger.debug(f"{kind} job {job_id} for {key} done in {finished - started:.2f}s")
+
+    def stats(self):
+        """Queue depth by status and job latency over recent jobs, in seconds."""
+        current = time.time()
+        with db.cursor(self.path) as c:
+            c.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+            by_status = dict(c.fetchall())
+            c.execute("SELECT MIN(created_at) FROM jobs WHERE status = 'queued'")
+            oldest = c.fetchone()[0]
+        with self._lock:
+            latencies = sorted(self._latencies)
+            run_times = sorted(self._run_times)
+            counts = dict(self._counts)
+
+        def summary(samples):
+            if not samples:
+                return None
+            return {"p50": round(_percentile(samples, 0.50), 3), "p95": round(_percentile(samples, 0.95), 3),
+                    "max": round(samples[-1], 3)}
+
+        return {
+            "depth": by_status.get('queued', 0),
+            "running": by_status.get('running', 0),
+            "failed": by_status.get('failed', 0),
+            "oldest_queued_seconds": round(current - oldest, 3) if oldest else 0,
+            "latency_seconds": summary(latencies),
+            "run_seconds": summary(run_times),
+            "workers": len(self._threads),
+            "counts": counts,
+        }
+
+
+job_queue = JobQueue()
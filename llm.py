@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import typing
+import logging
+
+import metrics
+from menu_context import CHARS_PER_TOKEN, estimate_tokens
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# 'gemini' talks to the Gemini API; 'fake' answers locally without network calls
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'gemini')
+MODEL_NAME = "gemini-1.5-flash"
+# Latency of the fake backend, in seconds
+FAKE_FIRST_TOKEN_DELAY = float(os.environ.get('LLM_FAKE_FIRST_TOKEN_DELAY', 0))
+FAKE_TOKEN_DELAY = float(os.environ.get('LLM_FAKE_TOKEN_DELAY', 0))
+
+
+class GeminiClient:
+    """Chat completions from the Gemini API."""
+
+    def _model(self, system_instruction=None):
+        import google.generativeai as genai
+
+        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+        return genai, genai.GenerativeModel(model_name=MODEL_NAME, system_instruction=system_instruction)
+
+    def _chat(self, system_instruction, history):
+        genai, model = self._model(system_instruction)
+        return genai, model.start_chat(history=history)
+
+    def _generation_config(self, genai, max_output_tokens, temperature):
+        return genai.types.GenerationConfig(
+            candidate_count=1,
+            max_output_tokens=max_output_tokens,
+            temperature=temperature,
+        )
+
+    def chat(self, system_instruction, history, prompt, max_output_tokens=200, temperature=1.0):
+        """Send `prompt` after `history` and return the reply text."""
+        genai, chat = self._chat(system_instruction, history)
+        response = chat.send_message(
+            prompt, generation_config=self._generation_config(genai, max_output_tokens, temperature))
+        return response.text
+
+    def stream_chat(self, system_instruction, history, prompt, max_output_tokens=200, temperature=1.0):
+        """Like chat(), but yield the reply in pieces as the model produces them."""
+        genai, chat = self._chat(system_instruction, history)
+        response = chat.send_message(
+            prompt, stream=True, generation_config=self._generation_config(genai, max_output_tokens, temperature))
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+    def generate(self, prompt, system_instruction=None, max_output_tokens=200, temperature=1.0):
+        """Return the model's reply to a single prompt."""
+        genai, model = self._model(system_instruction)
+        result = model.generate_content(
+            prompt, generation_config=self._generation_config(genai, max_output_tokens, temperature))
+        return result.text
+
+    def generate_json(self, prompt, response_schema, system_instruction=None):
+        """Return the model's reply parsed from JSON matching `response_schema` (a TypedDict or list of one)."""
+        genai, model = self._model(system_instruction)
+        result = model.generate_content(
+            prompt,
+            generation_config=genai.GenerationConfig(response_mime_type="application/json", response_schema=response_schema),
+        )
+        return json.loads(result.text)
+
+
+class FakeClient:
+    """Deterministic local stand-in for the model.
+
+    Replies with `reply` split into words, waiting `first_token_delay` seconds
+    before the first word and `token_delay` seconds before each later one.
+    """
+
+    def __init__(self, reply="This is a test response from the fake model.", first_token_delay=FAKE_FIRST_TOKEN_DELAY,
+                 token_delay=FAKE_TOKEN_DELAY):
+        self.reply = reply
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+
+    def _tokens(self):
+        words = self.reply.split(' ')
+        return [word if position == 0 else ' ' + word for position, word in enumerate(words)]
+
+    def chat(self, system_instruction, history, prompt, max_output_tokens=200, temperature=1.0):
+        return ''.join(self.stream_chat(system_instruction, history, prompt, max_output_tokens, temperature))
+
+    def stream_chat(self, system_instruction, history, prompt, max_output_tokens=200, temperature=1.0):
+        for position, token in enumerate(self._tokens()):
+            time.sleep(self.first_token_delay if position == 0 else self.token_delay)
+            yield token
+
+    def generate(self, prompt, system_instruction=None, max_output_tokens=200, temperature=1.0):
+        return self.chat(system_instruction, [], prompt)
+
+    def generate_json(self, prompt, response_schema, system_instruction=None):
+        """Fill `response_schema` with the reply text, taking as long as streaming the reply would."""
+        return self._fill(response_schema, self.generate(prompt, system_instruction))
+
+    def _fill(self, schema, text):
+        if typing.get_origin(schema) is list:
+            return [self._fill(typing.get_args(schema)[0], text)]
+        if isinstance(schema, type) and hasattr(schema, '__annotations__'):
+            return {field: self._fill(value, text) for field, value in typing.get_type_hints(schema).items()}
+        return text
+
+
+class MeteredClient:
+    """Wraps a client to record call latency, prompt size and estimated tokens in metrics."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def _record_prompt(self, operation, system_instruction, history, prompt):
+        chars = len(system_instruction or '') + len(str(prompt)) + sum(len(str(message["parts"])) for message in history)
+        metrics.LLM_PROMPT_CHARS.observe(chars, operation=operation)
+        metrics.LLM_TOKENS.inc(chars // CHARS_PER_TOKEN + 1, operation=operation, direction='prompt')
+
+    def _record_reply(self, operation, text):
+        metrics.LLM_TOKENS.inc(estimate_tokens(text), operation=operation, direction='reply')
+
+    def chat(self, system_instruction, history, prompt, **options):
+        self._record_prompt('chat', system_instruction, history, prompt)
+        with metrics.timer('llm', 'chat'):
+            reply = self.client.chat(system_instruction, history, prompt, **options)
+        self._record_reply('chat', reply)
+        return reply
+
+    def stream_chat(self, system_instruction, history, prompt, **options):
+        self._record_prompt('stream_chat', system_instruction, history, prompt)
+        chunks = []
+        started = time.perf_counter()
+        with metrics.timer('llm', 'stream_chat'):
+            for chunk in self.client.stream_chat(system_instruction, history, prompt, **options):
+                if not chunks:
+                    metrics.LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started, operation='stream_chat')
+                chunks.append(chunk)
+                yield chunk
+        self._record_reply('stream_chat', ''.join(chunks))
+
+    def generate(self, prompt, system_instruction=None, **options):
+        self._record_prompt('generate', system_instruction, [], prompt)
+        with metrics.timer('llm', 'generate'):
+            reply = self.client.generate(prompt, system_instruction, **options)
+        self._record_reply('generate', reply)
+        return reply
+
+    def generate_json(self, prompt, response_schema, system_instruction=None):
+        self._record_prompt('generate_json', system_instruction, [], prompt)
+        with metrics.timer('llm', 'generate_json'):
+            reply = self.client.generate_json(prompt, response_schema, system_instruction)
+        self._record_reply('generate_json', json.dumps(reply))
+        return reply
+
+
+_client = None
+
+def get_client():
+    """Return the client selected by LLM_BACKEND, or the one installed with set_client()."""
+    global _client
+    if _client is None:
+        _client = MeteredClient(FakeClient() if LLM_BACKEND == 'fake' else GeminiClient())
+        logger.info(f"Using {type(_client.client).__name__} for model calls")
+    return _client
+
+def set_client(client):
+    """Replace the model client, e.g. with a FakeClient in tests and benchmarks."""
+    global _client
+    _client = MeteredClient(client)
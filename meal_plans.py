@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import uuid
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+from handler import Handler, var_dir
+from menu_scrape import fetch_dining_hall_info, fetch_menu_snapshot
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# Model calls for all meal plans together; later days wait for a free slot
+MEAL_PLAN_CONCURRENCY = 7
+MAX_PLAN_DAYS = 14
+# Seconds a finished plan can still be polled
+PLAN_TTL = 60 * 60
+
+plans_db = os.path.join(var_dir, 'meal_plans.db')
+
+
+def has_menus(date):
+    """Whether `date` has menus, downloading them if needed; a published day is checked without decoding it."""
+    return fetch_menu_snapshot(date) is not None or bool(fetch_dining_hall_info(date))
+
+
+class MealPlan:
+    """A multi-day meal plan whose days are generated concurrently."""
+
+    def __init__(self, user_id, dining_halls, dates, prompt, plan_id=None, created_at=None):
+        self.plan_id = plan_id or uuid.uuid4().hex
+        self.user_id = user_id
+        self.dining_halls = dining_halls
+        self.dates = list(dates)
+        self.prompt = prompt
+        self.created_at = created_at or time.time()
+        self.finished_at = None
+        self.days = {date: {"status": "pending"} for date in self.dates}
+        # Dates in the order they finished, for streaming
+        self.finished = []
+        self.changed = threading.Condition()
+
+    @property
+    def complete(self):
+        return len(self.finished) == len(self.dates)
+
+    def finish_day(self, date, result, finished_at=None):
+        with self.changed:
+            self.days[date] = result
+            self.finished.append(date)
+            if self.complete:
+                self.finished_at = finished_at or time.time()
+            self.changed.notify_all()
+
+    def to_dict(self):
+        with self.changed:
+            return {
+                "plan_id": self.plan_id,
+                "user_id": self.user_id,
+                "status": "complete" if self.complete else "pending",
+                "dates": self.dates,
+                "days": {date: dict(day) for date, day in self.days.items()},
+                "seconds": round((self.finished_at or time.time()) - self.created_at, 3),
+            }
+
+    def updates(self, timeout=None):
+        """Yield (date, day result) as days finish, until the plan is complete."""
+        sent = 0
+        while True:
+            with self.changed:
+                if sent == len(self.finished) and not self.complete:
+                    self.changed.wait(timeout)
+                ready = [(date, dict(self.days[date])) for date in self.finished[sent:]]
+                done = self.complete
+            for update in ready:
+                yield update
+            sent += len(ready)
+            if done and sent == len(self.dates):
+                return
+
+
+class MealPlanner:
+    """Runs meal plans on a shared, bounded thread pool and keeps them for polling.
+
+    Each day's menus are fetched by the day's own task, so a plan can cover
+    days nobody has downloaded yet without the request waiting for them.
+    Plans and finished days are written to SQLite, so any process serving
+    the app can answer a poll; streaming reads the plan in memory.
+    """
+
+    def __init__(self, plan_day, fetch_day=has_menus, path=plans_db,
+                 max_workers=MEAL_PLAN_CONCURRENCY, ttl=PLAN_TTL):
+        self.plan_day = plan_day
+        self.fetch_day = fetch_day
+        self.path = path
+        self.ttl = ttl
+        self._plans = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='meal-plans')
+        self._migrate()
+
+    def _migrate(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with db.transaction(self.path) as c:
+            c.execute('''CREATE TABLE IF NOT EXISTS meal_plans
+                        (plan_id text PRIMARY KEY, user_id text NOT NULL, dates json NOT NULL,
+                        created_at real NOT NULL, finished_at real)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS meal_plan_days
+                        (plan_id text NOT NULL REFERENCES meal_plans(plan_id) ON DELETE CASCADE,
+                        date text NOT NULL, result json NOT NULL, finished_at real NOT NULL,
+                        PRIMARY KEY (plan_id, date)) WITHOUT ROWID''')
+
+    def start(self, user_id, dining_halls, dates, prompt):
+        """Start generating a plan and return it right away; days fill in as they finish."""
+        plan = MealPlan(user_id, dining_halls, dates, prompt)
+        current = time.time()
+        with db.transaction(self.path) as c:
+            c.execute("DELETE FROM meal_plans WHERE finished_at < ?", (current - self.ttl,))
+            c.execute("INSERT INTO meal_plans (plan_id, user_id, dates, created_at) VALUES (?, ?, ?, ?)",
+                      (plan.plan_id, user_id, json.dumps(plan.dates), plan.created_at))
+        with self._lock:
+            for plan_id in [p for p, old in self._plans.items() if old.finished_at and old.finished_at + self.ttl < current]:
+                del self._plans[plan_id]
+            self._plans[plan.plan_id] = plan
+        logger.info(f"Starting meal plan {plan.plan_id} for {user_id}: {len(plan.dates)} days")
+        for date in plan.dates:
+            self._executor.submit(self._run_day, plan, date)
+        return plan
+
+    def get(self, plan_id):
+        """Return a plan started by any process, or None."""
+        with self._lock:
+            plan = self._plans.get(plan_id)
+        if plan is not None:
+            return plan
+        with db.cursor(self.path) as c:
+            c.execute("SELECT user_id, dates, created_at FROM meal_plans WHERE plan_id = ?", (plan_id,))
+            row = c.fetchone()
+            if row is None:
+                return None
+            c.execute("SELECT date, result, finished_at FROM meal_plan_days WHERE plan_id = ? ORDER BY finished_at", (plan_id,))
+            days = c.fetchall()
+        plan = MealPlan(row[0], None, json.loads(row[1]), None, plan_id=plan_id, created_at=row[2])
+        for date, result, finished_at in days:
+            plan.finish_day(date, json.loads(result), finished_at)
+        return plan
+
+    def generate(self, user_id, dining_halls, dates, prompt):
+        """Generate a plan and wait for it; returns {date: meals or None if that day failed}."""
+        plan = self.start(user_id, dining_halls, dates, prompt)
+        for _ in plan.updates():
+            pass
+        return {date: day.get("meals") for date, day in plan.to_dict()["days"].items()}
+
+    def _run_day(self, plan, date):
+        started = time.perf_counter()
+        try:
+            if not self.fetch_day(date):
+                result = {"status": "failed", "error": f"No menus for {date}."}
+            else:
+                result = {"status": "ready", "meals": self.plan_day(plan.user_id, plan.dining_halls, date, plan.prompt)}
+        except Exception as e:
+            logger.error(f"Error planning {date} of meal plan {plan.plan_id}: {e}")
+            result = {"status": "failed", "error": "Could not generate this day's plan."}
+        result["seconds"] = round(time.perf_counter() - started, 3)
+        finished_at = time.time()
+        try:
+            with db.transaction(self.path) as c:
+                c.execute("INSERT OR REPLACE INTO meal_plan_days (plan_id, date, result, finished_at) VALUES (?, ?, ?, ?)",
+                          (plan.plan_id, date, json.dumps(result), finished_at))
+                c.execute('''UPDATE meal_plans SET finished_at = ? WHERE plan_id = ?
+                            AND (SELECT COUNT(*) FROM meal_plan_days WHERE plan_id = ?) = json_array_length(dates)''',
+                          (finished_at, plan.plan_id, plan.plan_id))
+        except Exception as e:
+            logger.error(f"Could not save {date} of meal plan {plan.plan_id}: {e}")
+        plan.finish_day(date, result, finished_at)
+
+
+meal_planner = MealPlanner(Handler.plan_day)
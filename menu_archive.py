@@ -0,0 +1,375 @@
+"""Compressed storage and retention of the downloaded menu pages.
+
+Each day's pages live in data/menu_htmls/<date>/ as <hall>.html. Once a day
+is RAW_HTML_DAYS old and the menu store holds the menus parsed from exactly
+those pages, they are gzipped in place; once its whole ISO week is
+WEEKLY_ARCHIVE_DAYS old, the week's days are moved into one archive,
+data/menu_htmls/archive/<year>-W<week>.tar.gz (.tar.zst with zstandard
+installed), and past HTML_RETENTION_DAYS the pages are deleted, leaving
+only the parsed menus. read_pages() reads a day in any of these forms.
+
+    RAW_HTML_DAYS=3 python menu_archive.py --dry-run
+"""
+import os
+import io
+import re
+import json
+import gzip
+import shutil
+import tarfile
+import hashlib
+import argparse
+import threading
+import logging
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, timedelta
+
+import menu_store
+import menu_snapshot
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# Past days whose pages are kept uncompressed; 0 turns archiving off, as data/menu_htmls holds committed fixtures
+RAW_HTML_DAYS = int(os.environ.get('RAW_HTML_DAYS', 0))
+# Weeks whose last day is older than this are compacted into one archive
+WEEKLY_ARCHIVE_DAYS = int(os.environ.get('WEEKLY_ARCHIVE_DAYS', 14))
+# Pages older than this are deleted once verified; 0 keeps them forever
+HTML_RETENTION_DAYS = int(os.environ.get('HTML_RETENTION_DAYS', 0))
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+ARCHIVE_DIR_NAME = 'archive'
+
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+def page_hash(html_content):
+    return hashlib.sha256(html_content.encode()).hexdigest()
+
+def week_name(date):
+    year, week, _ = datetime.strptime(date, '%Y-%m-%d').isocalendar()
+    return f'{year}-W{week:02d}'
+
+def week_end(date):
+    """The Sunday ending the ISO week of `date`."""
+    day = datetime.strptime(date, '%Y-%m-%d').date()
+    return (day + timedelta(days=7 - day.isoweekday())).strftime('%Y-%m-%d')
+
+def _temporary(path):
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+def _archive_dir(menu_htmls_dir):
+    return os.path.join(menu_htmls_dir, ARCHIVE_DIR_NAME)
+
+def _manifest_path(menu_htmls_dir, week):
+    return os.path.join(_archive_dir(menu_htmls_dir), f'{week}.json')
+
+def _read_manifest(menu_htmls_dir, week):
+    try:
+        with open(_manifest_path(menu_htmls_dir, week), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+@contextmanager
+def _open_archive(path, mode):
+    """Open a weekly archive as a tar stream, reading ('r') or writing ('w')."""
+    if '.tar.zst' in os.path.basename(path):
+        if zstandard is None:
+            raise RuntimeError(f"{path} needs the zstandard package")
+        with open(path, mode + 'b') as raw:
+            if mode == 'r':
+                stream = zstandard.ZstdDecompressor().stream_reader(raw)
+            else:
+                stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw)
+            with stream, tarfile.open(fileobj=stream, mode=mode + '|') as archive:
+                yield archive
+    elif mode == 'r':
+        with tarfile.open(path, 'r|gz') as archive:
+            yield archive
+    else:
+        with tarfile.open(path, 'w:gz', compresslevel=GZIP_LEVEL) as archive:
+            yield archive
+
+
+def archived_day(day_dir):
+    """Return (archive path, {page name: content hash}) of a day moved into a weekly archive, or None."""
+    menu_htmls_dir, date = os.path.split(day_dir)
+    manifest = _read_manifest(menu_htmls_dir, week_name(date))
+    if manifest is None or date not in manifest['days']:
+        return None
+    return os.path.join(_archive_dir(menu_htmls_dir), manifest['file']), manifest['days'][date]
+
+def has_day(day_dir):
+    """Whether any of a day's pages were saved, in any form."""
+    return day_signature(day_dir) is not None
+
+def page_files(day_dir):
+    """Return {page name: file name} of a day directory; an uncompressed page wins over a gzipped one."""
+    files = {}
+    for file_name in sorted(os.listdir(day_dir)):
+        if file_name.endswith('.html'):
+            files[file_name] = file_name
+        elif file_name.endswith('.html.gz'):
+            files.setdefault(file_name[:-len('.gz')], file_name)
+    return files
+
+def day_signature(day_dir):
+    """Return a hashable fingerprint of a day's saved pages, or None if there are none."""
+    if os.path.isdir(day_dir):
+        signature = []
+        with os.scandir(day_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.html') or entry.name.endswith('.html.gz'):
+                    stat = entry.stat()
+                    signature.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        if signature:
+            return tuple(sorted(signature))
+    archived = archived_day(day_dir)
+    if archived is None:
+        return None
+    stat = os.stat(archived[0])
+    return ((os.path.basename(archived[0]), stat.st_mtime_ns, stat.st_size),)
+
+def read_pages(day_dir):
+    """Yield (page name, HTML) for each of a day's pages, decompressing them as they are read."""
+    if os.path.isdir(day_dir):
+        for name, file_name in page_files(day_dir).items():
+            path = os.path.join(day_dir, file_name)
+            with (gzip.open(path, 'rt', encoding='utf-8') if file_name.endswith('.gz') else open(path, 'r', encoding='utf-8')) as file:
+                yield name, file.read()
+        return
+    archived = archived_day(day_dir)
+    if archived is None:
+        return
+    date = os.path.basename(day_dir)
+    with _open_archive(archived[0], 'r') as archive:
+        for member in archive:
+            day, _, name = member.name.partition('/')
+            if day == date and member.isfile():
+                # Archived pages were written with their newlines already translated
+                yield name, archive.extractfile(member).read().decode('utf-8')
+
+
+def verified_pages(day_dir, load_day=None):
+    """Return {page name: content hash} if the menu store holds the menus parsed from a day's pages, else None.
+
+    A day the store does not match is loaded once with `load_day(date)`, if
+    given, and checked again.
+    """
+    date = os.path.basename(day_dir)
+    hashes = {name: page_hash(html_content) for name, html_content in read_pages(day_dir)}
+    if not hashes:
+        return None
+    for attempt in range(2):
+        stored = menu_store.day_pages(date)
+        if stored and sorted(stored.values()) == sorted(hashes.values()) \
+                and all(menu_store.has_page(content_hash) for content_hash in hashes.values()):
+            return hashes
+        if load_day is None or attempt:
+            break
+        load_day(date)
+    return None
+
+def compress_day(day_dir):
+    """Replace a day's uncompressed pages with gzipped ones."""
+    for file_name in sorted(os.listdir(day_dir)):
+        if not file_name.endswith('.html'):
+            continue
+        path = os.path.join(day_dir, file_name)
+        tmp_path = _temporary(path + '.gz')
+        with open(path, 'rb') as source, open(tmp_path, 'wb') as target, \
+                gzip.GzipFile(file_name, 'wb', GZIP_LEVEL, target, mtime=0) as compressed:
+            shutil.copyfileobj(source, compressed)
+        os.replace(tmp_path, path + '.gz')
+        os.remove(path)
+
+def compact_week(menu_htmls_dir, week, dates):
+    """Move the pages of `dates`, all in `week`, into the week's archive and remove their directories.
+
+    Days already in the archive are carried over, so a week can be compacted
+    more than once.
+    """
+    archive_dir = _archive_dir(menu_htmls_dir)
+    os.makedirs(archive_dir, exist_ok=True)
+    manifest = _read_manifest(menu_htmls_dir, week)
+    file_name = f'{week}.tar.zst' if zstandard else f'{week}.tar.gz'
+    path = os.path.join(archive_dir, file_name)
+    # Keeps the extension, which says how the archive is compressed
+    tmp_path = os.path.join(archive_dir, f'{os.getpid()}.{threading.get_ident()}.tmp.{file_name}')
+
+    days = {}
+    with _open_archive(tmp_path, 'w') as archive:
+        if manifest is not None:
+            with _open_archive(os.path.join(archive_dir, manifest['file']), 'r') as previous:
+                for member in previous:
+                    if member.isfile() and member.name.partition('/')[0] not in dates:
+                        archive.addfile(member, previous.extractfile(member))
+            days = {date: pages for date, pages in manifest['days'].items() if date not in dates}
+        for date in sorted(dates):
+            day_dir = os.path.join(menu_htmls_dir, date)
+            mtime = os.stat(day_dir).st_mtime
+            days[date] = {}
+            for name, html_content in read_pages(day_dir):
+                data = html_content.encode()
+                member = tarfile.TarInfo(f'{date}/{name}')
+                member.size, member.mtime = len(data), mtime
+                archive.addfile(member, io.BytesIO(data))
+                days[date][name] = page_hash(html_content)
+    os.replace(tmp_path, path)
+
+    manifest_path = _manifest_path(menu_htmls_dir, week)
+    with open(_temporary(manifest_path), 'w') as file:
+        json.dump({'file': file_name, 'days': dict(sorted(days.items()))}, file, indent=1)
+    os.replace(_temporary(manifest_path), manifest_path)
+    if manifest is not None and manifest['file'] != file_name:
+        os.remove(os.path.join(archive_dir, manifest['file']))
+    for date in dates:
+        shutil.rmtree(os.path.join(menu_htmls_dir, date))
+
+def delete_week(menu_htmls_dir, week):
+    """Delete a week's archive; returns the dates it held."""
+    manifest = _read_manifest(menu_htmls_dir, week)
+    if manifest is None:
+        return []
+    os.remove(_manifest_path(menu_htmls_dir, week))
+    os.remove(os.path.join(_archive_dir(menu_htmls_dir), manifest['file']))
+    return sorted(manifest['days'])
+
+
+def _tree_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            size += os.path.getsize(os.path.join(root, file_name))
+    return size
+
+@contextmanager
+def _maintaining(menu_htmls_dir, dry_run=False):
+    """Yield whether this process got the maintenance lock; workers that did not skip maintenance."""
+    if dry_run:
+        # Changes nothing, so it needs no lock (and creates no lock file)
+        yield True
+        return
+    os.makedirs(_archive_dir(menu_htmls_dir), exist_ok=True)
+    with open(os.path.join(_archive_dir(menu_htmls_dir), '.lock'), 'w') as file:
+        if not menu_snapshot.lock_file(file, blocking=False):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            menu_snapshot.unlock_file(file)
+
+def maintain(menu_htmls_dir, today, load_day=None, raw_days=RAW_HTML_DAYS, weekly_days=WEEKLY_ARCHIVE_DAYS,
+             retention_days=HTML_RETENTION_DAYS, dry_run=False):
+    """Compress, compact and delete the pages saved before `today` as the retention policy says.
+
+    Pages are only rewritten or deleted once verified_pages() confirms the
+    menu store holds what was parsed from them. Past days also have their
+    stored menus gzipped and their snapshots dropped; both come back on
+    demand. Returns a report, or None if another process is maintaining.
+
+    A dry run only reads: days the store does not match yet, which a real
+    run would first load with `load_day`, are listed under "unparsed".
+    """
+    with _maintaining(menu_htmls_dir, dry_run) as locked:
+        if not locked:
+            logger.info("Menu pages are being archived by another process")
+            return None
+
+        day = datetime.strptime(today, '%Y-%m-%d').date()
+        def cutoff(days):
+            return (day - timedelta(days=days)).strftime('%Y-%m-%d')
+        size_before = _tree_size(menu_htmls_dir)
+        report = {"compressed": [], "archived": {}, "deleted": [], "unverified": [], "unparsed": []}
+
+        dates = sorted(name for name in os.listdir(menu_htmls_dir)
+                       if DATE_PATTERN.fullmatch(name) and name < cutoff(raw_days))
+        weeks = {}
+        for date in dates:
+            day_dir = os.path.join(menu_htmls_dir, date)
+            if retention_days and date < cutoff(retention_days):
+                action = 'deleted'
+            elif week_end(date) < cutoff(weekly_days):
+                action = 'archived'
+            elif any(file_name.endswith('.html') for file_name in os.listdir(day_dir)):
+                action = 'compressed'
+            else:
+                continue
+            if verified_pages(day_dir, None if dry_run else load_day) is None:
+                if dry_run and load_day is not None:
+                    report["unparsed"].append(date)
+                    continue
+                logger.warning(f"Keeping the pages of {date}: the stored menus do not match them")
+                report["unverified"].append(date)
+                continue
+            if action == 'archived':
+                weeks.setdefault(week_name(date), []).append(date)
+                continue
+            report[action].append(date)
+            if dry_run:
+                continue
+            # Parsing the day waits for this, and this for a parse in progress
+            with menu_snapshot.publishing(date):
+                if action == 'deleted':
+                    shutil.rmtree(day_dir)
+                else:
+                    compress_day(day_dir)
+                menu_store.compress_day(date)
+                menu_snapshot.discard(date)
+
+        for week, week_dates in sorted(weeks.items()):
+            report["archived"][week] = week_dates
+            if dry_run:
+                continue
+            with ExitStack() as locks:
+                for date in sorted(week_dates):
+                    locks.enter_context(menu_snapshot.publishing(date))
+                compact_week(menu_htmls_dir, week, week_dates)
+                for date in week_dates:
+                    menu_store.compress_day(date)
+                    menu_snapshot.discard(date)
+
+        if retention_days and os.path.isdir(_archive_dir(menu_htmls_dir)):
+            for file_name in sorted(os.listdir(_archive_dir(menu_htmls_dir))):
+                if not file_name.endswith('.json'):
+                    continue
+                week = file_name[:-len('.json')]
+                manifest = _read_manifest(menu_htmls_dir, week)
+                if max(manifest['days']) < cutoff(retention_days):
+                    report["deleted"].extend(manifest['days'] if dry_run else delete_week(menu_htmls_dir, week))
+
+        report["bytes_before"], report["bytes_after"] = size_before, _tree_size(menu_htmls_dir)
+        logger.info(f"Archived menu pages: {len(report['compressed'])} days compressed, "
+                    f"{sum(map(len, report['archived'].values()))} compacted into {len(report['archived'])} weeks, "
+                    f"{len(report['deleted'])} deleted; {size_before} -> {report['bytes_after']} bytes")
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--today', help='Apply the policy as of this date (default: today)')
+    parser.add_argument('--raw-days', type=int, default=RAW_HTML_DAYS)
+    parser.add_argument('--weekly-days', type=int, default=WEEKLY_ARCHIVE_DAYS)
+    parser.add_argument('--retention-days', type=int, default=HTML_RETENTION_DAYS)
+    parser.add_argument('--dry-run', action='store_true', help='Verify and report, but change nothing')
+    args = parser.parse_args()
+    if not args.raw_days:
+        parser.error("set RAW_HTML_DAYS or --raw-days to archive anything")
+
+    import menu_scrape
+    today = args.today or menu_scrape.get_current_time_est().strftime('%Y-%m-%d')
+    report = maintain(menu_scrape.menu_htmls_dir, today, menu_scrape.fetch_dining_hall_info,
+                      args.raw_days, args.weekly_days, args.retention_days, args.dry_run)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
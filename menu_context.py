@@ -0,0 +1,209 @@
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# Upper bound on the size of a rendered menu context, in estimated tokens
+DEFAULT_TOKEN_BUDGET = int(os.environ.get('MENU_CONTEXT_TOKENS', 1500))
+# Rough size of a token for English text; close enough for budgeting
+CHARS_PER_TOKEN = 4
+
+MEALS = ['Breakfast', 'Brunch', 'Lunch', 'Dinner']
+# Traits on nearly every item; they cost tokens without helping the model choose
+UNINFORMATIVE_TRAITS = ('Carbon Footprint', 'Nutrient Dense')
+# Names students use for halls besides the words of the hall name itself
+HALL_ALIASES = {
+    'mojo': 'Mosher-Jordan',
+    'mj': 'Mosher-Jordan',
+    'eq': 'East Quad',
+    'nq': 'North Quad',
+    'sq': 'South Quad',
+}
+STOPWORDS = {
+    'a', 'an', 'and', 'any', 'are', 'at', 'can', 'do', 'does', 'for', 'get', 'have', 'i', 'in', 'is', 'it',
+    'me', 'my', 'of', 'on', 'or', 'serving', 'some', 'the', 'there', 'to', 'today', 'tonight', 'what',
+    'where', 'which', 'with', 'hall', 'halls', 'dining', 'food', 'eat', 'good', 'quad',
+}
+
+# Weights of a query word found in an item's name, its station or its traits
+NAME_WEIGHT = 3
+STATION_WEIGHT = 2
+TRAIT_WEIGHT = 1
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def tokenize(text):
+    """Lowercase words without stopwords, with a trailing plural 's' removed."""
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    return [word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+            for word in words if word not in STOPWORDS]
+
+def _stations(meals):
+    """Yield (station, items) for both menu shapes: {station: items} and [{"station_name", "items"}]."""
+    if isinstance(meals, dict):
+        yield from meals.items()
+    else:
+        for station in meals:
+            yield station["station_name"], station["items"]
+
+def _format_hour(hour):
+    return f"{int(hour)}:{round(hour % 1 * 60):02d}"
+
+
+class MenuIndex:
+    """Keyword index over one day's menus.
+
+    Every item becomes an entry (position, hall, meal, station, item), and each
+    word of an item's name, station and traits points back at its entries.
+    """
+
+    def __init__(self, dining_halls):
+        self.entries = []
+        self.postings = {}
+        self.halls = []
+        hall_words = {}
+        for dining_hall in dining_halls:
+            hall = dining_hall["dining_hall"]
+            self.halls.append(hall)
+            for word in tokenize(hall):
+                hall_words.setdefault(word, set()).add(hall)
+            for meal, meals in dining_hall["menus"].items():
+                for station, items in _stations(meals):
+                    for item in items:
+                        position = len(self.entries)
+                        self.entries.append((position, hall, meal, station, item))
+                        self._add(item["item_name"], position, NAME_WEIGHT)
+                        self._add(station, position, STATION_WEIGHT)
+                        for trait in item.get("traits", []):
+                            self._add(trait, position, TRAIT_WEIGHT)
+        # Only words naming a single hall identify it ("east" does, "quad" would not)
+        self.hall_words = {word: halls.pop() for word, halls in hall_words.items() if len(halls) == 1}
+        self.hall_words.update((alias, hall) for alias, hall in HALL_ALIASES.items() if hall in self.halls)
+
+    def _add(self, text, position, weight):
+        for word in set(tokenize(text)):
+            postings = self.postings.setdefault(word, {})
+            postings[position] = max(postings.get(position, 0), weight)
+
+    def search(self, message):
+        """Return (halls named, meals named, {entry position: score}) for a message."""
+        words = tokenize(message or '')
+        halls = {self.hall_words[word] for word in words if word in self.hall_words}
+        meals = {meal for meal in MEALS if meal.lower() in words}
+        scores = {}
+        for word in words:
+            if word in self.hall_words or word in ('breakfast', 'brunch', 'lunch', 'dinner'):
+                continue
+            for position, weight in self.postings.get(word, {}).items():
+                scores[position] = scores.get(position, 0) + weight
+        return halls, meals, scores
+
+
+def render_item(item):
+    """'Scrambled Eggs (163 cal; Gluten Free, Vegetarian; contains eggs, soy)'"""
+    details = []
+    calories = item.get("nutrition", {}).get("calories")
+    if calories:
+        details.append(f"{calories} cal")
+    traits = [trait for trait in item.get("traits", []) if not trait.startswith(UNINFORMATIVE_TRAITS)]
+    if traits:
+        details.append(', '.join(traits))
+    if item.get("allergens"):
+        details.append("contains " + ', '.join(item["allergens"]))
+    return f"{item['item_name']} ({'; '.join(details)})" if details else item["item_name"]
+
+def render_heading(hall, meal, statuses):
+    status = (statuses or {}).get(hall)
+    if status and status[0] == meal:
+        return f"{hall}, {meal} (open {_format_hour(status[1][0])}-{_format_hour(status[1][1])}):"
+    return f"{hall}, {meal}:"
+
+
+def select_entries(index, message=None, statuses=None):
+    """Order entries by relevance to the message and the halls' current status.
+
+    Halls and meals named in the message narrow the selection. Otherwise open
+    halls and the meals they are serving are used, or the whole day when
+    nothing is open. Items matching words of the message come first, best
+    match first, looking at the rest of the day if none match within the
+    selection; the rest of the selection follows in menu order, so the
+    context can still answer what else is being served.
+    """
+    halls, meals, scores = index.search(message)
+    open_meals = {hall: status[0] for hall, status in (statuses or {}).items() if status}
+    if not halls:
+        halls = set(open_meals) & set(index.halls) or set(index.halls)
+
+    def selected(entry):
+        _, hall, meal, _, _ = entry
+        if hall not in halls:
+            return False
+        if meals:
+            return meal in meals
+        return meal == open_meals[hall] if hall in open_meals else True
+
+    candidates = [entry for entry in index.entries if selected(entry)]
+    matched = [entry for entry in candidates if entry[0] in scores]
+    if scores and not matched:
+        matched = [entry for entry in index.entries if entry[0] in scores]
+    matched.sort(key=lambda entry: -scores[entry[0]])
+    return matched + [entry for entry in candidates if entry[0] not in scores]
+
+
+def build_menu_context(dining_halls, message=None, statuses=None, budget=None):
+    """Render the menu items most relevant to `message` as compact text.
+
+    `dining_halls` is a list of hall menus as returned by fetch_dining_hall_info,
+    get_user_menu or query_menu. `statuses` maps halls to (meal, [start, end])
+    as returned by Schedule.statuses(), or None for a day other than today.
+    The rendered text stays within `budget` estimated tokens.
+    """
+    budget = budget or DEFAULT_TOKEN_BUDGET
+    index = MenuIndex(dining_halls)
+    ordered = select_entries(index, message, statuses)
+
+    chosen = []
+    groups = set()
+    used = 0
+    for entry in ordered:
+        position, hall, meal, station, item = entry
+        cost = estimate_tokens(render_item(item)) + 1
+        if (hall, meal) not in groups:
+            cost += estimate_tokens(render_heading(hall, meal, statuses))
+        if (hall, meal, station) not in groups:
+            cost += estimate_tokens(station) + 1
+        if used + cost > budget:
+            break
+        used += cost
+        groups.update([(hall, meal), (hall, meal, station)])
+        chosen.append(entry)
+
+    # Render in menu order so items of a station stay together
+    lines = []
+    current_group = current_station = None
+    station_items = []
+    for position, hall, meal, station, item in sorted(chosen):
+        if (hall, meal, station) != current_station and station_items:
+            lines.append(f"  {current_station[2]}: " + '; '.join(station_items))
+            station_items = []
+        if (hall, meal) != current_group:
+            lines.append(render_heading(hall, meal, statuses))
+            current_group = (hall, meal)
+        current_station = (hall, meal, station)
+        station_items.append(render_item(item))
+    if station_items:
+        lines.append(f"  {current_station[2]}: " + '; '.join(station_items))
+
+    omitted = len(ordered) - len(chosen)
+    if omitted:
+        lines.append(f"({omitted} more items not listed)")
+    if not lines:
+        lines.append("No menu items found.")
+    text = '\n'.join(lines)
+    logger.debug(f"Built menu context of ~{estimate_tokens(text)} tokens from {len(index.entries)} items")
+    return text
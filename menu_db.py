@@ -0,0 +1,261 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import logging
+
+import metrics
+from menu_scrape import fetch_dining_hall_info, menu_files_signature, menu_htmls_dir, NUTRITION_FIELDS
+from menu_masks import normalize_label
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+var_dir = os.path.join(this_dir, 'var')
+menus_db = os.path.join(var_dir, 'menus.db')
+
+os.makedirs(var_dir, exist_ok=True)
+
+MEAL_NAMES = ['Breakfast', 'Lunch', 'Brunch', 'Dinner']
+NUTRITION_COLUMNS = [field for _, field, _ in NUTRITION_FIELDS]
+# Traits and allergens are matched by their normalize_label() form, as the
+# preference masks are, so 'Gluten Free' and 'glutenFree' are the same
+LABELED_TABLES = ('traits', 'allergens')
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS halls (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS dates (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL UNIQUE,
+    signature TEXT,
+    ingested_at REAL
+);
+CREATE TABLE IF NOT EXISTS meals (
+    id INTEGER PRIMARY KEY,
+    date_id INTEGER NOT NULL REFERENCES dates(id) ON DELETE CASCADE,
+    hall_id INTEGER NOT NULL REFERENCES halls(id),
+    hall_position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    UNIQUE (date_id, hall_id, name)
+);
+CREATE INDEX IF NOT EXISTS meals_by_date_meal ON meals (date_id, name);
+CREATE TABLE IF NOT EXISTS stations (
+    id INTEGER PRIMARY KEY,
+    meal_id INTEGER NOT NULL REFERENCES meals(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stations_by_meal ON stations (meal_id, position);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    station_id INTEGER NOT NULL REFERENCES stations(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_by_station ON items (station_id, position);
+CREATE TABLE IF NOT EXISTS traits (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    label TEXT
+);
+CREATE TABLE IF NOT EXISTS item_traits (
+    item_id INTEGER NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+    trait_id INTEGER NOT NULL REFERENCES traits(id),
+    position INTEGER NOT NULL,
+    PRIMARY KEY (item_id, position)
+);
+CREATE INDEX IF NOT EXISTS item_traits_by_trait ON item_traits (trait_id);
+CREATE TABLE IF NOT EXISTS allergens (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    label TEXT
+);
+CREATE TABLE IF NOT EXISTS item_allergens (
+    item_id INTEGER NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+    allergen_id INTEGER NOT NULL REFERENCES allergens(id),
+    position INTEGER NOT NULL,
+    PRIMARY KEY (item_id, position)
+);
+CREATE INDEX IF NOT EXISTS item_allergens_by_allergen ON item_allergens (allergen_id);
+CREATE TABLE IF NOT EXISTS nutrition (
+    item_id INTEGER PRIMARY KEY REFERENCES items(id) ON DELETE CASCADE,
+    {", ".join(f"{column} TEXT" for column in NUTRITION_COLUMNS)}
+);
+'''
+
+_ingest_lock = threading.Lock()
+
+
+def connect():
+    conn = sqlite3.connect(menus_db)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+def _init_db():
+    conn = connect()
+    conn.executescript(SCHEMA)
+    for table in LABELED_TABLES:
+        if 'label' not in [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]:
+            # Created before names were matched by label
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN label TEXT")
+        conn.executemany(f"UPDATE {table} SET label = ? WHERE id = ?",
+                         [(normalize_label(name), row_id) for row_id, name in
+                          conn.execute(f"SELECT id, name FROM {table} WHERE label IS NULL").fetchall()])
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_by_label ON {table} (label)")
+    conn.commit()
+    conn.close()
+
+_init_db()
+
+
+def _lookup_id(c, table, name, cache):
+    if name not in cache:
+        if table in LABELED_TABLES:
+            c.execute(f"INSERT OR IGNORE INTO {table} (name, label) VALUES (?, ?)", (name, normalize_label(name)))
+        else:
+            c.execute(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", (name,))
+        c.execute(f"SELECT id FROM {table} WHERE name = ?", (name,))
+        cache[name] = c.fetchone()[0]
+    return cache[name]
+
+@metrics.timed("db")
+def ingest_day(date, dining_halls, signature=None):
+    """Load the output of fetch_dining_hall_info for one date into the database.
+
+    Any rows previously ingested for the date are replaced.
+    """
+    started = time.perf_counter()
+    conn = connect()
+    c = conn.cursor()
+    ids = {'halls': {}, 'traits': {}, 'allergens': {}}
+    nutrition_insert = (f"INSERT INTO nutrition (item_id, {', '.join(NUTRITION_COLUMNS)}) "
+                        f"VALUES (?, {', '.join('?' for _ in NUTRITION_COLUMNS)})")
+    try:
+        c.execute("DELETE FROM dates WHERE date = ?", (date,))
+        c.execute("INSERT INTO dates (date, signature, ingested_at) VALUES (?, ?, ?)",
+                  (date, json.dumps(signature), time.time()))
+        date_id = c.lastrowid
+        for hall_position, dining_hall in enumerate(dining_halls):
+            hall_id = _lookup_id(c, 'halls', dining_hall['dining_hall'], ids['halls'])
+            for meal_position, (meal_time, stations) in enumerate(dining_hall['menus'].items()):
+                c.execute("INSERT INTO meals (date_id, hall_id, hall_position, name, position) VALUES (?, ?, ?, ?, ?)",
+                          (date_id, hall_id, hall_position, meal_time, meal_position))
+                meal_id = c.lastrowid
+                for station_position, (station, items) in enumerate(stations.items()):
+                    c.execute("INSERT INTO stations (meal_id, name, position) VALUES (?, ?, ?)",
+                              (meal_id, station, station_position))
+                    station_id = c.lastrowid
+                    for item_position, item in enumerate(items):
+                        c.execute("INSERT INTO items (station_id, name, position) VALUES (?, ?, ?)",
+                                  (station_id, item['item_name'], item_position))
+                        item_id = c.lastrowid
+                        c.executemany("INSERT INTO item_traits (item_id, trait_id, position) VALUES (?, ?, ?)",
+                                      [(item_id, _lookup_id(c, 'traits', trait, ids['traits']), position)
+                                       for position, trait in enumerate(item['traits'])])
+                        c.executemany("INSERT INTO item_allergens (item_id, allergen_id, position) VALUES (?, ?, ?)",
+                                      [(item_id, _lookup_id(c, 'allergens', allergen, ids['allergens']), position)
+                                       for position, allergen in enumerate(item['allergens'])])
+                        nutrition = item.get('nutrition', {})
+                        c.execute(nutrition_insert, [item_id] + [nutrition.get(column) for column in NUTRITION_COLUMNS])
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"Error ingesting menus for {date}: {e}")
+        raise
+    finally:
+        conn.close()
+    logger.info(f"Ingested menus for {date} in {time.perf_counter() - started:.2f}s")
+
+@metrics.timed("db")
+def ensure_day(date):
+    """Ingest a date's menus unless the database already holds the current version."""
+    signature = menu_files_signature(os.path.join(menu_htmls_dir, date))
+    conn = connect()
+    c = conn.cursor()
+    c.execute("SELECT signature FROM dates WHERE date = ?", (date,))
+    row = c.fetchone()
+    conn.close()
+    # Without HTML (the retention policy deleted it) the menus can no longer change,
+    # so whatever was ingested is current
+    if row and (signature is None or row[0] == json.dumps(signature)):
+        return
+    with _ingest_lock:
+        dining_halls = fetch_dining_hall_info(date)
+        ingest_day(date, dining_halls, menu_files_signature(os.path.join(menu_htmls_dir, date)))
+
+@metrics.timed("db")
+def query_menu(date, halls=None, meals=None, stations=None, exclude_allergens=(), require_traits=()):
+    """Return menus for a date in the fetch_dining_hall_info format, filtered in SQL.
+
+    `halls`, `meals` and `stations` restrict the result to those names.
+    Items containing any of `exclude_allergens`, or missing any of
+    `require_traits`, are left out; these match names as normalize_label() does.
+    """
+    ensure_day(date)
+
+    conditions = ["d.date = ?"]
+    params = [date]
+    for column, names in (("h.name", halls), ("m.name", meals), ("s.name", stations)):
+        if names:
+            conditions.append(f"{column} IN ({', '.join('?' for _ in names)})")
+            params.extend(names)
+    if exclude_allergens:
+        conditions.append(f'''NOT EXISTS (
+            SELECT 1 FROM item_allergens ia JOIN allergens a ON a.id = ia.allergen_id
+            WHERE ia.item_id = i.id AND a.label IN ({', '.join('?' for _ in exclude_allergens)}))''')
+        params.extend(normalize_label(allergen) for allergen in exclude_allergens)
+    for trait in require_traits:
+        conditions.append('''EXISTS (
+            SELECT 1 FROM item_traits it JOIN traits t ON t.id = it.trait_id
+            WHERE it.item_id = i.id AND t.label = ?)''')
+        params.append(normalize_label(trait))
+
+    query = f'''
+        SELECT h.name, m.name, s.name, i.name,
+            (SELECT json_group_array(name) FROM (
+                SELECT t.name FROM item_traits it JOIN traits t ON t.id = it.trait_id
+                WHERE it.item_id = i.id ORDER BY it.position)),
+            (SELECT json_group_array(name) FROM (
+                SELECT a.name FROM item_allergens ia JOIN allergens a ON a.id = ia.allergen_id
+                WHERE ia.item_id = i.id ORDER BY ia.position)),
+            {", ".join(f"n.{column}" for column in NUTRITION_COLUMNS)}
+        FROM dates d
+        JOIN meals m ON m.date_id = d.id
+        JOIN halls h ON h.id = m.hall_id
+        JOIN stations s ON s.meal_id = m.id
+        JOIN items i ON i.station_id = s.id
+        LEFT JOIN nutrition n ON n.item_id = i.id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY m.hall_position, m.position, s.position, i.position
+    '''
+    conn = connect()
+    c = conn.cursor()
+    c.execute(query, params)
+    rows = c.fetchall()
+    conn.close()
+
+    result = {}
+    for row in rows:
+        hall_name, meal_time, station, item_name, traits, allergens = row[:6]
+        if hall_name not in result:
+            result[hall_name] = {
+                'dining_hall': hall_name,
+                'last_updated': date,
+                'menus': {meal: {} for meal in (meals or MEAL_NAMES)},
+            }
+        menus = result[hall_name]['menus']
+        menus.setdefault(meal_time, {}).setdefault(station, []).append({
+            'item_name': item_name,
+            'traits': json.loads(traits),
+            'allergens': json.loads(allergens),
+            'nutrition': {column: value for column, value in zip(NUTRITION_COLUMNS, row[6:]) if value is not None},
+        })
+    return list(result.values())
@@ -0,0 +1,183 @@
+import re
+import json
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+import menu_snapshot
+from menu_scrape import MENU_CACHE_MAX_DATES
+
+
+def normalize_label(name):
+    """Map 'Gluten Free', 'gluten-free' and 'glutenFree' to the same label."""
+    name = re.sub(r'(?<=[a-z])(?=[A-Z])', ' ', name)
+    return ' '.join(name.lower().replace('-', ' ').replace('_', ' ').split())
+
+
+class UnknownLabel(ValueError):
+    pass
+
+
+class MaskVocabulary:
+    """Assigns one bit to each known trait or allergen name.
+
+    Names outside the vocabulary have no bit. Filters must not name one,
+    since it would silently match everything; menu items may, and those
+    names are ignored.
+    """
+
+    def __init__(self, names):
+        self.names = [normalize_label(name) for name in names]
+        self.bits = {name: 1 << position for position, name in enumerate(self.names)}
+
+    def encode(self, names, ignore_unknown=False):
+        """Return the mask of `names`; raises UnknownLabel for a name without a bit unless `ignore_unknown`."""
+        mask = 0
+        for name in names:
+            bit = self.bits.get(normalize_label(name))
+            if bit is None:
+                if ignore_unknown:
+                    continue
+                raise UnknownLabel(f"Unknown label '{name}', expected one of {', '.join(self.names)}")
+            mask |= bit
+        return mask
+
+    def decode(self, mask):
+        return [name for name, bit in self.bits.items() if mask & bit]
+
+
+class DayMaskIndex:
+    """Allergen and trait masks of every item in one day's menus.
+
+    Items are stored in the order they appear when walking halls, meals and
+    stations, so `matches()` lines up with that same walk.
+    """
+
+    def __init__(self, dining_halls, allergen_vocabulary, trait_vocabulary):
+        self.allergen_masks = array('Q')
+        self.trait_masks = array('Q')
+        for dining_hall in dining_halls:
+            for stations in dining_hall['menus'].values():
+                for items in stations.values():
+                    for item in items:
+                        self.allergen_masks.append(allergen_vocabulary.encode(item['allergens'], ignore_unknown=True))
+                        self.trait_masks.append(trait_vocabulary.encode(item['traits'], ignore_unknown=True))
+
+    def matches(self, exclude_allergens=0, require_traits=0):
+        """Return one bool per item: no excluded allergen and every required trait."""
+        return [
+            not allergen_mask & exclude_allergens and trait_mask & require_traits == require_traits
+            for allergen_mask, trait_mask in zip(self.allergen_masks, self.trait_masks)
+        ]
+
+
+_day_indexes = OrderedDict()
+_day_indexes_lock = threading.Lock()
+
+def day_mask_index(dining_halls, allergen_vocabulary, trait_vocabulary):
+    """Return the mask index for a parsed day, building it once per menus object.
+
+    `dining_halls` is the shared list returned by fetch_dining_hall_info, so a
+    re-parsed day gets a new object and therefore a new index.
+    """
+    key = (id(dining_halls), id(allergen_vocabulary), id(trait_vocabulary))
+    with _day_indexes_lock:
+        entry = _day_indexes.get(key)
+        if entry is not None and entry[0] is dining_halls:
+            _day_indexes.move_to_end(key)
+            return entry[1]
+
+    index = DayMaskIndex(dining_halls, allergen_vocabulary, trait_vocabulary)
+    with _day_indexes_lock:
+        # Keep a reference to the menus so their id cannot be reused while cached
+        _day_indexes[key] = (dining_halls, index)
+        while len(_day_indexes) > MENU_CACHE_MAX_DATES:
+            _day_indexes.popitem(last=False)
+    return index
+
+
+class PublishedDayIndex(DayMaskIndex):
+    """A DayMaskIndex read in place from a menu snapshot.
+
+    The snapshot also holds each item's JSON and the halls, meals and
+    stations around them, so a filtered menu can be written out without
+    decoding the menus in this process. Positions follow the same walk as
+    DayMaskIndex.
+    """
+
+    def __init__(self, snapshot):
+        layout = json.loads(bytes(snapshot.section('masks:layout')))
+        self.allergen_names = layout['allergens']
+        self.trait_names = layout['traits']
+        # [{"fields": [[key, value], ...], "digest": str, "meals": [[meal, [[station, count], ...]], ...]}]
+        self.halls = layout['halls']
+        self.allergen_masks = snapshot.section('masks:allergens').cast('Q')
+        self.trait_masks = snapshot.section('masks:traits').cast('Q')
+        self._offsets = snapshot.section('masks:offsets').cast('Q')
+        self._items = snapshot.section('masks:items')
+
+    def item_json(self, position):
+        """The compact JSON of the item at `position`, as a view of the snapshot."""
+        return self._items[self._offsets[position]:self._offsets[position + 1]]
+
+
+def _index_sections(dining_halls, allergen_vocabulary, trait_vocabulary):
+    halls = []
+    items = bytearray()
+    offsets = array('Q', [0])
+    allergen_masks = array('Q')
+    trait_masks = array('Q')
+    for dining_hall in dining_halls:
+        meals = []
+        for meal, stations in dining_hall['menus'].items():
+            counts = []
+            for station, station_items in stations.items():
+                for item in station_items:
+                    items += json.dumps(item, separators=(',', ':')).encode()
+                    offsets.append(len(items))
+                    allergen_masks.append(allergen_vocabulary.encode(item['allergens'], ignore_unknown=True))
+                    trait_masks.append(trait_vocabulary.encode(item['traits'], ignore_unknown=True))
+                counts.append([station, len(station_items)])
+            meals.append([meal, counts])
+        halls.append({
+            'fields': [[key, None if key == 'menus' else value] for key, value in dining_hall.items()],
+            'digest': hashlib.sha256(json.dumps(dining_hall, sort_keys=True).encode()).hexdigest()[:32],
+            'meals': meals,
+        })
+    layout = {'allergens': allergen_vocabulary.names, 'traits': trait_vocabulary.names, 'halls': halls}
+    return {
+        'masks:layout': json.dumps(layout, separators=(',', ':')).encode(),
+        'masks:items': bytes(items),
+        'masks:offsets': offsets.tobytes(),
+        'masks:allergens': allergen_masks.tobytes(),
+        'masks:traits': trait_masks.tobytes(),
+    }
+
+def publish_mask_index(allergen_vocabulary, trait_vocabulary):
+    """Add the masks and item JSON of every day to its menu snapshot, for published_mask_index."""
+    menu_snapshot.register_sections('masks', lambda dining_halls: _index_sections(dining_halls, allergen_vocabulary, trait_vocabulary))
+
+def published_mask_index(snapshot, allergen_vocabulary, trait_vocabulary):
+    """Return the PublishedDayIndex of a snapshot, or None if it has none for these vocabularies.
+
+    Snapshots published before a vocabulary changed have masks with other
+    bits, so they are not used.
+    """
+    key = ('published', snapshot.path, id(allergen_vocabulary), id(trait_vocabulary))
+    with _day_indexes_lock:
+        entry = _day_indexes.get(key)
+        if entry is not None and entry[0] is snapshot:
+            _day_indexes.move_to_end(key)
+            return entry[1]
+
+    if snapshot.section('masks:layout') is None:
+        return None
+    index = PublishedDayIndex(snapshot)
+    if index.allergen_names != allergen_vocabulary.names or index.trait_names != trait_vocabulary.names:
+        return None
+    with _day_indexes_lock:
+        _day_indexes[key] = (snapshot, index)
+        while len(_day_indexes) > MENU_CACHE_MAX_DATES:
+            _day_indexes.popitem(last=False)
+    return index
@@ -1,4 +1,6 @@
 import json
+import html
+import re
 from bs4 import BeautifulSoup
 import os
 import requests
@@ -7,6 +9,17 @@ import pytz
 import time
 import random
 import logging
+import threading
+import menu_store
+import menu_snapshot
+import menu_archive
+import metrics
+import dining_hours
+from collections import OrderedDict
+from menu_archive import page_hash
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -22,6 +35,31 @@ os.makedirs(data_dir, exist_ok=True)
 os.makedirs(menu_htmls_dir, exist_ok=True)
 os.makedirs(output_dir, exist_ok=True)
 
+# Number of dates whose parsed menus are kept in memory
+MENU_CACHE_MAX_DATES = 7
+
+DINING_HALLS = [
+    'Bursley',
+    'East Quad',
+    'Markley',
+    'Mosher-Jordan',
+    'North Quad',
+    'South Quad'
+]
+
+# Where the hall pages are downloaded from; point it at a mirror or a local stub to test
+MENU_BASE_URL = os.environ.get('MENU_BASE_URL', 'https://dining.umich.edu/menus-locations/dining-halls/')
+
+# Concurrency, timeout (seconds) and retry budget for menu page downloads
+FETCH_MAX_WORKERS = 6
+FETCH_TIMEOUT = 15
+FETCH_RETRIES = 3
+
+# Per-day file holding the ETag/Last-Modified of each downloaded page
+VALIDATORS_FILE = 'validators.json'
+# A day none of whose pages could be downloaded is not downloaded again on request for this long
+DOWNLOAD_RETRY_SECONDS = 60
+
 
 def get_current_time_est():
     # Create a timezone object for Eastern Standard Time
@@ -38,294 +76,751 @@ def get_current_time_est():
 
     return est_now
 
-def save_webpage(url, file_path):
-    try:
-        # Send a GET request to the URL
-        response = requests.get(url)
-
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Open a file and write the content
-            with open(file_path, 'w', encoding='utf-8') as file:
-                file.write(response.text)
-            print(f"Page saved successfully to {file_path}")
-        else:
-            print(f"Failed to retrieve the page. Status code: {response.status_code}")
-    except requests.RequestException as e:
-        print(f"An error occurred: {e}")
+class MenuCache:
+    """Date-keyed LRU cache of parsed menus.
+
+    Each entry remembers the signature (name, mtime, size) of the HTML files it
+    was parsed from and is discarded as soon as the files on disk change.
+    Cached menus are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_dates=MENU_CACHE_MAX_DATES):
+        self.max_dates = max_dates
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, date, signature):
+        with self._lock:
+            entry = self._entries.get(date)
+            if entry is None or entry[0] != signature:
+                self.misses += 1
+                metrics.cache_lookup('menus', False)
+                return None
+            self._entries.move_to_end(date)
+            self.hits += 1
+            metrics.cache_lookup('menus', True)
+            return entry[1]
+
+    def put(self, date, signature, menus):
+        with self._lock:
+            self._entries[date] = (signature, menus)
+            self._entries.move_to_end(date)
+            while len(self._entries) > self.max_dates:
+                evicted, _ = self._entries.popitem(last=False)
+                logger.debug(f"Evicted menus for {evicted} from the menu cache")
+
+    def latest(self, date):
+        """The menus cached for a date, whatever HTML they came from, or None."""
+        with self._lock:
+            entry = self._entries.get(date)
+            return entry[1] if entry else None
+
+    def invalidate(self, date=None):
+        with self._lock:
+            if date is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(date, None)
 
-def webscraping_needed(date):
-        if os.path.exists(menu_htmls_dir + '/' + date):
-            logger.info("Data is up to date, no need to scrape.")
-            return False
-        logger.info("Data is not up to date, scraping is needed.")
-        return True
 
-def fetch_dining_hall_info(date=get_current_time_est().strftime('%Y-%m-%d'), force_update=False):
+menu_cache = MenuCache()
 
-    day_menu_htmls_dir = os.path.join(menu_htmls_dir, date)
-    if date:
-        date = date
-        day_menu_htmls_dir = os.path.join(menu_htmls_dir, date)
+def invalidate_menu_cache(date=None):
+    """Drop the cached menus for a date, or for every date if none is given."""
+    menu_cache.invalidate(date)
 
-    dining_halls = [
-        'Bursley',
-        'East Quad',
-        'Markley',
-        'Mosher-Jordan',
-        'North Quad',
-        'South Quad'
-    ]
+def menu_files_signature(day_menu_htmls_dir):
+    """Return a hashable fingerprint of the HTML files saved for a day, compressed or archived ones included."""
+    return menu_archive.day_signature(day_menu_htmls_dir)
 
-    base_url = 'https://dining.umich.edu/menus-locations/dining-halls/'
+def _parse_menu_soup(html_content, date):
+    """Parse a dining hall page with BeautifulSoup (the original parser)."""
+    dining_hall_info = {}
 
-    if webscraping_needed(date) or force_update:
-        day_menu_htmls_dir = os.path.join(menu_htmls_dir, date)
-        os.makedirs(day_menu_htmls_dir, exist_ok=True)
-        for hall in dining_halls:
-            url = base_url + hall.lower().replace(' ', '-') + '/'
-            url += f'?menuDate={date}'
-            file_name = url.split('/')[-2] + '.html'
-            file_path = os.path.join(day_menu_htmls_dir, file_name)
-            save_webpage(url, file_path)
+    # Parse the HTML
+    soup = BeautifulSoup(html_content, 'html.parser')
+    dining_hall_name = soup.find('title').get_text(strip=True)
+    dining_hall_info['dining_hall'] = dining_hall_name.split(' | ')[0].strip()
+    dining_hall_info['last_updated'] = date
+
+    # Initialize a dictionary to store the menu data
+    menus = {'Breakfast': {}, 'Lunch': {}, 'Brunch': {}, 'Dinner': {}}
 
-    all_info = []
+    menu_items = soup.find('div', id="mdining-items") 
+    sections = list(menu_items.find_all('ul', class_="items")) 
+    for section in sections:
+        meal_time = section.find_previous('h3').get_text(strip=True)
 
-    # Load the HTML from a file
-    file_list = os.listdir(f'{data_dir}/menu_htmls/{date}')
-    dining_halls = {}
 
+        station = section.find_previous('h4').get_text(strip=True)
+        menus[meal_time][station] = []
 
-    for file_path in file_list:
-        if not file_path.endswith('.html'):
-            print(f"Skipping {file_path} because it is not an HTML file")
+        items = list(section.find_all('div', class_="nutrition-wrapper"))
+        for item in items:
+            item_object = {}
+            item_name = item.find_previous('div', class_="item-name").get_text(strip=True)
+            item_object['item_name'] = item_name
+            traits = item.find_previous('ul', class_="traits")
+            item_object['traits'] = [trait.get_text(strip=True) for trait in traits.find_all('li')]
+            
+            allergens_div = item.find('div', class_='allergens')
+            if allergens_div:
+                allergens_list = allergens_div.find_all('li')
+                item_object['allergens'] = [allergen.get_text(strip=True) for allergen in allergens_list]
+            else:
+                item_object['allergens'] = []
+            
+            if item_name == "No Service":
+                continue
+            item_object['nutrition'] = {}
+
+            nutrition_info = list(item.find_all('td'))
+            for attribute in nutrition_info:
+                if "Serving Size" in attribute.get_text():
+                    item_object['nutrition']['serving_size'] = attribute.get_text().split('(')[-1][:-2]
+                if "Calories" in attribute.get_text():
+                    item_object['nutrition']['calories'] = attribute.get_text().split(' ')[-1]
+                if "Total Fat" in attribute.get_text():
+                    item_object['nutrition']['total_fat'] = attribute.get_text().split(' ')[-1]
+                if "Saturated Fat" in attribute.get_text():
+                    item_object['nutrition']['saturated_fat'] = attribute.get_text().split(' ')[-1]
+                if "Trans Fat" in attribute.get_text():
+                    item_object['nutrition']['trans_fat'] = attribute.get_text().split(' ')[-1]
+                if "Cholesterol" in attribute.get_text():
+                    item_object['nutrition']['cholesterol'] = attribute.get_text().split(' ')[-1]
+                if "Sodium" in attribute.get_text():
+                    item_object['nutrition']['sodium'] = attribute.get_text().split(' ')[-1]
+                if "Total Carbohydrate" in attribute.get_text():
+                    item_object['nutrition']['total_carbohydrate'] = attribute.get_text().split(' ')[-1]
+                if "Dietary Fiber" in attribute.get_text():
+                    item_object['nutrition']['dietary_fiber'] = attribute.get_text().split(' ')[-1]
+                if "Sugars" in attribute.get_text():
+                    item_object['nutrition']['sugars'] = attribute.get_text().split(' ')[-1]
+                if "Protein" in attribute.get_text():
+                    item_object['nutrition']['protein'] = attribute.get_text().split(' ')[-1]
+                if "Vitamin A" in attribute.get_text():
+                    next_attribute = nutrition_info[nutrition_info.index(attribute) + 1].get_text()
+                    item_object['nutrition']['vitamin_a'] = next_attribute.split(' ')[-1]
+                if "Vitamin C" in attribute.get_text():
+                    next_attribute = nutrition_info[nutrition_info.index(attribute) + 1].get_text()
+                    item_object['nutrition']['vitamin_c'] = next_attribute.split(' ')[-1]
+                if "Calcium" in attribute.get_text():
+                    next_attribute = nutrition_info[nutrition_info.index(attribute) + 1].get_text()
+                    item_object['nutrition']['calcium'] = next_attribute.split(' ')[-1]
+                if "Iron" in attribute.get_text():
+                    next_attribute = nutrition_info[nutrition_info.index(attribute) + 1].get_text()
+                    item_object['nutrition']['iron'] = next_attribute.split(' ')[-1]
+            menus[meal_time][station].append(item_object)
+    
+    dining_hall_info['menus'] = menus
+    return dining_hall_info
+
+# Nutrition rows as (label, field, how the value is read); mirrors _parse_menu_soup
+NUTRITION_FIELDS = (
+    ('Serving Size', 'serving_size', 'serving_size'),
+    ('Calories', 'calories', 'same_cell'),
+    ('Total Fat', 'total_fat', 'same_cell'),
+    ('Saturated Fat', 'saturated_fat', 'same_cell'),
+    ('Trans Fat', 'trans_fat', 'same_cell'),
+    ('Cholesterol', 'cholesterol', 'same_cell'),
+    ('Sodium', 'sodium', 'same_cell'),
+    ('Total Carbohydrate', 'total_carbohydrate', 'same_cell'),
+    ('Dietary Fiber', 'dietary_fiber', 'same_cell'),
+    ('Sugars', 'sugars', 'same_cell'),
+    ('Protein', 'protein', 'same_cell'),
+    ('Vitamin A', 'vitamin_a', 'next_cell'),
+    ('Vitamin C', 'vitamin_c', 'next_cell'),
+    ('Calcium', 'calcium', 'next_cell'),
+    ('Iron', 'iron', 'next_cell'),
+)
+
+# Elements BeautifulSoup's html.parser builder closes as soon as they open
+_VOID_TAGS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem',
+    'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+    'image', 'isindex', 'nextid', 'spacer',
+])
+_RAW_TEXT_END_RES = {tag: re.compile(r'</%s' % tag, re.I) for tag in ('script', 'style')}
+_ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+_TOKEN_RE = re.compile(
+    r'<!--.*?-->|<![^>]*>|<\?[^>]*>'
+    r'|<(/?)([a-zA-Z][^\s/>]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>',
+    re.S,
+)
+_CLASS_RE = re.compile(r'\bclass\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))', re.I)
+_ID_RE = re.compile(r'\bid\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))', re.I)
+
+
+def _attribute(pattern, attrs):
+    match = pattern.search(attrs)
+    if not match:
+        return ''
+    return next(group for group in match.groups() if group is not None)
+
+def _text(chunks):
+    """Equivalent of Tag.get_text() over the strings collected for an element."""
+    return ''.join(chunks)
+
+def _stripped_text(chunks):
+    """Equivalent of Tag.get_text(strip=True)."""
+    return ''.join(chunk.strip() for chunk in chunks)
+
+def _read_nutrition(cells):
+    nutrition = {}
+    for index, text in enumerate(cells):
+        for label, field, source in NUTRITION_FIELDS:
+            if label not in text:
+                continue
+            if source == 'serving_size':
+                nutrition[field] = text.split('(')[-1][:-2]
+            elif source == 'same_cell':
+                nutrition[field] = text.split(' ')[-1]
+            else:
+                nutrition[field] = cells[index + 1].split(' ')[-1]
+    return nutrition
+
+def _parse_menu_single_pass(html_content, date):
+    """Parse a dining hall page in one forward pass over its tags.
+
+    Walks the document in order, tracking the current meal (h3), station (h4),
+    item name and trait list as they appear instead of searching backwards for
+    them. Strings are normalized the way BeautifulSoup's html.parser builder
+    does, so the result is identical to _parse_menu_soup.
+    """
+    menus = {'Breakfast': {}, 'Lunch': {}, 'Brunch': {}, 'Dinner': {}}
+    dining_hall_name = None
+
+    # Open elements as [tag, role, chunks]; mirrors the BeautifulSoup tree stack
+    stack = []
+    captures = []
+    pending = []
+    in_items_region = 0
+    in_section = 0
+    in_traits = 0
+
+    meal_time = station = item_name = None
+    traits = []
+    section_items = None
+    item = None
+
+    def start_capture(tag, role):
+        chunks = []
+        stack.append([tag, role, chunks])
+        captures.append(chunks)
+
+    def flush_text(text):
+        if not text or not captures:
+            return
+        text = html.unescape(text)
+        if not text.strip(_ASCII_SPACES):
+            text = '\n' if '\n' in text else ' '
+        for chunks in captures:
+            chunks.append(text)
+
+    def close(entry):
+        nonlocal dining_hall_name, meal_time, station, item_name, item
+        nonlocal in_items_region, in_section, in_traits
+        tag, role, chunks = entry
+        if chunks is not None:
+            captures.remove(chunks)
+        if role is None:
+            return
+        if role == 'title':
+            if dining_hall_name is None:
+                dining_hall_name = _stripped_text(chunks)
+        elif role == 'meal':
+            meal_time = _stripped_text(chunks)
+        elif role == 'station':
+            station = _stripped_text(chunks)
+        elif role == 'item_name':
+            item_name = _stripped_text(chunks)
+        elif role == 'trait':
+            traits.append(_stripped_text(chunks))
+        elif role == 'allergen':
+            if item is not None:
+                item['allergens'].append(_stripped_text(chunks))
+        elif role == 'cell':
+            if item is not None:
+                item['cells'].append(_text(chunks))
+        elif role == 'allergens':
+            item['in_allergens'] = False
+        elif role == 'items_region':
+            in_items_region -= 1
+        elif role == 'section':
+            in_section -= 1
+        elif role == 'traits':
+            in_traits -= 1
+        elif role == 'item':
+            if item['item_name'] != "No Service":
+                section_items.append({
+                    'item_name': item['item_name'],
+                    'traits': item['traits'],
+                    'allergens': item['allergens'],
+                    'nutrition': _read_nutrition(item['cells']),
+                })
+            item = None
+
+    position = 0
+    length = len(html_content)
+    while position < length:
+        match = _TOKEN_RE.search(html_content, position)
+        if match is None:
+            flush_text(html_content[position:])
+            break
+        flush_text(html_content[position:match.start()])
+        position = match.end()
+        tag = match.group(2)
+        if tag is None:
+            # Comments, doctypes and processing instructions only split strings
+            continue
+        tag = tag.lower()
+
+        if match.group(1):
+            for index in range(len(stack) - 1, -1, -1):
+                if stack[index][0] == tag:
+                    while len(stack) > index:
+                        close(stack.pop())
+                    break
             continue
 
-        with open(day_menu_htmls_dir + '/' + file_path, 'r') as file:
-            html_content = file.read()
-
-        dining_hall_info = {}
-
-        # Parse the HTML
-        soup = BeautifulSoup(html_content, 'html.parser')
-        dining_hall_name = soup.find('title').get_text(strip=True)
-        dining_hall_info['dining_hall'] = dining_hall_name.split(' | ')[0].strip()
-        dining_hall_info['last_updated'] = date
-
-        # Initialize a dictionary to store the menu data
-        menus = {'Breakfast': {}, 'Lunch': {}, 'Brunch': {}, 'Dinner': {}}
-
-        menu_items = soup.find('div', id="mdining-items") 
-        sections = list(menu_items.find_all('ul', class_="items")) 
-        for section in sections:
-            meal_time = section.find_previous('h3').get_text(strip=True)
-
-
-            station = section.find_previous('h4').get_text(strip=True)
-            menus[meal_time][station] = []
-
-            items = list(section.find_all('div', class_="nutrition-wrapper"))
-            for item in items:
-                item_object = {}
-                item_name = item.find_previous('div', class_="item-name").get_text(strip=True)
-                item_object['item_name'] = item_name
-                traits = item.find_previous('ul', class_="traits")
-                item_object['traits'] = [trait.get_text(strip=True) for trait in traits.find_all('li')]
-                
-                allergens_div = item.find('div', class_='allergens')
-                if allergens_div:
-                    allergens_list = allergens_div.find_all('li')
-                    item_object['allergens'] = [allergen.get_text(strip=True) for allergen in allergens_list]
-                else:
-                    item_object['allergens'] = []
-                
-                if item_name == "No Service":
-                    continue
-                item_object['nutrition'] = {}
-
-                nutrition_info = list(item.find_all('td'))
-                for attribute in nutrition_info:
-                    if "Serving Size" in attribute.get_text():
-                        item_object['nutrition']['serving_size'] = attribute.get_text().split('(')[-1][:-2]
-                    if "Calories" in attribute.get_text():
-                        item_object['nutrition']['calories'] = attribute.get_text().split(' ')[-1]
-                    if "Total Fat" in attribute.get_text():
-                        item_object['nutrition']['total_fat'] = attribute.get_text().split(' ')[-1]
-                    if "Saturated Fat" in attribute.get_text():
-                        item_object['nutrition']['saturated_fat'] = attribute.get_text().split(' ')[-1]
-                    if "Trans Fat" in attribute.get_text():
-                        item_object['nutrition']['trans_fat'] = attribute.get_text().split(' ')[-1]
-                    if "Cholesterol" in attribute.get_text():
-                        item_object['nutrition']['cholesterol'] = attribute.get_text().split(' ')[-1]
-                    if "Sodium" in attribute.get_text():
-                        item_object['nutrition']['sodium'] = attribute.get_text().split(' ')[-1]
-                    if "Total Carbohydrate" in attribute.get_text():
-                        item_object['nutrition']['total_carbohydrate'] = attribute.get_text().split(' ')[-1]
-                    if "Dietary Fiber" in attribute.get_text():
-                        item_object['nutrition']['dietary_fiber'] = attribute.get_text().split(' ')[-1]
-                    if "Sugars" in attribute.get_text():
-                        item_object['nutrition']['sugars'] = attribute.get_text().split(' ')[-1]
-                    if "Protein" in attribute.get_text():
-                        item_object['nutrition']['protein'] = attribute.get_text().split(' ')[-1]
-                    if "Vitamin A" in attribute.get_text():
-                        next_attribute = nutrition_info[nutrition_info.index(attribute) + 1].get_text()
-                        item_object['nutrition']['vitamin_a'] = next_attribute.split(' ')[-1]
-                    if "Vitamin C" in attribute.get_text():
-                        next_attribute = nutrition_info[nutrition_info.index(attribute) + 1].get_text()
-                        item_object['nutrition']['vitamin_c'] = next_attribute.split(' ')[-1]
-                    if "Calcium" in attribute.get_text():
-                        next_attribute = nutrition_info[nutrition_info.index(attribute) + 1].get_text()
-                        item_object['nutrition']['calcium'] = next_attribute.split(' ')[-1]
-                    if "Iron" in attribute.get_text():
-                        next_attribute = nutrition_info[nutrition_info.index(attribute) + 1].get_text()
-                        item_object['nutrition']['iron'] = next_attribute.split(' ')[-1]
-                menus[meal_time][station].append(item_object)
-        
-        dining_hall_info['menus'] = menus
-        all_info.append(dining_hall_info)
-
-
-        file_path = os.path.join(output_dir, "dining_hall_info.json")
-        if os.path.exists(file_path):
-            existing_data = json.load(open(file_path))
-            existing_data[date] = all_info
-            json.dump(existing_data, open(file_path, 'w'), indent=4)
+        attrs = match.group(3)
+        role = None
+        if tag == 'div':
+            classes = _attribute(_CLASS_RE, attrs).split()
+            if _attribute(_ID_RE, attrs) == 'mdining-items':
+                role = 'items_region'
+                in_items_region += 1
+            elif 'item-name' in classes:
+                role = 'item_name'
+            elif 'nutrition-wrapper' in classes and in_section and item is None:
+                role = 'item'
+                item = {'item_name': item_name, 'traits': list(traits), 'allergens': [],
+                        'cells': [], 'in_allergens': False, 'seen_allergens': False}
+            elif 'allergens' in classes and item is not None and not item['seen_allergens']:
+                role = 'allergens'
+                item['in_allergens'] = item['seen_allergens'] = True
+        elif tag == 'ul':
+            classes = _attribute(_CLASS_RE, attrs).split()
+            if 'items' in classes and in_items_region:
+                role = 'section'
+                in_section += 1
+                section_items = menus[meal_time][station] = []
+            elif 'traits' in classes:
+                role = 'traits'
+                in_traits += 1
+                traits = []
+        elif tag == 'li':
+            if item is not None and item['in_allergens']:
+                role = 'allergen'
+            elif in_traits:
+                role = 'trait'
+        elif tag == 'td':
+            if item is not None:
+                role = 'cell'
+        elif tag == 'h3':
+            role = 'meal'
+        elif tag == 'h4':
+            role = 'station'
+        elif tag == 'title':
+            role = 'title'
+
+        if role in ('items_region', 'section', 'traits', 'allergens'):
+            stack.append([tag, role, None])
+        elif role is not None:
+            start_capture(tag, role)
         else:
-            with open(file_path, 'w') as file:
-                data = {date: all_info}
-                json.dump(data, file, indent=4)
-                logger.info(f"Data saved successfully to {file_path}")
-    
-    return json.load(open(output_dir + '/dining_hall_info.json'))[date]
-
-def currently_serving():
-    dining_halls = [
-        'Bursley',
-        'East Quad',
-        'Markley',
-        'Mosher-Jordan',
-        'North Quad',
-        'South Quad'
-    ]
-
-    time = get_current_time_est().strftime('%H:%M')
-    time = '19:00' # for testing
-    dining_hall_hours = json.load(open(data_dir + '/static_info/dining_hall_hours.json'))
-    days_translation = {
-        'Sunday': 0,
-        'Monday': 1,
-        'Tuesday': 2,
-        'Wednesday': 3,
-        'Thursday': 4,
-        'Friday': 5,
-        'Saturday': 6
+            stack.append([tag, None, None])
+
+        if tag in _VOID_TAGS or attrs.endswith('/'):
+            close(stack.pop())
+        elif tag in _RAW_TEXT_END_RES:
+            end = _RAW_TEXT_END_RES[tag].search(html_content, position)
+            position = length if end is None else end.start()
+
+    while stack:
+        close(stack.pop())
+
+    return {
+        'dining_hall': dining_hall_name.split(' | ')[0].strip(),
+        'last_updated': date,
+        'menus': menus,
     }
 
-    hours = int(time.split(':')[0])
-    minutes = int(time.split(':')[1]) / 60
+# Parser engines selectable through parse_menu_html(engine=...). They give identical results, and
+# fetch_dining_hall_info reuses pages parsed before by content hash, so it always uses the default
+PARSER_ENGINES = {
+    'soup': _parse_menu_soup,
+    'single_pass': _parse_menu_single_pass,
+}
+DEFAULT_PARSER_ENGINE = 'single_pass'
+
+def parse_menu_html(html_content, date, engine=None):
+    """Parse one dining hall page into its name, date and menus."""
+    engine = engine or DEFAULT_PARSER_ENGINE
+    with metrics.timer('parse', engine):
+        return PARSER_ENGINES[engine](html_content, date)
+
+# Parsed pages kept in memory, keyed by the hash of their HTML
+PARSED_PAGES_MAX = len(DINING_HALLS) * 2 * MENU_CACHE_MAX_DATES
+_parsed_pages = OrderedDict()
+_parsed_pages_lock = threading.Lock()
+
+def parse_page(html_content, date):
+    """Return (content hash, parsed hall) for a page, parsing only HTML not seen before.
+
+    Parsed pages are kept by content hash in memory and in the menu store, so
+    a page that did not change is never parsed again.
+    """
+    content_hash = page_hash(html_content)
+    with _parsed_pages_lock:
+        hall = _parsed_pages.get(content_hash)
+        if hall is not None:
+            _parsed_pages.move_to_end(content_hash)
+    metrics.cache_lookup('pages', hall is not None)
+    if hall is None:
+        hall = menu_store.load_page(content_hash)
+        if hall is None:
+            hall = parse_menu_html(html_content, date)
+            menu_store.save_page(content_hash, hall)
+        with _parsed_pages_lock:
+            _parsed_pages[content_hash] = hall
+            while len(_parsed_pages) > PARSED_PAGES_MAX:
+                _parsed_pages.popitem(last=False)
+    if hall['last_updated'] != date:
+        hall = dict(hall, last_updated=date)
+    return content_hash, hall
+
+def diff_menus(previous, current):
+    """Describe how two versions of a day's menus differ.
+
+    Returns {hall: {"change": "added" | "removed" | "changed", "meals": {meal: [stations]}}}
+    with only the halls, meals and stations that differ; an empty dict means
+    nothing changed.
+    """
+    before = {hall['dining_hall']: hall for hall in previous}
+    after = {hall['dining_hall']: hall for hall in current}
+    report = {}
+    for name in sorted(before.keys() | after.keys()):
+        old, new = before.get(name), after.get(name)
+        if old is new:
+            continue
+        old_menus = old['menus'] if old else {}
+        new_menus = new['menus'] if new else {}
+        meals = {}
+        for meal in sorted(old_menus.keys() | new_menus.keys()):
+            old_stations, new_stations = old_menus.get(meal, {}), new_menus.get(meal, {})
+            stations = sorted(station for station in old_stations.keys() | new_stations.keys()
+                              if old_stations.get(station) != new_stations.get(station))
+            if stations:
+                meals[meal] = stations
+        if old is None or new is None or meals:
+            report[name] = {"change": "added" if old is None else "removed" if new is None else "changed", "meals": meals}
+    return report
+
+_change_listeners = []
+
+def on_menus_changed(listener):
+    """Call `listener(date, report)` whenever a re-parse changes a date's menus (see diff_menus)."""
+    _change_listeners.append(listener)
+
+def _notify_menus_changed(date, report):
+    logger.info(f"Menus for {date} changed: {json.dumps(report)}")
+    for listener in _change_listeners:
+        try:
+            listener(date, report)
+        except Exception as e:
+            logger.error(f"Error handling changed menus for {date}: {e}")
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Return the shared pooled session used to download menu pages."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(total=FETCH_RETRIES, backoff_factor=0.5,
+                          status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+            adapter = HTTPAdapter(pool_connections=FETCH_MAX_WORKERS, pool_maxsize=FETCH_MAX_WORKERS,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+def menu_page_url(hall, date, base_url=None):
+    return (base_url or MENU_BASE_URL) + hall.lower().replace(' ', '-') + f'/?menuDate={date}'
+
+def load_page_validators(day_menu_htmls_dir):
+    path = os.path.join(day_menu_htmls_dir, VALIDATORS_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable validators file {path}: {e}")
+        return {}
+
+def save_page_validators(day_menu_htmls_dir, validators):
+    path = os.path.join(day_menu_htmls_dir, VALIDATORS_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(validators, file)
+    os.replace(tmp_path, path)
+
+def _download_menu_page(session, url, file_path, validators, timeout):
+    """Conditionally GET one page; returns (status, new validators)."""
+    headers = {}
+    if validators and os.path.exists(file_path):
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
 
-    date = days_translation[get_current_time_est().strftime('%A')]
+    try:
+        response = session.get(url, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        logger.error(f"Failed to download {url}: {e}")
+        return 'failed', validators
+
+    if response.status_code == 304:
+        logger.debug(f"{url} not modified")
+        return 'not_modified', validators
+    if response.status_code != 200:
+        logger.error(f"Failed to retrieve {url}. Status code: {response.status_code}")
+        return 'failed', validators
+
+    new_validators = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+    content = response.text
+    if os.path.exists(file_path):
+        with open(file_path, 'r', encoding='utf-8') as file:
+            if file.read() == content:
+                # Leave the file untouched so its mtime (and the menu cache) stay valid
+                return 'unchanged', new_validators
+
+    # The day's directory only appears once it has a page in it
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(content)
+    os.replace(tmp_path, file_path)
+    logger.info(f"Page saved successfully to {file_path}")
+    return 'updated', new_validators
+
+@metrics.timed('scrape')
+def download_menu_pages(dates, halls=None, base_url=None, max_workers=None, session=None, timeout=None):
+    """Download the menu pages of several halls and dates concurrently.
+
+    Requests go through one pooled session and send If-None-Match /
+    If-Modified-Since from the validators saved next to each day's HTML, so
+    pages that have not changed are neither transferred nor rewritten.
+    Returns {(date, hall): status} with status one of 'updated', 'unchanged',
+    'not_modified' or 'failed'.
+    """
+    halls = halls or DINING_HALLS
+    session = session or get_http_session()
+    timeout = timeout or FETCH_TIMEOUT
+
+    jobs = []
+    day_validators = {}
+    for date in dates:
+        day_menu_htmls_dir = os.path.join(menu_htmls_dir, date)
+        day_validators[date] = load_page_validators(day_menu_htmls_dir)
+        for hall in halls:
+            file_name = hall.lower().replace(' ', '-') + '.html'
+            jobs.append((date, hall, file_name, menu_page_url(hall, date, base_url),
+                         os.path.join(day_menu_htmls_dir, file_name)))
+
+    with ThreadPoolExecutor(max_workers=max_workers or FETCH_MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(_download_menu_page, session, url, file_path,
+                            day_validators[date].get(file_name), timeout)
+            for date, hall, file_name, url, file_path in jobs
+        ]
+        results = {}
+        for (date, hall, file_name, _, _), future in zip(jobs, futures):
+            status, validators = future.result()
+            results[(date, hall)] = status
+            if validators:
+                day_validators[date][file_name] = validators
+
+    for date, validators in day_validators.items():
+        # Validators without pages would make the next attempt send conditional requests for nothing
+        if validators and menu_archive.has_day(os.path.join(menu_htmls_dir, date)):
+            save_page_validators(os.path.join(menu_htmls_dir, date), validators)
+    return results
 
-    current_time = hours + minutes
+def webscraping_needed(date):
+        if menu_archive.has_day(os.path.join(menu_htmls_dir, date)):
+            logger.info("Data is up to date, no need to scrape.")
+            return False
+        logger.info("Data is not up to date, scraping is needed.")
+        return True
 
-    current_serving = "Dining hall serving statuses: \n\n"
+_current_date = None
+# When each date last came back without any pages
+_download_failures = {}
 
-    for hall in dining_halls:
-        hours_each_day = list(dining_hall_hours[hall].keys())
-        current_hours = None
-        for day in hours_each_day:
-            day_interval = None
-            if '-' in day:
-                beginning = days_translation[day.split('-')[0].strip()]
-                end = days_translation[day.split('-')[1].strip()]
-                day_interval = (beginning, end)
-            else:
-                beginning = days_translation[day]
-                end = days_translation[day]
-                day_interval = (beginning, end)
-
-            if date >= day_interval[0] and date <= day_interval[1]:
-                current_hours = dining_hall_hours[hall][day]
-                break
-
-        if current_hours:
-            if 'Breakfast' in current_hours and current_time >= current_hours['Breakfast'][0] and current_time <= current_hours['Breakfast'][1]:
-                current_serving += f"{hall} is currently serving breakfast: {current_hours['Breakfast']}\n"
-            elif 'Lunch' in current_hours and current_time >= current_hours['Lunch'][0] and current_time <= current_hours['Lunch'][1]:
-                current_serving += f"{hall} is currently serving lunch: {current_hours['Lunch']}\n"
-            elif 'Brunch' in current_hours and current_time >= current_hours['Brunch'][0] and current_time <= current_hours['Brunch'][1]:
-                current_serving += f"{hall} is currently serving brunch: {current_hours['Brunch']}\n"
-            elif 'Dinner' in current_hours and current_time >= current_hours['Dinner'][0] and current_time <= current_hours['Dinner'][1]:
-                current_serving += f"{hall} is currently serving dinner: {current_hours['Dinner']}\n"
-            else:
-                current_serving += f"{hall} is currently closed.\n"
-        else:
-            current_serving += f"{hall} is currently closed.\n"
+def current_date():
+    """The date whose menus are served by default.
 
-    return current_serving
+    The prefetcher switches it at midnight once the new day is warm; until
+    something sets it, it is today's date.
+    """
+    return _current_date or get_current_time_est().strftime('%Y-%m-%d')
 
-def currently_serving_dict():
-    dining_halls = [
-        'Bursley',
-        'East Quad',
-        'Markley',
-        'Mosher-Jordan',
-        'North Quad',
-        'South Quad'
-    ]
-
-    time = get_current_time_est().strftime('%H:%M')
-    time = '19:00' # for testing
-    dining_hall_hours = json.load(open(data_dir + '/static_info/dining_hall_hours.json'))
-    days_translation = {
-        'Sunday': 0,
-        'Monday': 1,
-        'Tuesday': 2,
-        'Wednesday': 3,
-        'Thursday': 4,
-        'Friday': 5,
-        'Saturday': 6
-    }
+def set_current_date(date):
+    global _current_date
+    _current_date = date
 
-    hours = int(time.split(':')[0])
-    minutes = int(time.split(':')[1]) / 60
+def fetch_dining_hall_info(date=None, force_update=False):
+    """Return the parsed menus of every dining hall for a date (default: the current date), from cache, store or the HTML pages."""
+    with metrics.timer('menus', 'fetch_dining_hall_info'):
+        return _load_dining_hall_info(date or current_date(), force_update)
 
-    date = days_translation[get_current_time_est().strftime('%A')]
+def _load_dining_hall_info(date, force_update):
 
-    current_time = hours + minutes
+    day_menu_htmls_dir = os.path.join(menu_htmls_dir, date)
+    if date:
+        date = date
+        day_menu_htmls_dir = os.path.join(menu_htmls_dir, date)
 
-    current_serving_dict = {}
+    if not force_update:
+        signature = menu_files_signature(day_menu_htmls_dir)
+        cached = menu_cache.get(date, signature)
+        if cached is not None:
+            return cached
+        if signature is None:
+            # The retention policy deleted the pages, leaving only the parsed menus
+            stored = menu_store.load_day(date)
+            if stored:
+                menu_cache.put(date, None, stored)
+                return stored
+        published = _load_published(date, signature)
+        if published is not None:
+            return published
+
+    # One process parses a date at a time; the others wait, then map its snapshot
+    with menu_snapshot.publishing(date):
+        if not force_update:
+            published = _load_published(date, menu_files_signature(day_menu_htmls_dir))
+            if published is not None:
+                return published
+
+        if force_update or (webscraping_needed(date)
+                            and time.time() - _download_failures.get(date, 0) >= DOWNLOAD_RETRY_SECONDS):
+            download_menu_pages([date])
+
+        all_info = []
+        pages = {}
+
+        # Load the HTML, whether plain, gzipped or in a weekly archive
+        for _, html_content in menu_archive.read_pages(day_menu_htmls_dir):
+            content_hash, dining_hall_info = parse_page(html_content, date)
+            pages[dining_hall_info['dining_hall']] = content_hash
+            all_info.append(dining_hall_info)
+
+        if not all_info:
+            # Nothing to parse; store nothing, so the day is downloaded again later
+            logger.warning(f"No menu pages for {date}")
+            _download_failures[date] = time.time()
+            return []
+        _download_failures.pop(date, None)
+
+        signature = menu_files_signature(day_menu_htmls_dir)
+        stored_pages = menu_store.day_pages(date)
+        previous = menu_cache.latest(date) or (menu_store.load_day(date) if stored_pages else None)
+        unchanged = previous is not None and stored_pages == pages
+        if unchanged:
+            # Same pages as before, so keep the same menus and every cache built from them
+            logger.info(f"Menus for {date} are unchanged")
+            all_info = previous
+        snapshot = menu_snapshot.open_current(date)
+        if not unchanged or snapshot is None or snapshot.signature != signature:
+            menu_store.save_day(date, all_info, signature, pages)
+            menu_snapshot.publish(date, signature, all_info)
+        menu_cache.put(date, signature, all_info)
+        if not unchanged and previous is not None:
+            report = diff_menus(previous, all_info)
+            if report:
+                _notify_menus_changed(date, report)
+        return all_info
+
+def _load_published(date, signature):
+    """Return the menus parsed from HTML with `signature` by any process, or None."""
+    if not signature:
+        return None
+    previous = menu_cache.latest(date)
+    snapshot = menu_snapshot.open_current(date)
+    if snapshot is not None and snapshot.signature == signature:
+        menus = snapshot.menus()
+    else:
+        menus = menu_store.load_day(date, signature)
+        if menus is None:
+            return None
+        # Publish it so the other workers map it instead of each reading the store
+        menu_snapshot.publish(date, signature, menus)
+    menu_cache.put(date, signature, menus)
+    # Another process re-parsed the day; this one still has to drop what changed
+    if previous is not None and previous is not menus:
+        report = diff_menus(previous, menus)
+        if report:
+            _notify_menus_changed(date, report)
+    return menus
+
+def fetch_menu_snapshot(date=None):
+    """Return the current menu snapshot for a date, loading and publishing the menus first if needed.
+
+    Returns None if no snapshot matches the HTML files on disk.
+    """
+    date = date or current_date()
+    signature = menu_files_signature(os.path.join(menu_htmls_dir, date))
+    snapshot = menu_snapshot.open_current(date)
+    if snapshot is None or snapshot.signature != signature:
+        fetch_dining_hall_info(date)
+        signature = menu_files_signature(os.path.join(menu_htmls_dir, date))
+        snapshot = menu_snapshot.open_current(date)
+    if snapshot is None or snapshot.signature != signature:
+        return None
+    return snapshot
+
+@metrics.timed('hours')
+def currently_serving(at=None):
+    """Describe what every dining hall is serving at `at` (default: now)."""
+    at = at or get_current_time_est()
+    statuses = dining_hours.get_schedule().statuses(at)
 
-    for hall in dining_halls:
-        hours_each_day = list(dining_hall_hours[hall].keys())
-        current_hours = None
-        for day in hours_each_day:
-            day_interval = None
-            if '-' in day:
-                beginning = days_translation[day.split('-')[0].strip()]
-                end = days_translation[day.split('-')[1].strip()]
-                day_interval = (beginning, end)
-            else:
-                beginning = days_translation[day]
-                end = days_translation[day]
-                day_interval = (beginning, end)
-
-            if date >= day_interval[0] and date <= day_interval[1]:
-                current_hours = dining_hall_hours[hall][day]
-                break
-
-        if current_hours:
-            if 'Breakfast' in current_hours and current_time >= current_hours['Breakfast'][0] and current_time <= current_hours['Breakfast'][1]:
-                current_serving_dict[hall] = 'Currently serving breakfast'
-            elif 'Lunch' in current_hours and current_time >= current_hours['Lunch'][0] and current_time <= current_hours['Lunch'][1]:
-                current_serving_dict[hall] = 'Currently serving lunch'
-            elif 'Brunch' in current_hours and current_time >= current_hours['Brunch'][0] and current_time <= current_hours['Brunch'][1]:
-                current_serving_dict[hall] = 'Currently serving brunch'
-            elif 'Dinner' in current_hours and current_time >= current_hours['Dinner'][0] and current_time <= current_hours['Dinner'][1]:
-                current_serving_dict[hall] = 'Currently serving dinner'
-            else:
-                current_serving_dict[hall] = 'Currently closed'
+    current_serving = "Dining hall serving statuses: \n\n"
+    for hall in DINING_HALLS:
+        status = statuses.get(hall)
+        if status:
+            meal, interval = status
+            current_serving += f"{hall} is currently serving {meal.lower()}: {interval}\n"
+        else:
+            current_serving += f"{hall} is currently closed.\n"
+
+    return current_serving
+
+@metrics.timed('hours')
+def currently_serving_dict(at=None):
+    """Map every dining hall to its serving status at `at` (default: now)."""
+    at = at or get_current_time_est()
+    statuses = dining_hours.get_schedule().statuses(at)
+
+    current_serving_dict = {}
+    for hall in DINING_HALLS:
+        status = statuses.get(hall)
+        if status:
+            current_serving_dict[hall] = f'Currently serving {status[0].lower()}'
         else:
             current_serving_dict[hall] = 'Currently closed'
 
-    return current_serving_dict
\ No newline at end of file
+    return current_serving_dict
@@ -0,0 +1,248 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock; msvcrt locks the first byte of the lock file instead
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+snapshot_dir = os.path.join(this_dir, 'output', 'snapshots')
+
+MAGIC = b'MDSNAP1\n'
+# Sections start on this boundary
+ALIGNMENT = 8
+# Number of dates whose snapshots stay mapped in each process
+SNAPSHOT_MAX_DATES = 7
+
+os.makedirs(snapshot_dir, exist_ok=True)
+
+_bodies = {}
+_section_builders = {}
+
+
+def register_body(name, build):
+    """Serialize `build(menus)` into every snapshot published from now on.
+
+    `build` returns (tag, {encoding or None: bytes}), the representations of
+    one response body, so workers can send it without decoding the menus.
+    """
+    _bodies[name] = build
+
+def register_sections(name, build):
+    """Add the sections `build(menus)` returns, a {section: bytes} dict, to every snapshot published from now on.
+
+    For data derived from the menus that workers read in place, such as
+    arrays they cast with memoryview.
+    """
+    _section_builders[name] = build
+
+def _section_name(name, encoding):
+    return f'body:{name}:{encoding}' if encoding else f'body:{name}'
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        # Windows refuses to delete a file some process still maps; a later publish retries
+        logger.debug(f"Could not remove {path}: {e}")
+
+def _pointer_path(date):
+    return os.path.join(snapshot_dir, f'{date}.current')
+
+
+class Snapshot:
+    """One date's published menus, mapped read-only.
+
+    The file is a magic line, the header length, a JSON header naming each
+    section's offset and length, then the sections. The pages of the mapping
+    are shared by every process that maps the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        if view[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a menu snapshot")
+        header_length = int.from_bytes(view[len(MAGIC):len(MAGIC) + 8], 'little')
+        header_end = len(MAGIC) + 8 + header_length
+        header = json.loads(bytes(view[len(MAGIC) + 8:header_end]))
+        data_start = -(-header_end // ALIGNMENT) * ALIGNMENT
+        self.date = header['date']
+        self.signature = tuple(tuple(entry) for entry in header['signature']) if header['signature'] else None
+        self.tags = header['tags']
+        self._sections = {name: view[data_start + offset:data_start + offset + length]
+                          for name, (offset, length) in header['sections'].items()}
+        self._menus = None
+        self._lock = threading.Lock()
+
+    def menus(self):
+        """The parsed menus, decoded on first use in this process."""
+        with self._lock:
+            if self._menus is None:
+                self._menus = json.loads(bytes(self._sections['menus']))
+            return self._menus
+
+    def section(self, name):
+        """A memoryview of a section added by register_sections, or None if it has none."""
+        return self._sections.get(name)
+
+    def representations(self, name):
+        """Return (tag, {encoding or None: memoryview}) of a published body, or None."""
+        if name not in self.tags:
+            return None
+        prefix = _section_name(name, None)
+        encoded = {None: self._sections[prefix]}
+        for section, data in self._sections.items():
+            if section.startswith(prefix + ':'):
+                encoded[section[len(prefix) + 1:]] = data
+        return self.tags[name], encoded
+
+
+def publish(date, signature, menus):
+    """Write a snapshot of `menus` and make it the current one for `date`.
+
+    Readers that still map the previous snapshot keep using it until they
+    look again; its file is unlinked, which leaves their mapping intact.
+    """
+    sections = [('menus', json.dumps(menus, separators=(',', ':')).encode())]
+    tags = {}
+    for name, build in _bodies.items():
+        tags[name], encoded = build(menus)
+        sections.extend((_section_name(name, encoding), data) for encoding, data in encoded.items())
+    for build in _section_builders.values():
+        sections.extend(build(menus).items())
+
+    layout = {}
+    offset = 0
+    for name, data in sections:
+        layout[name] = [offset, len(data)]
+        offset = -(-(offset + len(data)) // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({
+        'date': date,
+        'signature': [list(entry) for entry in signature] if signature else None,
+        'tags': tags,
+        'sections': layout,
+    }).encode()
+
+    digest = hashlib.sha256(header)
+    for _, data in sections:
+        digest.update(data)
+    file_name = f'{date}.{digest.hexdigest()[:16]}.snap'
+    path = os.path.join(snapshot_dir, file_name)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC + len(header).to_bytes(8, 'little') + header)
+        file.write(b'\0' * (-file.tell() % ALIGNMENT))
+        for _, data in sections:
+            file.write(data)
+            file.write(b'\0' * (-file.tell() % ALIGNMENT))
+    os.replace(tmp_path, path)
+
+    pointer_tmp = f'{_pointer_path(date)}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(pointer_tmp, 'w') as file:
+        file.write(file_name)
+    os.replace(pointer_tmp, _pointer_path(date))
+
+    for stale in os.listdir(snapshot_dir):
+        if stale.startswith(f'{date}.') and stale.endswith('.snap') and stale != file_name:
+            _remove(os.path.join(snapshot_dir, stale))
+    logger.info(f"Published menu snapshot {file_name} ({os.path.getsize(path)} bytes)")
+
+    snapshot = open_current(date)
+    # This process already holds the menus, so it need not decode them again
+    if snapshot is not None and snapshot.path == path:
+        with snapshot._lock:
+            snapshot._menus = snapshot._menus or menus
+    return snapshot
+
+
+_mapped = OrderedDict()
+_mapped_lock = threading.Lock()
+
+def open_current(date):
+    """Return the current Snapshot for `date`, or None if none was published.
+
+    The mapping is reused while the date's pointer file is unchanged, so
+    this costs one stat per call.
+    """
+    try:
+        stat = os.stat(_pointer_path(date))
+    except FileNotFoundError:
+        return None
+    version = (stat.st_ino, stat.st_mtime_ns)
+    with _mapped_lock:
+        entry = _mapped.get(date)
+        if entry is not None and entry[0] == version:
+            _mapped.move_to_end(date)
+            return entry[1]
+    try:
+        with open(_pointer_path(date), 'r') as file:
+            snapshot = Snapshot(os.path.join(snapshot_dir, file.read().strip()))
+    except (FileNotFoundError, ValueError) as e:
+        # Replaced again while we were opening it; the next call sees the new one
+        logger.warning(f"Could not open the menu snapshot for {date}: {e}")
+        return None
+    with _mapped_lock:
+        _mapped[date] = (version, snapshot)
+        _mapped.move_to_end(date)
+        while len(_mapped) > SNAPSHOT_MAX_DATES:
+            _mapped.popitem(last=False)
+    return snapshot
+
+def discard(date):
+    """Delete the snapshots of `date`; processes that map one keep their mapping."""
+    for file_name in os.listdir(snapshot_dir):
+        if file_name.startswith(f'{date}.') and (file_name.endswith('.snap') or file_name.endswith('.current')):
+            _remove(os.path.join(snapshot_dir, file_name))
+    with _mapped_lock:
+        _mapped.pop(date, None)
+
+def lock_file(file, blocking=True):
+    """Lock an open file against other processes. Returns False if it is held and `blocking` is off."""
+    if fcntl is not None:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        return True
+    while True:
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(0.05)
+
+def unlock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file, fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def publishing(date):
+    """Hold the lock, shared by every process, on parsing and publishing `date`."""
+    with open(os.path.join(snapshot_dir, f'{date}.lock'), 'w') as file:
+        lock_file(file)
+        try:
+            yield
+        finally:
+            unlock_file(file)
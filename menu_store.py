@@ -0,0 +1,183 @@
+import json
+import os
+import gzip
+import shutil
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+import metrics
+import menu_snapshot
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+output_dir = os.path.join(this_dir, 'output')
+store_dir = os.path.join(output_dir, 'menus')
+index_path = os.path.join(store_dir, 'index.json')
+# Parsed hall pages, named by the SHA-256 of their HTML
+pages_dir = os.path.join(store_dir, 'pages')
+
+# The single file every date used to be merged into
+legacy_output_path = os.path.join(output_dir, 'dining_hall_info.json')
+
+os.makedirs(store_dir, exist_ok=True)
+os.makedirs(pages_dir, exist_ok=True)
+
+# Threads of this process; the index's lock file keeps other processes out while it is rewritten
+_index_lock = threading.Lock()
+
+
+def _shard_path(date):
+    return os.path.join(store_dir, f'{date}.json')
+
+def _write_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+@contextmanager
+def _index_file_lock():
+    """Hold index.json.lock, shared by every process, while the index is read, changed and written."""
+    with open(index_path + '.lock', 'w') as file:
+        menu_snapshot.lock_file(file)
+        try:
+            yield
+        finally:
+            menu_snapshot.unlock_file(file)
+
+def _read_index():
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r') as file:
+        return json.load(file)
+
+def _load_index():
+    """Return the index, splitting the legacy monolithic file on first use."""
+    index = _read_index()
+    if index is None:
+        with _index_file_lock():
+            # Another process may have split it while this one waited
+            index = _read_index()
+            if index is None:
+                index = _migrate_legacy_output()
+    return index
+
+def _migrate_legacy_output():
+    index = {}
+    if os.path.exists(legacy_output_path):
+        logger.info(f"Splitting {legacy_output_path} into per-date files in {store_dir}")
+        with open(legacy_output_path, 'r') as file:
+            legacy_data = json.load(file)
+        for date, halls in legacy_data.items():
+            _write_atomic(_shard_path(date), halls)
+            index[date] = {'halls': len(halls), 'signature': None, 'saved_at': time.time()}
+    _write_atomic(index_path, index)
+    return index
+
+@metrics.timed("store")
+def save_day(date, halls, signature=None, pages=None):
+    """Store one date's parsed menus in its own file and record it in the index.
+
+    `signature` identifies the HTML the menus were parsed from (see
+    menu_scrape.menu_files_signature) so readers can tell whether it is stale.
+    `pages` maps each hall to the content hash of its page; parsed pages no
+    date refers to any more are deleted.
+    """
+    _write_atomic(_shard_path(date), halls)
+    if os.path.exists(_shard_path(date) + '.gz'):
+        os.remove(_shard_path(date) + '.gz')
+    with _index_lock, _index_file_lock():
+        index = _read_index()
+        if index is None:
+            index = _migrate_legacy_output()
+        index[date] = {
+            'halls': len(halls),
+            'signature': [list(entry) for entry in signature] if signature else None,
+            'pages': pages,
+            'saved_at': time.time(),
+        }
+        _write_atomic(index_path, index)
+        if pages is not None:
+            _prune_pages(index)
+    logger.info(f"Menus for {date} saved to {_shard_path(date)}")
+
+def day_pages(date):
+    """Return {hall: content hash} of the stored version of a date, or None."""
+    with _index_lock:
+        entry = _load_index().get(date)
+    return entry.get('pages') if entry else None
+
+def _page_path(content_hash):
+    return os.path.join(pages_dir, f'{content_hash}.json')
+
+def has_page(content_hash):
+    return os.path.exists(_page_path(content_hash))
+
+def save_page(content_hash, hall):
+    _write_atomic(_page_path(content_hash), hall)
+
+def load_page(content_hash):
+    """Load a parsed hall page by the hash of its HTML, or None."""
+    try:
+        with open(_page_path(content_hash), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def _prune_pages(index):
+    referenced = {content_hash for entry in index.values() for content_hash in (entry.get('pages') or {}).values()}
+    for file_name in os.listdir(pages_dir):
+        if file_name.endswith('.json') and file_name[:-len('.json')] not in referenced:
+            os.remove(os.path.join(pages_dir, file_name))
+
+@metrics.timed("store")
+def load_day(date, signature=None):
+    """Load the stored menus for a date, or None if missing.
+
+    When `signature` is given, menus stored from different HTML are treated as
+    missing.
+    """
+    with _index_lock:
+        if signature is not None or not os.path.exists(index_path):
+            entry = _load_index().get(date)
+            if signature is not None and (not entry or entry['signature'] != [list(item) for item in signature]):
+                return None
+    path = _shard_path(date)
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        pass
+    try:
+        with gzip.open(path + '.gz', 'rt') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def compress_day(date):
+    """Gzip a stored date's menus, which load_day reads either way."""
+    path = _shard_path(date)
+    if not os.path.exists(path):
+        return
+    tmp_path = f'{path}.gz.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(path, 'rb') as source, gzip.open(tmp_path, 'wb') as target:
+        shutil.copyfileobj(source, target)
+    os.replace(tmp_path, path + '.gz')
+    os.remove(path)
+
+def has_day(date):
+    """Whether menus with at least one hall are stored for a date."""
+    with _index_lock:
+        entry = _load_index().get(date)
+    return bool(entry and entry['halls'])
+
+def available_dates():
+    """Return the sorted list of dates that have stored menus."""
+    with _index_lock:
+        return sorted(_load_index())
@@ -0,0 +1,146 @@
+import re
+from dataclasses import dataclass
+from datetime import datetime
+
+from menu_context import HALL_ALIASES, MEALS
+
+# Fields of a menu item; nutrition fields can also be picked one by one as nutrition.<name>
+ITEM_FIELDS = ('item_name', 'traits', 'allergens', 'nutrition')
+NUTRITION_FIELDS = (
+    'serving_size', 'calories', 'total_fat', 'saturated_fat', 'trans_fat', 'cholesterol', 'sodium',
+    'total_carbohydrate', 'dietary_fiber', 'sugars', 'protein', 'vitamin_a', 'vitamin_c', 'calcium', 'iron',
+)
+SUMMARY_FIELDS = ('item_name', 'traits', 'allergens')
+DATE_FORMAT = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+class InvalidMenuQuery(ValueError):
+    pass
+
+
+def _names(args, key):
+    """The comma-separated values of a query parameter, which may also be repeated."""
+    values = []
+    for value in args.getlist(key):
+        values.extend(part.strip() for part in value.split(',') if part.strip())
+    return values
+
+
+@dataclass(frozen=True)
+class MenuQuery:
+    """What part of the menus a client asked for. Empty tuples mean everything."""
+    halls: tuple = ()
+    meals: tuple = ()
+    stations: tuple = ()
+    fields: tuple = ()
+    nutrition: tuple = ()
+    date: str = None
+
+    @classmethod
+    def from_args(cls, args):
+        """Parse hall, meal, station, date, fields and summary query parameters."""
+        halls = []
+        for name in _names(args, 'hall'):
+            halls.append(HALL_ALIASES.get(name.lower(), name).lower())
+
+        meals = []
+        for name in _names(args, 'meal'):
+            if name.capitalize() not in MEALS:
+                raise InvalidMenuQuery(f"Unknown meal '{name}', expected one of {', '.join(MEALS)}")
+            meals.append(name.capitalize())
+
+        fields, nutrition = [], []
+        requested = _names(args, 'fields')
+        if args.get('summary') in ('1', 'true'):
+            if requested:
+                raise InvalidMenuQuery("Use either fields or summary, not both")
+            requested = list(SUMMARY_FIELDS)
+        for name in requested:
+            if name.startswith('nutrition.'):
+                if name[len('nutrition.'):] not in NUTRITION_FIELDS:
+                    raise InvalidMenuQuery(f"Unknown nutrition field '{name}'")
+                nutrition.append(name[len('nutrition.'):])
+            elif name in ITEM_FIELDS:
+                fields.append(name)
+            else:
+                raise InvalidMenuQuery(f"Unknown field '{name}', expected one of {', '.join(ITEM_FIELDS)} or nutrition.<field>")
+        # Asking for all of nutrition makes single nutrition fields redundant
+        if 'nutrition' in fields:
+            nutrition = []
+
+        date = args.get('date')
+        if date is not None:
+            try:
+                if not DATE_FORMAT.fullmatch(date):
+                    raise ValueError(date)
+                datetime.strptime(date, '%Y-%m-%d')
+            except ValueError:
+                raise InvalidMenuQuery("Dates must be formatted YYYY-MM-DD")
+
+        return cls(tuple(sorted(set(halls))), tuple(sorted(set(meals))), tuple(sorted({name.lower() for name in _names(args, 'station')})),
+                   tuple(sorted(set(fields))), tuple(sorted(set(nutrition))), date)
+
+    @property
+    def is_everything(self):
+        return not (self.halls or self.meals or self.stations or self.fields or self.nutrition)
+
+    @property
+    def key(self):
+        """A short string naming this query, for cache keys and validators."""
+        parts = [f"{name}={','.join(getattr(self, name))}" for name in ('halls', 'meals', 'stations', 'fields', 'nutrition')
+                 if getattr(self, name)]
+        return ';'.join(parts) or 'all'
+
+    @property
+    def projects(self):
+        """Whether items are cut down to some of their fields."""
+        return bool(self.fields or self.nutrition)
+
+    def wants_hall(self, name):
+        return not self.halls or name.lower() in self.halls
+
+    def wants_meal(self, meal):
+        return not self.meals or meal in self.meals
+
+    def wants_station(self, name):
+        return not self.stations or name.lower() in self.stations
+
+    def project_item(self, item):
+        if not self.projects:
+            return item
+        projected = {field: item[field] for field in self.fields if field in item}
+        if self.nutrition:
+            item_nutrition = item.get('nutrition') or {}
+            projected['nutrition'] = {field: item_nutrition[field] for field in self.nutrition if field in item_nutrition}
+        return projected
+
+    def project_items(self, items):
+        if not self.projects:
+            return items
+        return [self.project_item(item) for item in items]
+
+    def apply(self, dining_halls):
+        """Return the halls, meals, stations and item fields asked for.
+
+        Works on both menu shapes: stations as a {station: items} dict, and as
+        the list of {"station_name", "items"} built for personalized menus.
+        The given halls are never modified, since they may be shared cache entries.
+        """
+        if self.is_everything:
+            return dining_halls
+        result = []
+        for dining_hall in dining_halls:
+            if not self.wants_hall(dining_hall['dining_hall']):
+                continue
+            menus = {}
+            for meal, stations in dining_hall.get('menus', {}).items():
+                if not self.wants_meal(meal):
+                    continue
+                if isinstance(stations, dict):
+                    menus[meal] = {station: self.project_items(items) for station, items in stations.items()
+                                   if self.wants_station(station)}
+                else:
+                    menus[meal] = [dict(station, items=self.project_items(station['items'])) for station in stations
+                                   if self.wants_station(station['station_name'])]
+            result.append(dict(dining_hall, menus=menus))
+        return result
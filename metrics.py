@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Upper bounds of the prompt size histogram, in characters
+SIZE_BUCKETS = (250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+# Each process writes its metrics here so whichever one answers /metrics can report them all
+this_dir = os.path.dirname(os.path.abspath(__file__))
+snapshot_dir = os.path.join(this_dir, 'var', 'metrics')
+PUBLISH_SECONDS = 10
+# Snapshots older than this belong to processes that have gone away
+STALE_SECONDS = 60
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [[list(key), value] for key, value in sorted(self._values.items())]
+
+    def render(self, workers=None):
+        """Render this process's values, or those of every (worker, samples) given, labelled by worker."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if workers is None:
+            for key, value in self.samples():
+                lines.extend(self._sample_lines(self.labelnames, tuple(key), value))
+        else:
+            for worker, samples in workers:
+                for key, value in samples:
+                    lines.extend(self._sample_lines(self.labelnames + ('worker',), tuple(key) + (worker,), value))
+        return lines
+
+    def _sample_lines(self, labelnames, key, value):
+        return [f"{self.name}{_label_text(labelnames, key)} {value}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Cumulative bucket counts, sum and count per label set, as Prometheus expects."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][position] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in sorted(self._values.items())]
+
+    def _sample_lines(self, labelnames, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_label_text(labelnames + ('le',), key + (bound,))} {cumulative}")
+        lines.append(f"{self.name}_bucket{_label_text(labelnames + ('le',), key + ('+Inf',))} {count}")
+        lines.append(f"{self.name}_sum{_label_text(labelnames, key)} {total}")
+        lines.append(f"{self.name}_count{_label_text(labelnames, key)} {count}")
+        return lines
+
+
+REGISTRY = []
+# name -> function returning a JSON-able report, published with the metrics
+REPORTS = {}
+
+STAGE_SECONDS = Histogram('mdining_stage_seconds', "Time spent in each stage of serving a request.", ('stage', 'operation'))
+STAGE_ERRORS = Counter('mdining_stage_errors_total', "Stages that raised an exception.", ('stage', 'operation'))
+CACHE_REQUESTS = Counter('mdining_cache_requests_total', "Cache lookups by result.", ('cache', 'result'))
+LLM_TOKENS = Counter('mdining_llm_tokens_total', "Estimated tokens sent to and received from the model.", ('operation', 'direction'))
+LLM_PROMPT_CHARS = Histogram('mdining_llm_prompt_chars', "Size of prompts sent to the model, history included.", ('operation',), SIZE_BUCKETS)
+LLM_FIRST_TOKEN_SECONDS = Histogram('mdining_llm_first_token_seconds', "Time until a streamed reply's first token.", ('operation',))
+HTTP_REQUEST_SECONDS = Histogram('mdining_http_request_seconds', "Request latency by endpoint.", ('endpoint', 'method', 'status'))
+HTTP_IN_FLIGHT = Gauge('mdining_http_requests_in_flight', "Requests being handled.", ('endpoint',))
+
+
+@contextmanager
+def timer(stage, operation):
+    """Record the time spent in the enclosed block under (stage, operation)."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage, operation=operation)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage, operation=operation)
+
+def timed(stage, operation=None):
+    """Decorator form of timer(); the operation defaults to the function's name."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage, operation or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def cache_lookup(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def report(name, function):
+    """Publish function()'s result with this process's metrics under `name`."""
+    REPORTS[name] = function
+
+def snapshot():
+    reports = {}
+    for name, function in REPORTS.items():
+        try:
+            reports[name] = function()
+        except Exception as e:
+            logger.error(f"Error building the {name} report: {e}")
+    return {"worker": os.getpid(), "published_at": time.time(),
+            "metrics": {metric.name: metric.samples() for metric in REGISTRY}, "reports": reports}
+
+def publish():
+    """Write this process's snapshot where the other workers can read it."""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = os.path.join(snapshot_dir, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(f"{path}.tmp", path)
+
+def worker_snapshots():
+    """Every live worker's latest snapshot, this process's current one included, by worker."""
+    own = snapshot()
+    snapshots = {own["worker"]: own}
+    try:
+        names = os.listdir(snapshot_dir)
+    except FileNotFoundError:
+        names = []
+    current = time.time()
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(snapshot_dir, name)
+        try:
+            with open(path) as f:
+                found = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if found["worker"] in snapshots:
+            continue
+        if current - found["published_at"] > STALE_SECONDS:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        snapshots[found["worker"]] = found
+    return dict(sorted(snapshots.items()))
+
+def render_workers():
+    """Every worker's metrics, each series labelled with the worker's pid."""
+    snapshots = worker_snapshots()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render([(worker, found["metrics"].get(metric.name, [])) for worker, found in snapshots.items()]))
+    return '\n'.join(lines) + '\n'
+
+def start_publishing():
+    """Publish this process's snapshot every PUBLISH_SECONDS from a daemon thread."""
+    def run():
+        while True:
+            try:
+                publish()
+            except Exception as e:
+                logger.error(f"Error publishing metrics: {e}")
+            time.sleep(PUBLISH_SECONDS)
+    threading.Thread(target=run, name='metrics-publisher', daemon=True).start()
@@ -0,0 +1,177 @@
+import os
+import time
+import threading
+import logging
+from datetime import datetime, timedelta
+
+import pytz
+
+import menu_scrape
+import menu_snapshot
+import menu_archive
+from menu_scrape import get_current_time_est as now
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# Days after today whose menus are fetched ahead of time
+PREFETCH_DAYS_AHEAD = int(os.environ.get('PREFETCH_DAYS_AHEAD', 2))
+# Fetched days are revalidated this often; unchanged pages come back as 304s
+REFRESH_SECONDS = 60 * 60
+# A day that could not be fetched is tried again after this long
+RETRY_SECONDS = 5 * 60
+
+timezone = pytz.timezone('America/New_York')
+
+
+def seconds_until_midnight(at):
+    """Seconds from `at` until the next local midnight, DST changes included."""
+    midnight = timezone.localize(datetime.combine(at.date() + timedelta(days=1), datetime.min.time()))
+    return max(0.0, (midnight - at).total_seconds())
+
+
+class Prefetcher:
+    """Keeps the menus of today and the next days downloaded, parsed and warm.
+
+    A background thread fetches each day ahead of time, revalidates it
+    every REFRESH_SECONDS and, at local midnight, switches
+    menu_scrape.current_date to the new day once it is warm, so requests
+    never scrape or parse. Other modules add their own caches to warm with
+    register(). After each rollover, past days' pages are archived as
+    menu_archive's retention policy says, if it is turned on.
+    """
+
+    def __init__(self, days_ahead=PREFETCH_DAYS_AHEAD):
+        self.days_ahead = days_ahead
+        self._warmers = {}
+        self._days = {}
+        self._current = None
+        self._archived = None
+        self._thread = None
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+
+    def register(self, name, warm):
+        """Call `warm(date)` after each day's menus are fetched."""
+        self._warmers[name] = warm
+
+    def dates(self, at):
+        return [(at + timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range(self.days_ahead + 1)]
+
+    def covers(self, date, at=None):
+        """Whether `date` is the current date or one of the days fetched ahead of it."""
+        return date == menu_scrape.current_date() or date in self.dates(at or now())
+
+    def prefetch(self, date):
+        """Download, parse and warm one day. Returns True if it succeeded."""
+        started = time.perf_counter()
+        try:
+            # gunicorn workers take turns, so the later ones get 304s instead of rewriting pages
+            with menu_snapshot.publishing(date):
+                statuses = menu_scrape.download_menu_pages([date])
+            if not menu_scrape.menu_files_signature(os.path.join(menu_scrape.menu_htmls_dir, date)):
+                raise RuntimeError(f"no menu pages could be downloaded ({', '.join(sorted(set(statuses.values())))})")
+            # Parses and publishes the day if no worker has yet; otherwise only maps its snapshot
+            menu_scrape.fetch_menu_snapshot(date)
+            for name, warm in self._warmers.items():
+                warm(date)
+        except Exception as e:
+            logger.error(f"Error prefetching menus for {date}: {e}")
+            with self._lock:
+                self._days[date] = {"ok": False, "error": str(e), "checked_at": time.time(),
+                                    "due_at": time.time() + RETRY_SECONDS}
+            return False
+        seconds = time.perf_counter() - started
+        logger.info(f"Prefetched menus for {date} in {seconds:.2f}s")
+        with self._lock:
+            self._days[date] = {"ok": True, "seconds": round(seconds, 3), "checked_at": time.time(),
+                                "due_at": time.time() + REFRESH_SECONDS}
+        return True
+
+    def run_once(self, at=None):
+        """Prefetch every upcoming day that is due, and forget days that have passed."""
+        dates = self.dates(at or now())
+        with self._lock:
+            for past in [date for date in self._days if date < dates[0]]:
+                del self._days[past]
+            due = [date for date in dates if date not in self._days or self._days[date]["due_at"] <= time.time()]
+        for date in due:
+            if self._stopping:
+                break
+            self.prefetch(date)
+
+    def rollover(self, at=None):
+        """Make the local date at `at` the current date, warming it first if needed."""
+        date = (at or now()).strftime('%Y-%m-%d')
+        if date == self._current:
+            return False
+        with self._lock:
+            warm = self._days.get(date, {}).get("ok")
+        if not warm:
+            self.prefetch(date)
+        menu_scrape.set_current_date(date)
+        self._current = date
+        logger.info(f"Current menu date is now {date}")
+        if menu_archive.RAW_HTML_DAYS:
+            self.archive(date)
+        return True
+
+    def archive(self, today):
+        """Compress, compact or delete the pages of days before `today`."""
+        try:
+            report = menu_archive.maintain(menu_scrape.menu_htmls_dir, today, menu_scrape.fetch_dining_hall_info)
+        except Exception as e:
+            logger.error(f"Error archiving menu pages before {today}: {e}")
+            report = {"error": str(e)}
+        if report is not None:
+            with self._lock:
+                self._archived = dict(report, at=time.time())
+        return report
+
+    def next_wakeup(self, at):
+        with self._lock:
+            due = min((day["due_at"] for day in self._days.values()), default=time.time())
+        return max(0.0, min(seconds_until_midnight(at), due - time.time()))
+
+    def start(self):
+        """Start the background thread, once."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                at = now()
+                self.rollover(at)
+                self.run_once(at)
+                wait = self.next_wakeup(now())
+            except Exception as e:
+                logger.error(f"Error in the prefetch loop: {e}")
+                wait = RETRY_SECONDS
+            with self._wakeup:
+                # Waking a little late keeps a wait that ends at midnight from landing just before it
+                self._wakeup.wait(wait + 0.5)
+
+    def stats(self):
+        with self._lock:
+            days = {date: dict(day) for date, day in sorted(self._days.items())}
+        return {"current_date": menu_scrape.current_date(), "days_ahead": self.days_ahead,
+                "running": self._thread is not None, "days": days, "archived": self._archived}
+
+
+prefetcher = Prefetcher()
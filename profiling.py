@@ -0,0 +1,189 @@
+import io
+import os
+import re
+import hmac
+import json
+import time
+import uuid
+import marshal
+import pstats
+import cProfile
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# Profiling is off unless a secret is configured; requests opt in by sending it
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET')
+# Profile one in every N requests on its own (0 turns sampling off)
+PROFILE_SAMPLE_EVERY = int(os.environ.get('PROFILE_SAMPLE_EVERY', 0))
+# Number of sampled profiles kept (the slowest) and of requested ones kept (the latest)
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 20))
+# Rows of the report's function table
+REPORT_ROWS = 40
+# Modules whose calls are expanded into callee lists in the report
+REPORT_FOCUS = r'menu_scrape|handler|menu_context|menu_db'
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+profiles_dir = os.path.join(this_dir, 'var', 'profiles')
+_profile_id = re.compile(r'[0-9a-f]{12}')
+
+
+def secret_matches(value):
+    return bool(PROFILE_SECRET) and value is not None and hmac.compare_digest(value.encode(), PROFILE_SECRET.encode())
+
+
+class Profile:
+    """A finished request profile."""
+
+    def __init__(self, profile_id, endpoint, method, path, mode, seconds, stats, created_at=None):
+        self.profile_id = profile_id
+        self.endpoint = endpoint
+        self.method = method
+        self.path = path
+        self.mode = mode
+        self.seconds = seconds
+        self.created_at = created_at or time.time()
+        self.stats = stats
+
+    def summary(self):
+        return {
+            "profile_id": self.profile_id,
+            "endpoint": self.endpoint,
+            "method": self.method,
+            "path": self.path,
+            "mode": self.mode,
+            "seconds": round(self.seconds, 4),
+            "created_at": self.created_at,
+        }
+
+    def report(self):
+        """The call-tree report: functions by cumulative time, then callees of the focus modules."""
+        output = io.StringIO()
+        stats = pstats.Stats(stream=output)
+        stats.add(self.stats)
+        output.write(f"{self.method} {self.path} ({self.mode}) took {self.seconds * 1000:.1f}ms\n\n")
+        stats.sort_stats('cumulative').print_stats(REPORT_ROWS)
+        stats.print_callees(REPORT_FOCUS)
+        return output.getvalue()
+
+    def pstats_bytes(self):
+        """The raw profile in the format of pstats.Stats.dump_stats, for snakeviz and friends."""
+        return marshal.dumps(self.stats.stats)
+
+
+class ProfileStore:
+    """Keeps the slowest sampled profiles and the latest requested ones on disk.
+
+    Every worker writes to the same directory, so a profile taken by one
+    can be listed and fetched through any other.
+    """
+
+    def __init__(self, directory=profiles_dir, keep=PROFILE_KEEP):
+        self.directory = directory
+        self.keep = keep
+
+    def add(self, profile):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, profile.profile_id)
+        profile.stats.dump_stats(f"{path}.prof")
+        # The summary is written last and atomically; it is what makes the profile visible
+        with open(f"{path}.json.tmp", 'w') as f:
+            json.dump(profile.summary(), f)
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+        self._prune()
+
+    def get(self, profile_id):
+        if not _profile_id.fullmatch(profile_id):
+            return None
+        path = os.path.join(self.directory, profile_id)
+        try:
+            with open(f"{path}.json") as f:
+                summary = json.load(f)
+            stats = pstats.Stats(f"{path}.prof", stream=io.StringIO())
+        except (OSError, ValueError, EOFError):
+            return None
+        return Profile(profile_id, summary["endpoint"], summary["method"], summary["path"], summary["mode"],
+                       summary["seconds"], stats, created_at=summary["created_at"])
+
+    def list(self):
+        return sorted(self._summaries(), key=lambda summary: -summary["seconds"])
+
+    def _summaries(self):
+        summaries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return summaries
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    summaries.append(json.load(f))
+            except (OSError, ValueError):
+                # Pruned by another worker since the listing
+                continue
+        return summaries
+
+    def _prune(self):
+        summaries = self._summaries()
+        sampled = sorted((s for s in summaries if s["mode"] != 'requested'), key=lambda s: -s["seconds"])
+        requested = sorted((s for s in summaries if s["mode"] == 'requested'), key=lambda s: -s["created_at"])
+        for summary in sampled[self.keep:] + requested[self.keep:]:
+            path = os.path.join(self.directory, summary["profile_id"])
+            for suffix in ('.json', '.prof'):
+                try:
+                    os.remove(path + suffix)
+                except FileNotFoundError:
+                    pass
+
+
+profile_store = ProfileStore()
+_requests_seen = itertools.count(1)
+
+
+class RequestProfiler:
+    """Profiles one request on the current thread, from start() until finish()."""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.profile_id = uuid.uuid4().hex[:12]
+        self._profile = cProfile.Profile()
+        self._started = None
+
+    def start(self):
+        try:
+            self._profile.enable()
+        except ValueError as e:
+            # Another profiler is active on this thread
+            logger.warning(f"Could not start profiling: {e}")
+            return False
+        self._started = time.perf_counter()
+        return True
+
+    def finish(self, endpoint, method, path):
+        self._profile.disable()
+        seconds = time.perf_counter() - self._started
+        profile = Profile(self.profile_id, endpoint, method, path, self.mode, seconds, pstats.Stats(self._profile))
+        profile_store.add(profile)
+        logger.info(f"Stored {self.mode} profile {self.profile_id} of {method} {path} ({seconds * 1000:.1f}ms)")
+        return profile
+
+
+def profiler_for(requested_secret):
+    """Return a started RequestProfiler if this request should be profiled, else None.
+
+    A request is profiled when it carries the configured secret, or when it
+    is the Nth request and sampling is on.
+    """
+    if secret_matches(requested_secret):
+        mode = 'requested'
+    elif PROFILE_SAMPLE_EVERY and next(_requests_seen) % PROFILE_SAMPLE_EVERY == 0:
+        mode = 'sampled'
+    else:
+        return None
+    profiler = RequestProfiler(mode)
+    return profiler if profiler.start() else None
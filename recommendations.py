@@ -0,0 +1,148 @@
+import hashlib
+import json
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import dining_hours
+import metrics
+from handler import Handler
+from menu_scrape import get_current_time_est as now, current_date, on_menus_changed
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger.setLevel(logging.DEBUG)
+
+# Seconds a computed recommendation stays fresh
+RECOMMENDATION_TTL = 30 * 60
+# Seconds to wait before retrying after the model call failed
+FAILURE_RETRY_SECONDS = 60
+# Users seen within this many seconds get new recommendations when the meal period changes
+ACTIVE_USER_SECONDS = 4 * 60 * 60
+# How often the meal period is checked
+PERIOD_CHECK_SECONDS = 60
+MAX_WORKERS = 2
+
+PENDING = {"status": "pending", "reasoning": "Recommendations are being generated."}
+
+
+def preferences_hash(preferences):
+    return hashlib.sha256(json.dumps(preferences, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class RecommendationCache:
+    """Recommendations keyed by (preferences hash, date, meal period), computed in the background.
+
+    get() never waits for the model: it returns the cached recommendation,
+    or PENDING after scheduling the computation on a small thread pool.
+    """
+
+    def __init__(self, compute, ttl=RECOMMENDATION_TTL, max_workers=MAX_WORKERS):
+        self.compute = compute
+        self.ttl = ttl
+        self._entries = {}
+        self._in_flight = set()
+        self._active_users = {}
+        self._period = None
+        self._watcher = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='recommendations')
+
+    def key(self, user_id, at=None):
+        date = at.strftime('%Y-%m-%d') if at else current_date()
+        at = at or now()
+        preferences = Handler.fetch_user_preferences(user_id)
+        return (preferences_hash(preferences), date, dining_hours.get_schedule().meal_period(at))
+
+    def get(self, user_id):
+        """Return the user's recommendation, or PENDING while it is being computed."""
+        self._start_watcher()
+        key = self.key(user_id)
+        with self._lock:
+            self._active_users[user_id] = time.time()
+            entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            metrics.cache_lookup('recommendations', entry[1] is not None)
+            if entry[1] is not None:
+                return entry[1]
+            return PENDING
+        metrics.cache_lookup('recommendations', False)
+        self._schedule(key, user_id)
+        return PENDING
+
+    def refresh(self, user_id):
+        """Recompute the user's recommendation now, e.g. after their preferences changed."""
+        self._schedule(self.key(user_id), user_id, force=True)
+
+    def _schedule(self, key, user_id, force=False):
+        with self._lock:
+            if key in self._in_flight:
+                return
+            entry = self._entries.get(key)
+            if not force and entry and entry[0] > time.time():
+                return
+            self._in_flight.add(key)
+        self._executor.submit(self._run, key, user_id)
+
+    def _run(self, key, user_id):
+        started = time.perf_counter()
+        try:
+            value = dict(self.compute(user_id, key[1]), status="ready")
+            expires_at = time.time() + self.ttl
+            logger.info(f"Computed recommendations for {user_id} in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"Error computing recommendations for {user_id}: {e}")
+            value = None
+            expires_at = time.time() + FAILURE_RETRY_SECONDS
+        with self._lock:
+            self._in_flight.discard(key)
+            self._entries[key] = (expires_at, value)
+            current = time.time()
+            for stale in [k for k, (expires, _) in self._entries.items() if expires <= current]:
+                del self._entries[stale]
+
+    def invalidate(self, date):
+        """Drop the recommendations made from a date's menus and recompute them for active users."""
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == date]:
+                del self._entries[key]
+            active_users = list(self._active_users)
+        if date == current_date():
+            for user_id in active_users:
+                self._schedule(self.key(user_id), user_id)
+
+    def check_meal_period(self, at=None):
+        """Recompute recommendations for recently active users when the meal period changes."""
+        period = dining_hours.get_schedule().meal_period(at or now())
+        with self._lock:
+            changed = self._period is not None and period != self._period
+            self._period = period
+            cutoff = time.time() - ACTIVE_USER_SECONDS
+            for user_id in [u for u, seen in self._active_users.items() if seen < cutoff]:
+                del self._active_users[user_id]
+            active_users = list(self._active_users)
+        if changed:
+            logger.info(f"Meal period changed to {period}; refreshing {len(active_users)} recommendations")
+            for user_id in active_users:
+                self._schedule(self.key(user_id, at), user_id)
+
+    def _start_watcher(self):
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch, name='recommendations-period', daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        while True:
+            try:
+                self.check_meal_period()
+            except Exception as e:
+                logger.error(f"Error checking meal period: {e}")
+            time.sleep(PERIOD_CHECK_SECONDS)
+
+
+recommendation_cache = RecommendationCache(Handler.get_ai_reccomendations)
+# Recommendations only depend on the day's menus as a whole
+on_menus_changed(lambda date, report: recommendation_cache.invalidate(date))
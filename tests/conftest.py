@@ -0,0 +1,51 @@
+import os
+import sys
+from collections import OrderedDict
+
+# The app must not start background work or call a real model while under test
+os.environ.setdefault('PREFETCH', '0')
+os.environ.setdefault('LLM_BACKEND', 'fake')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fixture_htmls_dir = os.path.join(repo_dir, 'data', 'menu_htmls')
+# Days of saved menu pages checked into data/menu_htmls
+FIXTURE_DATES = ('2024-11-16', '2024-11-17', '2024-11-18')
+
+
+@pytest.fixture
+def users_db(tmp_path, monkeypatch):
+    """Point the handler at a users database in a scratch directory."""
+    import db
+    import handler
+    path = str(tmp_path / 'users.db')
+    monkeypatch.setattr(handler, 'users_db', path)
+    yield path
+    db.close_connections()
+
+
+@pytest.fixture
+def menu_output(tmp_path, monkeypatch):
+    """Keep parsed menus and snapshots in a scratch directory, serving the fixture days."""
+    import menu_scrape
+    import menu_snapshot
+    import menu_store
+    store_dir = tmp_path / 'menus'
+    (store_dir / 'pages').mkdir(parents=True)
+    (tmp_path / 'snapshots').mkdir()
+    monkeypatch.setattr(menu_store, 'store_dir', str(store_dir))
+    monkeypatch.setattr(menu_store, 'index_path', str(store_dir / 'index.json'))
+    monkeypatch.setattr(menu_store, 'pages_dir', str(store_dir / 'pages'))
+    monkeypatch.setattr(menu_store, 'legacy_output_path', str(tmp_path / 'dining_hall_info.json'))
+    monkeypatch.setattr(menu_snapshot, 'snapshot_dir', str(tmp_path / 'snapshots'))
+    monkeypatch.setattr(menu_scrape, '_current_date', FIXTURE_DATES[-1])
+    # Pages parsed by an earlier test are in memory but not in this store
+    monkeypatch.setattr(menu_scrape, '_parsed_pages', OrderedDict())
+    menu_snapshot._mapped.clear()
+    menu_scrape.invalidate_menu_cache()
+    yield tmp_path
+    menu_snapshot._mapped.clear()
+    menu_scrape.invalidate_menu_cache()
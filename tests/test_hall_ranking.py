@@ -0,0 +1,32 @@
+import pytest
+
+import flaskServer
+import geo
+import handler
+from handler import Handler
+
+LOCATION = (42.2780, -83.7382)
+
+
+@pytest.fixture
+def client(menu_output, users_db):
+    handler.migrate_users_db()
+    Handler.register_new_user('rahul', 'password')
+    return flaskServer.app.test_client()
+
+
+def test_ranking_uses_exact_distances(client):
+    # Two points a few meters apart used to share a cached ranking
+    for location in (LOCATION, (LOCATION[0] + 0.0004, LOCATION[1])):
+        response = client.get('/nearest_halls/', query_string={'location': f'{location[0]},{location[1]}'})
+        assert response.status_code == 200
+        halls = response.json['dining_halls']
+        assert {hall['dining_hall']: hall['distance'] for hall in halls} == geo.hall_distances(location)
+        order = [(hall['meal'] is None, hall['matching_items'] == 0, hall['distance']) for hall in halls]
+        assert order == sorted(order)
+
+
+def test_limit_must_be_positive(client):
+    location = f'{LOCATION[0]},{LOCATION[1]}'
+    assert client.get('/nearest_halls/', query_string={'location': location, 'limit': 0}).status_code == 400
+    assert len(client.get('/nearest_halls/', query_string={'location': location, 'limit': 2}).json['dining_halls']) == 2
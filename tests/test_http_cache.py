@@ -0,0 +1,86 @@
+import copy
+
+import pytest
+
+from werkzeug.datastructures import MultiDict
+
+import flaskServer
+import handler
+import menu_scrape
+from handler import Handler
+from recommendations import recommendation_cache
+
+LOCATION = {'location': '42.2780,-83.7382'}
+
+
+@pytest.fixture
+def client(menu_output, users_db, monkeypatch):
+    handler.migrate_users_db()
+    Handler.register_new_user('rahul', 'password')
+    # Recommendations come from the model; the menu routes only read the cached one
+    monkeypatch.setattr(recommendation_cache, 'get', lambda user: {"status": "pending"})
+    monkeypatch.setattr(recommendation_cache, 'refresh', lambda user: None)
+    return flaskServer.app.test_client()
+
+
+@pytest.mark.parametrize('path', ['/get_full_menu/', '/get_full_menu/?summary=1', '/getmenu/', '/getmenu/?meal=Dinner'])
+def test_matching_etag_gets_304(client, path):
+    response = client.get(path, headers=LOCATION)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    cached = client.get(path, headers={**LOCATION, 'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.data == b''
+    assert cached.headers['ETag'] == etag
+
+    # If-None-Match compares weakly, and may list several validators
+    assert client.get(path, headers={**LOCATION, 'If-None-Match': f'"other", W/{etag}'}).status_code == 304
+    assert client.get(path, headers={**LOCATION, 'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_each_encoding_has_its_own_etag(client):
+    plain = client.get('/get_full_menu/')
+    gzipped = client.get('/get_full_menu/', headers={'Accept-Encoding': 'gzip'})
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+    assert gzipped.headers['ETag'] != plain.headers['ETag']
+    assert gzipped.headers['Vary'] == 'Accept-Encoding'
+
+    revalidated = client.get('/get_full_menu/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': gzipped.headers['ETag']})
+    assert revalidated.status_code == 304
+
+
+def test_personalized_etag_changes_with_preferences(client):
+    etag = client.get('/getmenu/', headers=LOCATION).headers['ETag']
+    preferences = copy.deepcopy(Handler.default_preferences)
+    preferences['allergens']['milk'] = True
+    Handler.save_user_preferences('rahul', preferences)
+
+    response = client.get('/getmenu/', headers={**LOCATION, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert all('milk' not in item['allergens']
+               for hall in response.json['dining_info'] for stations in hall['menus'].values()
+               for station in stations for item in station['items'])
+
+
+def test_snapshot_body_matches_decoded_menus(client):
+    # /getmenu/ is written from the snapshot's item JSON; it must equal filtering the decoded menus
+    assert Handler.published_menu_index() is not None
+    spliced = client.get('/getmenu/?meal=Lunch&fields=item_name', headers=LOCATION).json['dining_info']
+    query = flaskServer.MenuQuery(meals=('Lunch',), fields=('item_name',))
+    decoded = query.apply(Handler.get_user_menu('rahul', (42.2780, -83.7382)))
+    assert spliced == decoded
+
+
+
+@pytest.mark.parametrize('args', [{'hall': 'bursley'}, {'meal': 'Dinner', 'summary': '1'}])
+def test_filtered_full_menu_is_written_from_the_snapshot(client, args):
+    query = flaskServer.MenuQuery.from_args(MultiDict(args))
+    expected = query.apply(Handler.get_menu(menu_scrape.fetch_dining_hall_info()))
+    # A worker that did not parse the day has only the snapshot
+    menu_scrape.invalidate_menu_cache()
+
+    response = client.get('/get_full_menu/', query_string=args)
+    assert response.json == expected
+    assert menu_scrape.menu_cache.latest(menu_scrape.current_date()) is None
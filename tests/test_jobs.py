@@ -0,0 +1,122 @@
+import json
+import threading
+import time
+
+import pytest
+
+import db
+from jobs import JobQueue, LEASE_SECONDS
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def jobs_db(tmp_path):
+    yield str(tmp_path / 'jobs.db')
+    db.close_connections()
+
+
+def recording_queue(path, runs, workers=4):
+    queue = JobQueue(path=path, workers=workers)
+    lock = threading.Lock()
+
+    def record(key, payload):
+        with lock:
+            runs.append((key, payload))
+    queue.register('record', record, merge=lambda old, new: {"n": old["n"] + new["n"]})
+    return queue
+
+
+def statuses(path):
+    with db.cursor(path) as c:
+        c.execute("SELECT key, status FROM jobs ORDER BY id")
+        return c.fetchall()
+
+
+def test_enqueue_does_not_run_until_started(jobs_db):
+    runs = []
+    queue = recording_queue(jobs_db, runs)
+    queue.enqueue('record', 'alice', {"n": 1})
+    time.sleep(0.2)
+    assert runs == []
+    assert statuses(jobs_db) == [('alice', 'queued')]
+
+
+def test_waiting_jobs_coalesce_and_each_runs_once(jobs_db):
+    runs = []
+    queue = recording_queue(jobs_db, runs)
+    first = queue.enqueue('record', 'alice', {"n": 1})
+    assert queue.enqueue('record', 'alice', {"n": 2}) == first
+    for key in ('bob', 'carol'):
+        queue.enqueue('record', key, {"n": 1})
+
+    queue.start()
+    try:
+        wait_for(lambda: len(runs) == 3)
+        time.sleep(0.2)
+    finally:
+        queue.stop()
+    assert sorted(runs) == [('alice', {"n": 3}), ('bob', {"n": 1}), ('carol', {"n": 1})]
+    assert [status for _, status in statuses(jobs_db)] == ['done'] * 3
+
+
+def test_queues_sharing_a_database_run_each_job_once(jobs_db):
+    runs = []
+    queues = [recording_queue(jobs_db, runs) for _ in range(3)]
+    for number in range(50):
+        queues[number % 3].enqueue('record', f'user{number}', {"n": 1})
+
+    for queue in queues:
+        queue.start()
+    try:
+        wait_for(lambda: len(runs) >= 50)
+        time.sleep(0.2)
+    finally:
+        for queue in queues:
+            queue.stop()
+    assert sorted(key for key, _ in runs) == sorted(f'user{number}' for number in range(50))
+
+
+def insert_running(path, key, owner, lease_until):
+    current = time.time()
+    with db.transaction(path) as c:
+        c.execute("""INSERT INTO jobs (kind, key, payload, status, attempts, created_at, available_at, started_at, owner, lease_until)
+                    VALUES ('record', ?, ?, 'running', 1, ?, ?, ?, ?, ?)""",
+                  (key, json.dumps({"n": 1}), current, current, current, owner, lease_until))
+
+
+def test_job_with_expired_lease_runs_again(jobs_db):
+    runs = []
+    queue = recording_queue(jobs_db, runs)
+    # Left running by a process that crashed a lease ago
+    insert_running(jobs_db, 'crashed', 'gone:1:00000000', time.time() - 1)
+    # Still running elsewhere, with its lease being renewed
+    insert_running(jobs_db, 'alive', 'elsewhere:2:00000000', time.time() + LEASE_SECONDS)
+
+    queue.start()
+    try:
+        wait_for(lambda: runs)
+        time.sleep(0.2)
+    finally:
+        queue.stop()
+    assert runs == [('crashed', {"n": 1})]
+    assert statuses(jobs_db) == [('crashed', 'done'), ('alive', 'running')]
+
+
+def test_stale_owner_cannot_finish_a_reclaimed_job(jobs_db):
+    runs = []
+    queue = recording_queue(jobs_db, runs)
+    insert_running(jobs_db, 'alice', 'elsewhere:2:00000000', time.time() + LEASE_SECONDS)
+    with db.cursor(jobs_db) as c:
+        c.execute("SELECT id, kind, key, payload, attempts, created_at FROM jobs")
+        job = c.fetchone()
+
+    # This queue does not hold the lease, so running the job must not mark it done
+    queue._run(*job)
+    assert statuses(jobs_db) == [('alice', 'running')]
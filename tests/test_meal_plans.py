@@ -0,0 +1,79 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import flaskServer
+import handler
+from handler import Handler
+from meal_plans import MealPlanner, meal_planner, MAX_PLAN_DAYS
+
+
+def days_from(start, count):
+    first = datetime.strptime(start, '%Y-%m-%d')
+    return [(first + timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range(count)]
+
+
+@pytest.fixture
+def client(menu_output, users_db, tmp_path, monkeypatch):
+    handler.migrate_users_db()
+    Handler.register_new_user('rahul', 'password')
+    monkeypatch.setattr(meal_planner, 'path', str(tmp_path / 'meal_plans.db'))
+    meal_planner._migrate()
+    fetched = []
+    # Days past the fixtures would be downloaded; the planner's tasks fetch them
+    monkeypatch.setattr(meal_planner, 'fetch_day', lambda date: fetched.append(date) or [{"dining_hall": "Bursley"}])
+    monkeypatch.setattr(meal_planner, 'plan_day', lambda user_id, dining_halls, date, prompt: [{"dining_hall": "Bursley", "date": date}])
+    client = flaskServer.app.test_client()
+    client.fetched = fetched
+    return client
+
+
+def wait_for_plan(client, location):
+    deadline = time.monotonic() + 10
+    while True:
+        plan = client.get(location).json
+        if plan["status"] == "complete" or time.monotonic() > deadline:
+            return plan
+        time.sleep(0.02)
+
+
+def test_week_long_plan_past_the_prefetch_window(client, menu_output):
+    dates = days_from('2024-11-18', 7)
+    response = client.post('/meal_plan/', json={"dates": dates, "prompt": "high protein"})
+
+    assert response.status_code == 202
+    plan = wait_for_plan(client, response.headers['Location'])
+    assert plan["status"] == "complete"
+    assert [plan["days"][date]["status"] for date in dates] == ["ready"] * 7
+    assert sorted(client.fetched) == dates
+
+
+def test_rejects_dates_too_far_out(client):
+    dates = days_from('2024-11-18', MAX_PLAN_DAYS + 1)
+    assert client.post('/meal_plan/', json={"dates": dates[-1:]}).status_code == 400
+    assert client.post('/meal_plan/', json={"dates": dates}).status_code == 400
+    assert client.post('/meal_plan/', json={"dates": ["2024-13-01"]}).status_code == 400
+
+
+def test_day_without_menus_fails_alone(client, monkeypatch):
+    monkeypatch.setattr(meal_planner, 'fetch_day', lambda date: [] if date == '2024-11-20' else [{"dining_hall": "Bursley"}])
+    response = client.post('/meal_plan/', json={"dates": days_from('2024-11-19', 2)})
+
+    plan = wait_for_plan(client, response.headers['Location'])
+    assert plan["days"]["2024-11-19"]["status"] == "ready"
+    assert plan["days"]["2024-11-20"]["status"] == "failed"
+    assert plan["days"]["2024-11-20"]["error"] == "No menus for 2024-11-20."
+
+
+def test_plan_can_be_polled_from_another_worker(client):
+    dates = days_from('2024-11-18', 3)
+    response = client.post('/meal_plan/', json={"dates": dates})
+    wait_for_plan(client, response.headers['Location'])
+
+    # Another worker has the same database but none of this worker's plans
+    other = MealPlanner(meal_planner.plan_day, meal_planner.fetch_day, path=meal_planner.path)
+    plan = other.get(response.json["plan_id"]).to_dict()
+    assert plan["status"] == "complete"
+    assert plan["days"] == meal_planner.get(response.json["plan_id"]).to_dict()["days"]
+    assert other.get("0" * 32) is None
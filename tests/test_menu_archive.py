@@ -0,0 +1,110 @@
+import os
+import shutil
+
+import pytest
+
+import menu_archive
+import menu_scrape
+import menu_store
+from conftest import FIXTURE_DATES, fixture_htmls_dir
+
+
+@pytest.fixture
+def htmls_dir(menu_output, monkeypatch):
+    """A copy of the fixture days that the app downloads to and parses from."""
+    path = menu_output / 'menu_htmls'
+    for date in FIXTURE_DATES:
+        shutil.copytree(os.path.join(fixture_htmls_dir, date), path / date)
+    monkeypatch.setattr(menu_scrape, 'menu_htmls_dir', str(path))
+    return str(path)
+
+
+@pytest.fixture
+def parsed(htmls_dir):
+    """The menus of every fixture day, parsed and stored before any archiving."""
+    return {date: menu_scrape.fetch_dining_hall_info(date) for date in FIXTURE_DATES}
+
+
+def original_pages(date):
+    return dict(menu_archive.read_pages(os.path.join(fixture_htmls_dir, date)))
+
+def tree(path):
+    return sorted((os.path.relpath(os.path.join(root, name), path), os.path.getsize(os.path.join(root, name)))
+                  for root, _, files in os.walk(path) for name in files)
+
+def reload(date):
+    menu_scrape.invalidate_menu_cache(date)
+    return menu_scrape.fetch_dining_hall_info(date)
+
+
+def test_compressed_days_read_back(htmls_dir, parsed):
+    report = menu_archive.maintain(htmls_dir, '2024-11-20', menu_scrape.fetch_dining_hall_info,
+                                   raw_days=1, weekly_days=30, retention_days=0)
+
+    assert report['compressed'] == list(FIXTURE_DATES)
+    assert report['bytes_after'] < report['bytes_before']
+    for date in FIXTURE_DATES:
+        day_dir = os.path.join(htmls_dir, date)
+        assert all(file_name.endswith('.html.gz') for file_name in os.listdir(day_dir))
+        assert dict(menu_archive.read_pages(day_dir)) == original_pages(date)
+        assert menu_archive.has_day(day_dir)
+        assert reload(date) == parsed[date]
+
+
+def test_weekly_archive_round_trip(htmls_dir, parsed):
+    # 11-16 and 11-17 end ISO week 46; 11-18 starts week 47, which is not old enough yet
+    report = menu_archive.maintain(htmls_dir, '2024-12-01', menu_scrape.fetch_dining_hall_info,
+                                   raw_days=1, weekly_days=7, retention_days=0)
+
+    assert report['archived'] == {'2024-W46': ['2024-11-16', '2024-11-17']}
+    assert report['compressed'] == ['2024-11-18']
+    for date in FIXTURE_DATES:
+        day_dir = os.path.join(htmls_dir, date)
+        assert os.path.isdir(day_dir) == (date == '2024-11-18')
+        assert dict(menu_archive.read_pages(day_dir)) == original_pages(date)
+        assert reload(date) == parsed[date]
+
+    # Compacting the next week leaves the archived one as it was
+    report = menu_archive.maintain(htmls_dir, '2024-12-08', menu_scrape.fetch_dining_hall_info,
+                                   raw_days=1, weekly_days=7, retention_days=0)
+    assert report['archived'] == {'2024-W47': ['2024-11-18']}
+    for date in FIXTURE_DATES:
+        assert dict(menu_archive.read_pages(os.path.join(htmls_dir, date))) == original_pages(date)
+
+
+def test_retention_deletes_pages_but_keeps_menus(htmls_dir, parsed):
+    menu_archive.maintain(htmls_dir, '2024-12-01', menu_scrape.fetch_dining_hall_info,
+                          raw_days=1, weekly_days=7, retention_days=0)
+    report = menu_archive.maintain(htmls_dir, '2025-01-01', menu_scrape.fetch_dining_hall_info,
+                                   raw_days=1, weekly_days=7, retention_days=30)
+
+    assert sorted(report['deleted']) == list(FIXTURE_DATES)
+    assert [path for path, _ in tree(htmls_dir) if not path.endswith('.lock')] == []
+    for date in FIXTURE_DATES:
+        assert not menu_archive.has_day(os.path.join(htmls_dir, date))
+        assert menu_store.load_day(date) == parsed[date]
+        assert reload(date) == parsed[date]
+
+
+def test_unverified_pages_are_kept(htmls_dir):
+    # Nothing was parsed, and without a loader nothing can be
+    before = tree(htmls_dir)
+    report = menu_archive.maintain(htmls_dir, '2025-01-01', raw_days=1, weekly_days=7, retention_days=30)
+
+    assert report['unverified'] == list(FIXTURE_DATES)
+    assert report['deleted'] == [] and report['archived'] == {} and report['compressed'] == []
+    assert [entry for entry in tree(htmls_dir) if not entry[0].endswith('.lock')] == before
+
+
+def test_dry_run_changes_nothing(htmls_dir, parsed, menu_output):
+    def load_day(date):
+        raise AssertionError(f"a dry run loaded {date}")
+    menu_store.save_day('2024-11-17', parsed['2024-11-17'])  # no longer matches the pages
+    before = tree(str(menu_output))
+
+    report = menu_archive.maintain(htmls_dir, '2025-01-01', load_day, raw_days=1, weekly_days=7,
+                                   retention_days=30, dry_run=True)
+
+    assert report['deleted'] == ['2024-11-16', '2024-11-18']
+    assert report['unparsed'] == ['2024-11-17']
+    assert tree(str(menu_output)) == before
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import menu_scrape
+
+DATE = '2030-01-07'
+HALLS = ['Bursley', 'South Quad']
+LAST_MODIFIED = 'Mon, 07 Jan 2030 06:00:00 GMT'
+
+
+@pytest.fixture
+def dining_site(tmp_path, monkeypatch):
+    """A local stand-in for the dining site that answers conditional GETs, recording every request."""
+    pages = {f'/{hall.lower().replace(" ", "-")}/': f'<html>{hall} menu</html>' for hall in HALLS}
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            requests_seen.append((path, self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')))
+            if path not in pages:
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = pages[path].encode()
+            etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', LAST_MODIFIED)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(menu_scrape, 'MENU_BASE_URL', f'http://127.0.0.1:{server.server_address[1]}/')
+    monkeypatch.setattr(menu_scrape, 'menu_htmls_dir', str(tmp_path))
+    server.pages = pages
+    server.requests_seen = requests_seen
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read_validators():
+    with open(os.path.join(menu_scrape.menu_htmls_dir, DATE, menu_scrape.VALIDATORS_FILE)) as f:
+        return json.load(f)
+
+
+def test_conditional_download(dining_site):
+    assert set(menu_scrape.download_menu_pages([DATE], halls=HALLS).values()) == {'updated'}
+    validators = read_validators()
+    assert set(validators) == {'bursley.html', 'south-quad.html'}
+    assert all(entry['etag'] and entry['last_modified'] == LAST_MODIFIED for entry in validators.values())
+    bursley = os.path.join(menu_scrape.menu_htmls_dir, DATE, 'bursley.html')
+    mtime = os.stat(bursley).st_mtime_ns
+
+    # Nothing changed: every request is conditional, every answer a 304, and no page is rewritten
+    dining_site.requests_seen.clear()
+    assert set(menu_scrape.download_menu_pages([DATE], halls=HALLS).values()) == {'not_modified'}
+    assert sorted(dining_site.requests_seen) == sorted(
+        (f'/{file_name[:-len(".html")]}/', entry['etag'], LAST_MODIFIED) for file_name, entry in validators.items())
+    assert os.stat(bursley).st_mtime_ns == mtime
+    assert read_validators() == validators
+
+    # One page changed: only it is downloaded, and its new validators are saved
+    dining_site.pages['/bursley/'] = '<html>Bursley dinner menu</html>'
+    assert menu_scrape.download_menu_pages([DATE], halls=HALLS) == {(DATE, 'Bursley'): 'updated', (DATE, 'South Quad'): 'not_modified'}
+    with open(bursley) as f:
+        assert f.read() == '<html>Bursley dinner menu</html>'
+    assert read_validators()['bursley.html']['etag'] != validators['bursley.html']['etag']
+    assert read_validators()['south-quad.html'] == validators['south-quad.html']
+
+
+def test_day_without_pages_saves_no_validators(dining_site):
+    # A plain session, so the 404s are not retried
+    statuses = menu_scrape.download_menu_pages([DATE], halls=['Markley'], session=requests.Session())
+    assert statuses == {(DATE, 'Markley'): 'failed'}
+    assert not os.path.exists(os.path.join(menu_scrape.menu_htmls_dir, DATE))
@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+import menu_archive
+import menu_scrape
+from conftest import FIXTURE_DATES, fixture_htmls_dir
+
+
+@pytest.mark.parametrize('date', FIXTURE_DATES)
+def test_single_pass_matches_soup(date):
+    pages = list(menu_archive.read_pages(os.path.join(fixture_htmls_dir, date)))
+    assert pages
+    for name, html_content in pages:
+        expected = menu_scrape.PARSER_ENGINES['soup'](html_content, date)
+        assert menu_scrape.PARSER_ENGINES['single_pass'](html_content, date) == expected, name
+
+
+@pytest.mark.parametrize('date', FIXTURE_DATES)
+def test_pages_have_menus(date):
+    # Equal but empty results would hide a parser that finds nothing
+    for name, html_content in menu_archive.read_pages(os.path.join(fixture_htmls_dir, date)):
+        hall = menu_scrape.PARSER_ENGINES['single_pass'](html_content, date)
+        assert hall['dining_hall'] and hall['last_updated'] == date
+        assert any(items for stations in hall['menus'].values() for items in stations.values()), name
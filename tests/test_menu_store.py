@@ -0,0 +1,30 @@
+import multiprocessing
+
+import pytest
+
+import menu_store
+
+PROCESSES = 4
+DATES_EACH = 15
+
+
+def save_dates(worker):
+    for number in range(DATES_EACH):
+        date = f'2030-{worker + 1:02d}-{number + 1:02d}'
+        menu_store.save_day(date, [{"dining_hall": "Bursley", "menus": {}}], pages={"Bursley": f'{worker}-{number}'})
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_concurrent_saves_keep_every_date(menu_output):
+    # Every process rewrites the index; none may drop another's dates or pages
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=save_dates, args=(worker,)) for worker in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    dates = menu_store.available_dates()
+    assert len(dates) == PROCESSES * DATES_EACH
+    assert all(menu_store.day_pages(date) for date in dates)
@@ -0,0 +1,68 @@
+import json
+import sqlite3
+
+import pytest
+
+import handler
+from handler import Handler
+
+
+def create_legacy_db(path, rows):
+    """The schema before migrations: one unindexed users table with each conversation as a JSON blob."""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id text, password text, preferences json, conversation text)")
+    conn.executemany("INSERT INTO users (user_id, password, preferences, conversation) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def test_migrates_conversations_and_drops_duplicates(users_db):
+    preferences = json.dumps(Handler.default_preferences)
+    first = [{"role": "user", "parts": "What is at Bursley?"}, {"role": "model", "parts": "Pizza."}]
+    create_legacy_db(users_db, [
+        ("alice", "hash1", preferences, json.dumps(first)),
+        ("bob", "hash2", preferences, None),
+        # The old schema had no primary key, so registering twice added a second row
+        ("alice", "hash3", preferences, json.dumps([{"role": "user", "parts": "Later"}])),
+    ])
+
+    handler.migrate_users_db()
+
+    conn = sqlite3.connect(users_db)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == handler.USERS_SCHEMA_VERSION
+    assert conn.execute("SELECT user_id, password FROM users ORDER BY user_id").fetchall() == [("alice", "hash1"), ("bob", "hash2")]
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'users_legacy'").fetchone() is None
+    conn.close()
+    assert Handler.load_conversation("alice") == first
+    assert Handler.load_conversation("bob") == []
+    assert Handler.fetch_user_preferences("alice") == Handler.default_preferences
+
+
+def test_migration_runs_once(users_db):
+    handler.migrate_users_db()
+    Handler.register_new_user("carol", "password")
+    Handler.append_messages("carol", [{"role": "user", "parts": "Hi"}])
+
+    handler.migrate_users_db()
+
+    assert Handler.load_conversation("carol") == [{"role": "user", "parts": "Hi"}]
+
+
+def test_user_id_is_unique(users_db):
+    handler.migrate_users_db()
+    Handler.register_new_user("dave", "password")
+    conn = sqlite3.connect(users_db)
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO users (user_id, password, preferences) VALUES ('dave', 'x', '{}')")
+    conn.close()
+
+
+def test_conversation_window_is_the_last_messages(users_db):
+    handler.migrate_users_db()
+    Handler.register_new_user("erin", "password")
+    messages = [{"role": "user" if seq % 2 == 0 else "model", "parts": f"message {seq}"} for seq in range(10)]
+    Handler.append_messages("erin", messages)
+
+    # Menu context goes with each prompt, so the first exchange is not kept back
+    assert Handler.load_conversation("erin", last=4) == messages[-4:]
+    assert Handler.load_conversation("erin", last=20) == messages
@@ -0,0 +1,53 @@
+import json
+import os
+import time
+import cProfile
+import pstats
+
+import metrics
+from profiling import Profile, ProfileStore
+
+
+def make_profile(profile_id, mode, seconds):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    sorted(range(100))
+    profiler.disable()
+    return Profile(profile_id, '/getmenu/', 'GET', '/getmenu/', mode, seconds, pstats.Stats(profiler))
+
+
+def test_profiles_are_shared_and_pruned(tmp_path):
+    one, other = ProfileStore(str(tmp_path), keep=2), ProfileStore(str(tmp_path), keep=2)
+    for number, seconds in enumerate([0.3, 0.1, 0.2]):
+        one.add(make_profile(f"{number:012x}", 'sampled', seconds))
+    one.add(make_profile('a' * 12, 'requested', 0.05))
+
+    # The fastest sampled profile was pruned; the other worker sees the rest
+    assert [summary["profile_id"] for summary in other.list()] == ['0' * 12, '2'.zfill(12), 'a' * 12]
+    profile = other.get('0' * 12)
+    assert profile.seconds == 0.3
+    assert 'sorted' in profile.report()
+    assert other.get('1'.zfill(12)) is None
+    assert other.get('../users') is None
+
+
+def test_metrics_of_every_worker_are_labelled(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'snapshot_dir', str(tmp_path))
+    counter = metrics.Counter('test_worker_requests_total', "Test requests.", ('endpoint',))
+    try:
+        counter.inc(endpoint='/getmenu/')
+        other = {"worker": 1, "published_at": time.time(), "reports": {"jobs": {"depth": 0}},
+                 "metrics": {counter.name: [[['/getmenu/'], 5]]}}
+        stale = dict(other, worker=2, published_at=time.time() - metrics.STALE_SECONDS - 1)
+        for found in (other, stale):
+            with open(os.path.join(tmp_path, f"{found['worker']}.json"), 'w') as f:
+                json.dump(found, f)
+
+        text = metrics.render_workers()
+        assert f'test_worker_requests_total{{endpoint="/getmenu/",worker="{os.getpid()}"}} 1' in text
+        assert 'test_worker_requests_total{endpoint="/getmenu/",worker="1"} 5' in text
+        assert 'worker="2"' not in text
+        assert not os.path.exists(os.path.join(tmp_path, '2.json'))
+        assert metrics.worker_snapshots()[1]["reports"]["jobs"] == {"depth": 0}
+    finally:
+        metrics.REGISTRY.remove(counter)